@@ -0,0 +1,269 @@
+"""Measure worker throughput with simulated clients in many rooms.
+
+Starts a `YroomWorker` and connects `--clients` websocket clients to each
+of `--rooms` rooms through `YroomConsumer`. Every client keeps its own
+Yjs document, syncs with the room and then sends `--edits` document
+updates plus an awareness update every `--awareness-every` edits. Reports
+messages per second, edit-to-broadcast latency (from sending an update
+until each client of the room received it) and the RSS of the process.
+
+Usage:
+
+    python benchmarks/load.py [--rooms 50] [--clients 4] [--edits 50]
+        [--interval 0.01] [--batch-size N] [--concurrent] [--redis URL]
+
+Without `--redis` the worker and the clients share an `InMemoryChannelLayer`.
+Pass `--redis redis://localhost:6379` to go through `channels_redis` and
+any Redis-compatible server (requires `channels-redis`). Clients run in
+the same process as the worker, so the reported RSS includes them.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+
+import django
+from django.conf import settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+CHANNEL = "yroom"
+MESSAGE_AWARENESS = 1
+
+
+def get_channel_layer_settings(redis_url):
+    if redis_url is None:
+        return {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            # Default capacity of 100 drops broadcasts under load
+            "CONFIG": {"capacity": 100_000},
+        }
+    return {
+        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "CONFIG": {"hosts": [redis_url], "capacity": 100_000},
+    }
+
+
+def setup(args):
+    settings.configure(
+        INSTALLED_APPS=["channels", "channels_yroom"],
+        CHANNEL_LAYERS={"default": get_channel_layer_settings(args.redis)},
+        YROOM_SETTINGS={
+            "default": {
+                "CHANNEL_NAME": CHANNEL,
+                "STORAGE_BACKEND": "channels_yroom.storage.YDocMemoryStorage",
+                "REMOVE_ROOM_DELAY": 0,
+            }
+        },
+    )
+    django.setup()
+
+
+def get_rss():
+    """Current and peak resident set size in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    peak = peak if sys.platform == "darwin" else peak * 1024
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        current = None
+    return current, peak
+
+
+def awareness_message(client_id, clock, state):
+    from channels_yroom.protocol import write_var_uint
+
+    def var_bytes(data):
+        return write_var_uint(len(data)) + data
+
+    update = (
+        write_var_uint(1)
+        + write_var_uint(client_id)
+        + write_var_uint(clock)
+        + var_bytes(json.dumps(state).encode("utf-8"))
+    )
+    return write_var_uint(MESSAGE_AWARENESS) + var_bytes(update)
+
+
+class Client:
+    def __init__(self, consumer_class, room_name, index, sent_at, latencies):
+        from channels.testing import WebsocketCommunicator
+
+        self.communicator = WebsocketCommunicator(consumer_class(), "/%s/" % room_name)
+        self.room_name = room_name
+        self.index = index
+        self.sent_at = sent_at
+        self.latencies = latencies
+        self.received = 0
+        self.receiver = None
+
+    async def connect(self):
+        import y_py as Y
+
+        connected, _ = await self.communicator.connect()
+        assert connected, "Client could not connect"
+        self.doc = Y.YDoc()
+        self.text = self.doc.get_text("text")
+        self.receiver = asyncio.create_task(self.receive())
+
+    async def receive(self):
+        while True:
+            message = await self.communicator.receive_output(timeout=3600)
+            payload = message.get("bytes")
+            if payload is None:
+                continue
+            self.received += 1
+            sent = self.sent_at.get(payload)
+            if sent is not None:
+                self.latencies.append(time.perf_counter() - sent)
+
+    async def edit(self, number):
+        import y_py as Y
+
+        from channels_yroom.protocol import write_sync_update
+
+        state_vector = Y.encode_state_vector(self.doc)
+        with self.doc.begin_transaction() as txn:
+            self.text.extend(txn, "client %d edit %d\n" % (self.index, number))
+        payload = write_sync_update(Y.encode_state_as_update(self.doc, state_vector))
+        self.sent_at[payload] = time.perf_counter()
+        await self.communicator.send_to(bytes_data=payload)
+
+    async def send_awareness(self, clock):
+        state = {"user": {"name": "client %d" % self.index}, "cursor": clock}
+        await self.communicator.send_to(
+            bytes_data=awareness_message(self.doc.client_id, clock, state)
+        )
+
+    async def run(self, edits, interval, awareness_every):
+        # Spread clients over the first interval
+        await asyncio.sleep(random.uniform(0, interval))
+        sent = 0
+        for number in range(edits):
+            await self.edit(number)
+            sent += 1
+            if awareness_every and number % awareness_every == 0:
+                await self.send_awareness(number)
+                sent += 1
+            await asyncio.sleep(interval)
+        return sent
+
+    async def close(self):
+        self.receiver.cancel()
+        await asyncio.gather(self.receiver, return_exceptions=True)
+        await self.communicator.disconnect()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def main(args):
+    from channels.layers import get_channel_layer
+
+    from channels_yroom.consumer import YroomConsumer
+    from channels_yroom.worker import YroomWorker
+
+    class BenchConsumer(YroomConsumer):
+        def get_room_name(self):
+            return self.scope["path"].strip("/")
+
+    channel_layer = get_channel_layer()
+    worker = YroomWorker(
+        channel=CHANNEL,
+        channel_layer=channel_layer,
+        batch_size=args.batch_size,
+        concurrent=args.concurrent,
+    )
+    worker_task = asyncio.create_task(worker.run_worker())
+    rss_before, _ = get_rss()
+
+    sent_at = {}
+    latencies = []
+    clients = [
+        Client(BenchConsumer, "bench.%d" % room, index, sent_at, latencies)
+        for room in range(args.rooms)
+        for index in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        await client.connect()
+    print(
+        "Connected %d clients in %d rooms in %.2f s"
+        % (len(clients), args.rooms, time.perf_counter() - start)
+    )
+
+    start = time.perf_counter()
+    sent = sum(
+        await asyncio.gather(
+            *(
+                client.run(args.edits, args.interval, args.awareness_every)
+                for client in clients
+            )
+        )
+    )
+    send_duration = time.perf_counter() - start
+    # Every edit is broadcast to all clients of its room, including the sender
+    expected = len(clients) * args.edits * args.clients
+    deadline = time.perf_counter() + args.drain_timeout
+    while len(latencies) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    duration = time.perf_counter() - start
+    rss, peak_rss = get_rss()
+
+    for client in clients:
+        await client.close()
+    worker_task.cancel()
+    await asyncio.gather(worker_task, return_exceptions=True)
+
+    received = sum(client.received for client in clients)
+    print("Sent %d messages in %.2f s" % (sent, send_duration))
+    print("%-24s %10.1f" % ("messages in per second", sent / duration))
+    print("%-24s %10.1f" % ("payloads out per second", received / duration))
+    if len(latencies) < expected:
+        print(
+            "Missing %d of %d edit broadcasts" % (expected - len(latencies), expected)
+        )
+    if latencies:
+        print(
+            "%-24s p50 %7.3f ms  p99 %7.3f ms  mean %7.3f ms"
+            % (
+                "edit to broadcast",
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                statistics.mean(latencies) * 1000,
+            )
+        )
+    if rss is not None:
+        print(
+            "%-24s %10.1f MiB (%+.1f MiB)"
+            % ("RSS", rss / 2**20, (rss - rss_before) / 2**20)
+        )
+    print("%-24s %10.1f MiB" % ("peak RSS", peak_rss / 2**20))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--clients", type=int, default=4, help="clients per room")
+    parser.add_argument("--edits", type=int, default=50, help="edits per client")
+    parser.add_argument(
+        "--interval", type=float, default=0.01, help="seconds between edits"
+    )
+    parser.add_argument("--awareness-every", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--concurrent", action="store_true")
+    parser.add_argument("--redis", default=None, help="Redis URL for channels_redis")
+    parser.add_argument("--drain-timeout", type=float, default=30.0)
+    args = parser.parse_args()
+    setup(args)
+    asyncio.run(main(args))
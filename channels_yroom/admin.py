@@ -1,5 +1,6 @@
 from django.contrib import admin
 
-from .models import YDocUpdate
+from .models import YDocIncrement, YDocUpdate
 
 admin.site.register(YDocUpdate)
+admin.site.register(YDocIncrement)
@@ -1,13 +1,16 @@
 import asyncio
-import time
-from asyncio import Task
-from typing import TYPE_CHECKING, Callable, Dict
+import random
+from typing import TYPE_CHECKING, Dict, Optional
 
 from .conf import get_room_settings
+from .scheduler import Scheduler
 
 if TYPE_CHECKING:
     from .consumer import YRoomChannelConsumer
 
+AUTOSAVE = "autosave"
+AUTOSAVE_STALE = "autosave_stale"
+
 
 class Autosave:
 
@@ -15,72 +18,133 @@ class Autosave:
 
     The `nudge()` method can be used to signal editing activity and will
     schedule a save after `AUTOSAVE_DELAY` many seconds. Subsequent `nudge()`
-    calls will postpone saving. Internally one saver task per room.
+    calls will postpone saving. Due times are kept by a `Scheduler`, so no
+    task is created per room until it is actually saved. With `WRITE_BEHIND`
+    enabled, due rooms are queued on the consumer's write-behind queue
+    instead of being saved one by one.
+
+    `AUTOSAVE_MAX_STALENESS` saves a room at the latest that many seconds
+    after its first unsaved edit, even under continuous editing. With
+    `AUTOSAVE_MIN_EDITS` or `AUTOSAVE_MIN_BYTES` the delayed save is skipped
+    until enough edits piled up and only the staleness limit saves smaller
+    changes. `AUTOSAVE_JITTER` adds up to that many random seconds to every
+    due time to spread out saves.
 
     Attributes:
         consumer: Channel consumer for snapshotting room.
-        time_func: Callable returning a monotonic timestamp.
-        due_times: Next update per room.
-        saver_tasks: Saver tasks per room.
+        scheduler: Scheduler running the saves.
+        edit_counts: Number of edits since last save per room.
+        edit_bytes: Size of edits since last save per room.
     """
 
-    def __init__(self, consumer: "YRoomChannelConsumer"):
+    def __init__(
+        self,
+        consumer: "YRoomChannelConsumer",
+        scheduler: Optional[Scheduler] = None,
+    ):
         """Args:
         consumer: YroomConsumer instance used for snapshot_room() saving.
+        scheduler: Scheduler to share, e.g. with room removal.
         """
         self.consumer = consumer
-        self.time_func: Callable[[], float] = time.perf_counter
-        self.due_times: Dict[str, float] = {}
-        self.saver_tasks: Dict[str, Task] = {}
-
-    def nudge(self, room_name: str) -> None:
+        self.scheduler = Scheduler() if scheduler is None else scheduler
+        self.edit_counts: Dict[str, int] = {}
+        self.edit_bytes: Dict[str, int] = {}
+
+    @property
+    def due_times(self) -> Dict[str, float]:
+        """Next update per room."""
+        due_times: Dict[str, float] = {}
+        for key, deadline in self.scheduler.deadlines.items():
+            if key[0] in (AUTOSAVE, AUTOSAVE_STALE):
+                due_times[key[1]] = min(
+                    deadline.when, due_times.get(key[1], deadline.when)
+                )
+        return due_times
+
+    def nudge(self, room_name: str, size: int = 0) -> None:
         """Signal editing activity for a room. Schedule autosave in
         AUTOSAVE_DELAY many seconds. Postpone existing autosavings. Has no
-        effect if AUTOSAVE_DELAY is not defined for this room.
+        effect if neither AUTOSAVE_DELAY nor AUTOSAVE_MAX_STALENESS are
+        defined for this room.
+
+        Args:
+            room_name: name of edited room
+            size: size of the edit in bytes
         """
         room_settings = get_room_settings(room_name)
         delay = room_settings["AUTOSAVE_DELAY"]
-        if delay is None:
+        max_staleness = room_settings["AUTOSAVE_MAX_STALENESS"]
+        if delay is None and max_staleness is None:
             return
 
-        if delay <= 0:
+        if delay is not None and delay <= 0:
             raise ValueError("Autosave delay time has to be strictly positive")
-
-        now = self.time_func()
-        self.due_times[room_name] = now + delay
-        if room_name in self.saver_tasks:
+        if max_staleness is not None and max_staleness <= 0:
+            raise ValueError("Autosave max staleness has to be strictly positive")
+
+        self.edit_counts[room_name] = self.edit_counts.get(room_name, 0) + 1
+        self.edit_bytes[room_name] = self.edit_bytes.get(room_name, 0) + size
+
+        jitter = room_settings["AUTOSAVE_JITTER"]
+        if delay is not None:
+            if jitter:
+                delay += random.uniform(0, jitter)
+            self.scheduler.schedule(
+                (AUTOSAVE, room_name), delay, lambda: self.save_room(room_name)
+            )
+        stale_key = (AUTOSAVE_STALE, room_name)
+        if max_staleness is not None and not self.scheduler.is_scheduled(stale_key):
+            # Not postponed by further edits
+            if jitter:
+                max_staleness += random.uniform(0, jitter)
+            self.scheduler.schedule(
+                stale_key, max_staleness, lambda: self.save_room(room_name, True)
+            )
+
+    def has_enough_edits(self, room_name: str) -> bool:
+        room_settings = get_room_settings(room_name)
+        min_edits = room_settings["AUTOSAVE_MIN_EDITS"]
+        min_bytes = room_settings["AUTOSAVE_MIN_BYTES"]
+        if min_edits is None and min_bytes is None:
+            return True
+        return (
+            min_edits is not None and self.edit_counts.get(room_name, 0) >= min_edits
+        ) or (min_bytes is not None and self.edit_bytes.get(room_name, 0) >= min_bytes)
+
+    async def save_room(self, room_name: str, stale: bool = False):
+        """Snapshot room now that it is due.
+
+        Args:
+            room_name: name of due room
+            stale: whether the maximum staleness is reached, which saves
+                regardless of the minimum edits
+        """
+        if not stale and not self.has_enough_edits(room_name):
             return
-
-        task = asyncio.create_task(self.snapshot_room_soon(room_name))
-        task.add_done_callback(lambda _task: self.forget(room_name))
-        self.saver_tasks[room_name] = task
-
-    async def snapshot_room_soon(self, room_name: str):
-        """Snapshot room in due time."""
-        while True:
-            now = self.time_func()
-            when = self.due_times[room_name]
-            if now < when:
-                await asyncio.sleep(when - now)
-            else:
-                break
-
-        await self.consumer.snapshot_room(room_name)
+        self.forget(room_name)
+        if get_room_settings(room_name)["WRITE_BEHIND"]:
+            self.consumer.write_behind.enqueue(room_name)
+        else:
+            await self.consumer.snapshot_room(room_name)
 
     def forget(self, room_name: str) -> None:
         """Forget about a room."""
-        if room_name in self.saver_tasks:
-            task = self.saver_tasks.pop(room_name)
-            task.cancel()
-
-        self.due_times.pop(room_name, None)
+        self.scheduler.cancel((AUTOSAVE, room_name))
+        self.scheduler.cancel((AUTOSAVE_STALE, room_name))
+        self.edit_counts.pop(room_name, None)
+        self.edit_bytes.pop(room_name, None)
 
     async def cancel_all(self) -> None:
-        """Cancel all auto saving."""
-        tasks = self.saver_tasks.values()
-        for task in tasks:
-            task.cancel()
-
+        """Cancel all pending auto saving and wait for running saves."""
+        for key in list(self.scheduler.deadlines):
+            if key[0] in (AUTOSAVE, AUTOSAVE_STALE):
+                self.scheduler.cancel(key)
+        self.edit_counts.clear()
+        self.edit_bytes.clear()
+        tasks = [
+            task
+            for key, task in self.scheduler.running.items()
+            if key[0] in (AUTOSAVE, AUTOSAVE_STALE)
+        ]
         await asyncio.gather(*tasks, return_exceptions=True)
-        self.saver_tasks.clear()
-        self.due_times.clear()
@@ -1,25 +1,80 @@
 import asyncio
 import logging
+import secrets
+import time
 from contextlib import asynccontextmanager
-from typing import Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from channels.consumer import AsyncConsumer
 from yroom import YRoomClientOptions, YRoomManager, YRoomMessage
 
 from .autosave import Autosave
 from .conf import get_room_prefix, get_room_settings, get_settings
+from .eviction import MemoryBudget
+from .metrics import get_metrics
+from .protocol import read_sync_update, read_var_uint, write_sync_update
+from .scheduler import Scheduler
+from .sharding import get_session_group_name
+from .stats import RoomStats
 from .storage import YDocStorage, get_ydoc_storage
-from .utils import YroomChannelMessage, YroomChannelRPCMessage
+from .tracing import export_spans, new_span_id, now, worker_spans
+from .utils import (
+    YroomChannelMessage,
+    YroomChannelMessageType,
+    YroomChannelPackedMessage,
+    YroomChannelPreloadMessage,
+    YroomChannelRPCMessage,
+    YroomTraceContext,
+    deserialize_client_options,
+)
+from .writebehind import WriteBehind
 
 logger = logging.getLogger(__name__)
 
+# Connection id used to fill a room with its snapshot
+LOADER_CONN_ID = 0
+# Scheduler key kind of room removals
+REMOVE_ROOM = "remove_room"
+# Scheduler key kind of coalesced broadcasts
+BROADCAST = "broadcast"
+# Bits of random session handles for the compact envelope
+SESSION_HANDLE_BITS = 48
+# Options for connections unknown to the worker, `None` would allow writing
+UNKNOWN_CLIENT_OPTIONS = YRoomClientOptions(
+    allow_write=False, allow_write_awareness=False
+)
+
 
 class YRoomChannelConsumer(AsyncConsumer):
     def __init__(self) -> None:
         self.room_manager: YRoomManager = YRoomManager(get_settings())
-        self.cleanup_tasks = {}
+        self.room_loads: Dict[str, asyncio.Future] = {}
+        self.compaction_tasks: Dict[str, asyncio.Task] = {}
+        # Updates per room waiting to be appended to incremental storages
+        self.pending_updates: Dict[str, List[bytes]] = {}
+        self.append_tasks: Dict[str, asyncio.Task] = {}
+        # Rooms with edits since their last snapshot
+        self.dirty_rooms: Set[str] = set()
         self.storages: dict[str, YDocStorage] = {}
-        self.autosave = Autosave(consumer=self)
+        # Runs autosaves and room removals
+        self.scheduler = Scheduler()
+        self.autosave = Autosave(consumer=self, scheduler=self.scheduler)
+        self.write_behind = WriteBehind(consumer=self)
+        self.memory = MemoryBudget(consumer=self)
+        self.room_stats: Dict[str, RoomStats] = {}
+        # Options of connected clients per room and connection id, also
+        # used to reconnect the clients when an evicted room is loaded again
+        self.client_options: Dict[str, Dict[int, Optional[YRoomClientOptions]]] = {}
+        # Compact envelope sessions: room, connection id and reply channel
+        # per handle and the reverse mapping
+        self.sessions: Dict[int, Tuple[str, int, str]] = {}
+        self.session_handles: Dict[Tuple[str, int], int] = {}
+        # Broadcast payloads per room waiting for their coalescing window
+        self.broadcast_buffers: Dict[str, List[bytes]] = {}
+        self.broadcast_traces: Dict[str, YroomTraceContext] = {}
+        # BROADCAST_COALESCE_WINDOW per room prefix
+        self.coalesce_windows: Dict[str, Optional[float]] = {}
+        self.metrics = get_metrics()
 
     def get_storage(self, room_name):
         prefix = get_room_prefix(room_name)
@@ -36,70 +91,521 @@ class YRoomChannelConsumer(AsyncConsumer):
         conn_id = message["conn_id"]
         logger.debug("yroom consumer connect %s %s", room_name, conn_id)
 
-        # Cancel room cleanup task if it exists
-        if room_name in self.cleanup_tasks:
-            self.cleanup_tasks[room_name].cancel()
+        # Cancel room removal if it is scheduled
+        self.scheduler.cancel((REMOVE_ROOM, room_name))
+
+        if options is None:
+            options = self.set_client_options(message)
 
-        result = None
         if not self.room_manager.has_room(room_name):
-            result = await self.create_room_from_snapshot(room_name, conn_id)
-        if result is None:
-            logger.debug(
-                "yroom connect, room present or no snapshot %s %s", room_name, conn_id
-            )
-            result = self.room_manager.connect(room_name, conn_id, options)
+            await self.load_room(room_name)
+        result = self.room_manager.connect(room_name, conn_id, options)
+        stats = self.get_stats(room_name)
+        stats.clients.add(conn_id)
+        stats.payloads_sent(result.payloads)
+        stats.payloads_sent(result.broadcast_payloads)
+        self.memory.touch(room_name)
+        self.memory.check()
+        if get_room_settings(room_name)["COMPACT_ENVELOPE"]:
+            await self.open_session(room_name, conn_id, message["channel_name"])
         await self.respond(
             result, room_name=room_name, channel_name=message["channel_name"]
         )
 
-    async def create_room_from_snapshot(
-        self, room_name: str, conn_id: int = 0
-    ) -> Optional[YRoomMessage]:
-        logger.debug("yroom connect, no room yet %s %s", room_name, conn_id)
+    async def open_session(self, room_name: str, conn_id: int, channel_name: str):
+        """Assign a session handle to the connection and send it to the
+        websocket consumer, which then sends packed messages."""
+        handle = self.session_handles.get((room_name, conn_id))
+        if handle is None:
+            # Random handles, so stale handles of a previous worker don't match
+            handle = secrets.randbits(SESSION_HANDLE_BITS)
+            while handle in self.sessions:
+                handle = secrets.randbits(SESSION_HANDLE_BITS)
+            self.sessions[handle] = (room_name, conn_id, channel_name)
+            self.session_handles[(room_name, conn_id)] = handle
+        await self.channel_layer.send(
+            channel_name, {"type": "yroom_session", "handle": handle}
+        )
+
+    def close_session(self, room_name: str, conn_id: int) -> None:
+        handle = self.session_handles.pop((room_name, conn_id), None)
+        if handle is not None:
+            del self.sessions[handle]
+
+    def unpack_message(self, message: dict) -> dict:
+        """Returns packed messages of known sessions as full message, other
+        messages as they are."""
+        if message["type"] != YroomChannelMessageType.packed.value:
+            return message
+        data = message["data"]
+        handle, pos = read_var_uint(data, 0)
+        session = self.sessions.get(handle)
+        if session is None:
+            # Rejected by packed()
+            return message
+        room_name, conn_id, channel_name = session
+        return YroomChannelMessage(
+            type=YroomChannelMessageType.message.value,
+            room=room_name,
+            conn_id=conn_id,
+            channel_name=channel_name,
+            payload=data[pos:],
+        )
+
+    async def packed(self, message: YroomChannelPackedMessage) -> None:
+        unpacked = self.unpack_message(message)
+        if unpacked["type"] == YroomChannelMessageType.packed.value:
+            await self.reject_packed(message)
+            return
+        await self.message(unpacked)
+
+    async def reject_packed(self, message: YroomChannelPackedMessage) -> None:
+        """Drop packed message with an unknown session handle, e.g. from
+        before a worker crash, and reset the session of its websocket
+        consumer. The consumer connects again, lost edits are restored by the
+        sync of the connect."""
+        handle, _pos = read_var_uint(message["data"], 0)
+        self.metrics.increment("unknown_sessions")
+        logger.info("Dropping packed message of unknown session %s", handle)
+        await self.reset_sessions(handle)
+
+    async def reset_sessions(self, handle: Optional[int] = None) -> None:
+        """Tell websocket consumers sending to this worker to connect again
+        for a new session: the one with the stale `handle` or, without
+        `handle`, all of them, e.g. when the worker starts."""
+        # Set by the worker or channels, like for any channel consumer
+        channel = getattr(self, "scope", {}).get("channel")
+        if channel is None or self.channel_layer is None:
+            return
+        await self.channel_layer.group_send(
+            get_session_group_name(channel),
+            {"type": "yroom_session_reset", "handle": handle},
+        )
+
+    async def reject_message(self, message: YroomChannelMessage) -> None:
+        """Return message of an unknown connection to its websocket consumer,
+        which connects again with its options and sends the payload again."""
+        logger.info(
+            "Returning message of unknown connection %s in room %s",
+            message["conn_id"],
+            message["room"],
+        )
+        self.metrics.increment("unknown_connections")
+        await self.channel_layer.send(
+            message["channel_name"],
+            {"type": "yroom_reconnect", "payload": message["payload"]},
+        )
+
+    def set_client_options(
+        self, message: YroomChannelMessage
+    ) -> Optional[YRoomClientOptions]:
+        """Remember options sent with the message for the connection."""
+        options = deserialize_client_options(message.get("options"))
+        room_options = self.client_options.setdefault(message["room"], {})
+        room_options[message["conn_id"]] = options
+        return options
+
+    def get_client_options(
+        self, room_name: str, conn_id: int
+    ) -> Optional[YRoomClientOptions]:
+        room_options = self.client_options.get(room_name)
+        if room_options is None:
+            return None
+        return room_options.get(conn_id)
+
+    def is_client_known(self, room_name: str, conn_id: int) -> bool:
+        """Whether the connection connected to this worker. Options of
+        unknown connections, e.g. after a worker restart, are not known and
+        `None` would allow writing."""
+        return conn_id in self.client_options.get(room_name, {})
+
+    async def update_options(self, message: YroomChannelMessage) -> None:
+        self.set_client_options(message)
+
+    def get_stats(self, room_name: str) -> RoomStats:
+        if room_name not in self.room_stats:
+            self.room_stats[room_name] = RoomStats()
+        return self.room_stats[room_name]
+
+    def get_room_stats(self, room_name: str) -> Optional[Dict[str, Any]]:
+        """Runtime statistics of a room or `None` if the room is not loaded."""
+        if not self.room_manager.has_room(room_name):
+            return None
+        # Size as tracked for the memory budget, serializing is too costly
+        return self.get_stats(room_name).as_dict(
+            size=self.memory.room_sizes.get(room_name)
+        )
+
+    async def load_room(self, room_name: str) -> bool:
+        """Restore room from its storage snapshot.
+
+        Concurrent calls for the same room share one in-flight load, so the
+        snapshot is fetched and applied only once.
+
+        Returns:
+            bool: whether the room is present after loading
+        """
+        if self.room_manager.has_room(room_name):
+            return True
+        if room_name not in self.room_loads:
+            task = asyncio.ensure_future(self.create_room_from_snapshot(room_name))
+            task.add_done_callback(lambda _task: self.room_loads.pop(room_name, None))
+            self.room_loads[room_name] = task
+        # Shield shared load from cancellation of a single waiter
+        return await asyncio.shield(self.room_loads[room_name])
+
+    async def create_room_from_snapshot(self, room_name: str, conn_id: int = 0) -> bool:
+        """Fill room from storage via a loader connection.
+
+        Args:
+            room_name: name of the room
+            conn_id: unused, kept for compatibility; clients connect after
+                the room is loaded
+
+        Returns:
+            bool: whether the room is present
+        """
+        logger.debug("yroom connect, no room yet %s", room_name)
         storage = self.get_storage(room_name)
         logger.debug("Using yroom storage %s of %s", storage, self.storages)
+        start = time.perf_counter()
         snapshot = await storage.get_snapshot(room_name)
         logger.debug("Found snapshot %s", snapshot)
+        updates = []
+        if hasattr(storage, "get_updates"):
+            updates = await storage.get_updates(room_name)
+        self.metrics.observe("snapshot_load_seconds", time.perf_counter() - start)
+        return self.fill_room(room_name, snapshot, updates)
+
+    def fill_room(
+        self, room_name: str, snapshot: Optional[bytes], updates: List[bytes]
+    ) -> bool:
+        """Create room from snapshot and updates unless it's already present.
+
+        Returns:
+            bool: whether the room is present
+        """
+        if self.room_manager.has_room(room_name) or not (snapshot or updates):
+            return self.room_manager.has_room(room_name)
+        logger.debug("yroom connect, snapshot found %s %s", room_name, snapshot)
+        # Fill room via a loader connection that leaves immediately
         if snapshot:
-            logger.debug("yroom connect, snapshot found %s %s", room_name, snapshot)
-            return self.room_manager.connect_with_data(room_name, conn_id, snapshot)
+            self.room_manager.connect_with_data(room_name, LOADER_CONN_ID, snapshot)
+        else:
+            self.room_manager.connect(room_name, LOADER_CONN_ID, None)
+        name = (
+            room_name if get_room_settings(room_name)["PROTOCOL_NAME_PREFIX"] else None
+        )
+        for update in updates:
+            self.room_manager.handle_message(
+                room_name, LOADER_CONN_ID, write_sync_update(update, name=name), None
+            )
+        self.room_manager.disconnect(room_name, LOADER_CONN_ID, None)
+        # Clients stay connected while their room is evicted, they already
+        # have the document and don't need the sync of the reconnect
+        stats = self.get_stats(room_name)
+        for conn_id, options in self.client_options.get(room_name, {}).items():
+            self.room_manager.connect(room_name, conn_id, options)
+            stats.clients.add(conn_id)
+        if updates:
+            # Compact loaded updates into a snapshot when the room is saved
+            self.dirty_rooms.add(room_name)
+        self.memory.set_size(
+            room_name, len(snapshot or b"") + sum(len(update) for update in updates)
+        )
+        return True
+
+    async def preload(self, message: YroomChannelPreloadMessage) -> None:
+        await self.preload_rooms(message["rooms"])
+
+    async def preload_rooms(self, room_names: List[str]) -> None:
+        """Load rooms that are not present, in one batch per storage if the
+        storage supports it. Rooms without clients are removed again after
+        REMOVE_ROOM_DELAY.
+        """
+        room_names = [
+            room_name
+            for room_name in room_names
+            if not self.room_manager.has_room(room_name)
+        ]
+        for storage, storage_rooms in self.group_by_storage(room_names).items():
+            if hasattr(storage, "get_snapshots") and not hasattr(
+                storage, "get_updates"
+            ):
+                snapshots = await storage.get_snapshots(storage_rooms)
+                for room_name in storage_rooms:
+                    self.fill_room(room_name, snapshots.get(room_name), [])
+            else:
+                for room_name in storage_rooms:
+                    await self.load_room(room_name)
+        for room_name in room_names:
+            if self.room_manager.has_room(room_name) and not (
+                self.room_manager.is_room_alive(room_name)
+            ):
+                await self.schedule_room_removal(room_name)
+
+    def group_by_storage(self, room_names: List[str]) -> Dict[YDocStorage, List[str]]:
+        rooms_by_storage: Dict[YDocStorage, List[str]] = {}
+        for room_name in room_names:
+            storage = self.get_storage(room_name)
+            rooms_by_storage.setdefault(storage, []).append(room_name)
+        return rooms_by_storage
 
     async def message(
         self, message: YroomChannelMessage, options: Optional[YRoomClientOptions] = None
     ) -> None:
+        trace = message.get("trace")
+        if trace is None:
+            result = await self.handle_message(message, options)
+            if result is None:
+                return
+            await self.respond(
+                result, room_name=message["room"], channel_name=message["channel_name"]
+            )
+            return
+        handle_start = now()
+        result = await self.handle_message(message, options)
+        if result is None:
+            return
+        handle_end = now()
+        fan_out_span_id = new_span_id()
+        await self.respond(
+            result,
+            room_name=message["room"],
+            channel_name=message["channel_name"],
+            trace=self.fan_out_trace(trace, fan_out_span_id),
+        )
+        export_spans(
+            worker_spans(
+                trace, message["room"], handle_start, handle_end, fan_out_span_id, now()
+            )
+        )
+
+    @staticmethod
+    def fan_out_trace(
+        trace: YroomTraceContext, fan_out_span_id: str
+    ) -> YroomTraceContext:
+        """Trace context sent along with responses of a traced message."""
+        return {
+            "trace_id": trace["trace_id"],
+            "span_id": fan_out_span_id,
+            "sent": now(),
+        }
+
+    async def handle_message(
+        self, message: YroomChannelMessage, options: Optional[YRoomClientOptions] = None
+    ) -> Optional[YRoomMessage]:
+        """Apply message to its room.
+
+        Returns:
+            the result or `None` if the connection is unknown and the message
+            was returned to its websocket consumer
+        """
         room_name = message["room"]
         conn_id = message["conn_id"]
-        channel_name = message["channel_name"]
         logger.debug("yroom consumer message %s %s: %s", room_name, conn_id, message)
-        # If room not present (and connect is lost/expired?), try restore first
+        if options is None:
+            if not self.is_client_known(room_name, conn_id):
+                await self.reject_message(message)
+                return None
+            options = self.get_client_options(room_name, conn_id)
+        if (room_name, conn_id) not in self.session_handles and get_room_settings(
+            room_name
+        )["COMPACT_ENVELOPE"]:
+            # Connected before, e.g. to a worker that has shut down since
+            await self.open_session(room_name, conn_id, message["channel_name"])
+        # If room not present (evicted or connect lost), try restore first
         if not self.room_manager.has_room(room_name):
-            # Ignore result, connect is kind of optional
-            await self.create_room_from_snapshot(room_name, conn_id)
+            # Loading reconnects the clients known to this worker
+            if await self.load_room(room_name) and conn_id not in (
+                self.client_options.get(room_name, {})
+            ):
+                # Ignore result, connect is kind of optional
+                self.room_manager.connect(room_name, conn_id, options)
         result = self.room_manager.handle_message(
             room_name, conn_id, message["payload"], options
         )
+        stats = self.get_stats(room_name)
+        stats.clients.add(conn_id)
+        stats.message_received(message["payload"], result.has_edits)
+        stats.payloads_sent(result.payloads)
+        stats.payloads_sent(result.broadcast_payloads)
         if result.has_edits:
-            self.autosave.nudge(room_name)
+            self.dirty_rooms.add(room_name)
+            self.autosave.nudge(room_name, len(message["payload"]))
+            self.memory.touch(room_name, len(message["payload"]))
+            self.memory.check()
+            await self.store_update(room_name, message["payload"])
+        else:
+            self.memory.touch(room_name)
+        return result
+
+    async def store_update(self, room_name: str, payload: bytes) -> None:
+        """Queue the update of an edit message for incremental storages.
 
-        await self.respond(result, room_name=room_name, channel_name=channel_name)
+        Updates are appended in a background task per room, in the order of
+        their messages, so responses don't wait for the storage.
+        """
+        storage = self.get_storage(room_name)
+        if not hasattr(storage, "append_update"):
+            return
+        name_prefixed = get_room_settings(room_name)["PROTOCOL_NAME_PREFIX"]
+        update = read_sync_update(payload, name_prefixed=name_prefixed)
+        if update is None:
+            # Can't store edit as update, fall back to full snapshot
+            logger.warning("Could not read update of edit in room %s", room_name)
+            storage.mark_unsaved(room_name)
+            self.schedule_compaction(room_name)
+            return
+        self.pending_updates.setdefault(room_name, []).append(update)
+        if room_name not in self.append_tasks:
+            self.append_tasks[room_name] = asyncio.create_task(
+                self.append_updates(room_name, storage)
+            )
+
+    async def append_updates(self, room_name: str, storage) -> None:
+        try:
+            while self.pending_updates.get(room_name):
+                for update in self.pending_updates.pop(room_name):
+                    try:
+                        await storage.append_update(room_name, update)
+                    except Exception:
+                        logger.exception(
+                            "Could not append update in room %s", room_name
+                        )
+                        # Next snapshot includes the update
+                        storage.mark_unsaved(room_name)
+                        self.schedule_compaction(room_name)
+                if storage.needs_compaction(room_name):
+                    self.schedule_compaction(room_name)
+        finally:
+            # No await between the empty check and here, so updates queued
+            # from now on start a new task
+            self.append_tasks.pop(room_name, None)
+
+    async def flush_updates(self, room_name: Optional[str] = None) -> None:
+        """Wait until queued updates of a room or of all rooms are appended."""
+        if room_name is None:
+            tasks = list(self.append_tasks.values())
+        else:
+            tasks = (
+                [self.append_tasks[room_name]] if room_name in self.append_tasks else []
+            )
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def schedule_compaction(self, room_name: str) -> None:
+        """Save snapshot of room in background, replacing stored updates."""
+        if room_name in self.compaction_tasks:
+            return
+        task = asyncio.create_task(self.snapshot_room(room_name))
+        self.compaction_tasks[room_name] = task
+        task.add_done_callback(lambda _task: self.compaction_tasks.pop(room_name, None))
+
+    async def dispatch_batch(self, messages: List[dict]) -> None:
+        """Dispatch a batch of messages grouped by room.
+
+        Messages keep their order within a room. Consecutive sync/awareness
+        messages of a room are handled in one pass and their responses are
+        merged into one send per client channel and one broadcast per room.
+        """
+        rooms: Dict[Optional[str], List[dict]] = {}
+        for message in messages:
+            rooms.setdefault(message.get("room"), []).append(message)
+        for room_name, room_messages in rooms.items():
+            if room_name is None:
+                for message in room_messages:
+                    await self.dispatch(message)
+                continue
+            pending: List[YroomChannelMessage] = []
+            for message in room_messages:
+                if message["type"] == YroomChannelMessageType.message.value:
+                    pending.append(message)
+                    continue
+                await self.message_batch(room_name, pending)
+                pending = []
+                await self.dispatch(message)
+            await self.message_batch(room_name, pending)
+
+    async def message_batch(
+        self, room_name: str, messages: List[YroomChannelMessage]
+    ) -> None:
+        if not messages:
+            return
+        channel_payloads: Dict[str, List[bytes]] = {}
+        broadcast_payloads: List[bytes] = []
+        # Traced messages with their handling start and end
+        traced = []
+        for message in messages:
+            trace = message.get("trace")
+            handle_start = now() if trace is not None else 0
+            result = await self.handle_message(message)
+            if result is None:
+                continue
+            if trace is not None:
+                traced.append((trace, handle_start, now()))
+            if result.payloads:
+                channel_payloads.setdefault(message["channel_name"], []).extend(
+                    result.payloads
+                )
+            broadcast_payloads.extend(result.broadcast_payloads)
+        # Merged sends carry the trace context of the first traced message
+        fan_out_span_id = new_span_id() if traced else None
+        for channel_name, payloads in channel_payloads.items():
+            event = {"type": "forward_payload", "payloads": payloads}
+            if traced:
+                event["trace"] = self.fan_out_trace(traced[0][0], fan_out_span_id)
+            await self.channel_layer.send(channel_name, event)
+            self.count_payloads(room_name, payloads, broadcast=False)
+        if broadcast_payloads:
+            await self.broadcast(
+                room_name,
+                broadcast_payloads,
+                trace=(
+                    self.fan_out_trace(traced[0][0], fan_out_span_id)
+                    if traced
+                    else None
+                ),
+            )
+        if traced:
+            fan_out_end = now()
+            spans = []
+            for index, (trace, handle_start, handle_end) in enumerate(traced):
+                spans.extend(
+                    worker_spans(
+                        trace,
+                        room_name,
+                        handle_start,
+                        handle_end,
+                        fan_out_span_id if index == 0 else new_span_id(),
+                        fan_out_end,
+                    )
+                )
+            export_spans(spans)
 
     @asynccontextmanager
     async def try_room(self, room_name: str) -> None:
+        has_room = self.room_manager.has_room(room_name)
+        room_available = has_room or await self.load_room(room_name)
         try:
-            has_room = True
-            if not self.room_manager.has_room(room_name):
-                has_room = False
-                result = await self.create_room_from_snapshot(room_name)
-                has_snapshot = result is not None
-            yield has_room or has_snapshot
+            yield room_available
         finally:
-            if not has_room:
-                # if room was not present before, disconnect client, remove room
-                await self.disconnect_client(room_name, send_response=False)
+            if room_available and not has_room:
+                # if room was not present before, remove it again when unused
+                if not self.room_manager.is_room_alive(room_name):
+                    await self.schedule_room_removal(room_name)
 
     async def rpc(self, message: YroomChannelRPCMessage) -> None:
         room_name = message["room"]
         method = message["method"]
+        if method == "stats":
+            await self.channel_layer.send(
+                message["channel_name"],
+                {
+                    "type": "rpc_response",
+                    "result": self.get_room_stats(room_name),
+                },
+            )
+            return
         if not hasattr(self.room_manager, method):
             logger.warning("yroom consumer bad rpc method %s %s", room_name, method)
             return
@@ -140,6 +646,7 @@ class YRoomChannelConsumer(AsyncConsumer):
         result: YRoomMessage,
         room_name: str,
         channel_name: Optional[str] = None,
+        trace: Optional[YroomTraceContext] = None,
     ) -> None:
         logger.debug(
             "yroom response in room %s at channel %s (client: %s, broadcast: %s)",
@@ -149,15 +656,80 @@ class YRoomChannelConsumer(AsyncConsumer):
             result.broadcast_payloads,
         )
         if result.payloads and channel_name:
-            await self.channel_layer.send(
-                channel_name,
-                {"type": "forward_payload", "payloads": result.payloads},
-            )
+            event = {"type": "forward_payload", "payloads": result.payloads}
+            if trace is not None:
+                event["trace"] = trace
+            await self.channel_layer.send(channel_name, event)
+            self.count_payloads(room_name, result.payloads, broadcast=False)
         if result.broadcast_payloads:
-            await self.channel_layer.group_send(
-                room_name,
-                {"type": "forward_payload", "payloads": result.broadcast_payloads},
+            await self.broadcast(room_name, result.broadcast_payloads, trace=trace)
+
+    async def broadcast(
+        self,
+        room_name: str,
+        payloads: List[bytes],
+        trace: Optional[YroomTraceContext] = None,
+    ) -> None:
+        """Send payloads to all clients of the room, after buffering them for
+        `BROADCAST_COALESCE_WINDOW` seconds if set."""
+        window = self.get_coalesce_window(room_name)
+        if not window:
+            await self.send_broadcast(room_name, payloads, trace)
+            return
+        buffer = self.broadcast_buffers.get(room_name)
+        if buffer is None:
+            self.broadcast_buffers[room_name] = list(payloads)
+            # Not postponed by later broadcasts, so latency stays bounded
+            self.scheduler.schedule(
+                (BROADCAST, room_name),
+                window,
+                lambda: self.flush_broadcast(room_name),
             )
+        else:
+            buffer.extend(payloads)
+        if trace is not None:
+            self.broadcast_traces.setdefault(room_name, trace)
+
+    def get_coalesce_window(self, room_name: str) -> Optional[float]:
+        prefix = get_room_prefix(room_name)
+        if prefix not in self.coalesce_windows:
+            self.coalesce_windows[prefix] = get_room_settings(room_name)[
+                "BROADCAST_COALESCE_WINDOW"
+            ]
+        return self.coalesce_windows[prefix]
+
+    async def flush_broadcast(self, room_name: str) -> None:
+        payloads = self.broadcast_buffers.pop(room_name, None)
+        trace = self.broadcast_traces.pop(room_name, None)
+        self.scheduler.cancel((BROADCAST, room_name))
+        if payloads:
+            await self.send_broadcast(room_name, payloads, trace)
+
+    async def send_broadcast(
+        self,
+        room_name: str,
+        payloads: List[bytes],
+        trace: Optional[YroomTraceContext] = None,
+    ) -> None:
+        event = {"type": "forward_payload", "payloads": payloads}
+        if trace is not None:
+            event["trace"] = trace
+        await self.channel_layer.group_send(room_name, event)
+        self.count_payloads(room_name, payloads, broadcast=True)
+
+    def count_payloads(
+        self, room_name: str, payloads: List[bytes], broadcast: bool
+    ) -> None:
+        if not broadcast:
+            self.metrics.increment(
+                "respond_payloads", len(payloads), {"target": "client"}
+            )
+            return
+        self.metrics.increment(
+            "respond_payloads", len(payloads), {"target": "broadcast"}
+        )
+        stats = self.room_stats.get(room_name)
+        self.metrics.observe("broadcast_fanout", len(stats.clients) if stats else 0)
 
     async def disconnect(
         self, message: YroomChannelMessage, options: Optional[YRoomClientOptions] = None
@@ -173,11 +745,25 @@ class YRoomChannelConsumer(AsyncConsumer):
         send_response: bool = True,
         options: Optional[YRoomClientOptions] = None,
     ) -> None:
+        if options is None:
+            if self.is_client_known(room_name, conn_id):
+                options = self.get_client_options(room_name, conn_id)
+            else:
+                options = UNKNOWN_CLIENT_OPTIONS
+        room_options = self.client_options.get(room_name)
+        if room_options is not None:
+            room_options.pop(conn_id, None)
+            if not room_options:
+                del self.client_options[room_name]
+        self.close_session(room_name, conn_id)
         if not self.room_manager.has_room(room_name):
             # We don't know this room, disconnect invalid
             return
         logger.debug("yroom consumer disconnect %s %s", room_name, conn_id)
         result = self.room_manager.disconnect(room_name, conn_id, options)
+        stats = self.get_stats(room_name)
+        stats.clients.discard(conn_id)
+        stats.payloads_sent(result.broadcast_payloads)
         if not self.room_manager.is_room_alive(room_name):
             logger.debug("Room %s is empty", room_name)
             await self.schedule_room_removal(room_name)
@@ -185,54 +771,140 @@ class YRoomChannelConsumer(AsyncConsumer):
             await self.respond(result, room_name=room_name, channel_name=None)
 
     async def schedule_room_removal(self, room_name: str):
-        if room_name in self.cleanup_tasks:
-            self.cleanup_tasks[room_name].cancel()
-
-        task = asyncio.create_task(self.remove_room_soon(room_name))
-        self.cleanup_tasks[room_name] = task
-        task.add_done_callback(lambda _task: self.cleanup_tasks.pop(room_name, None))
-
-    async def remove_room_soon(self, room_name: str):
         # Wait a bit and then check if the room is still alive
         room_settings = get_room_settings(room_name)
-        await asyncio.sleep(room_settings["REMOVE_ROOM_DELAY"])
-        await self.remove_room(room_name)
+        self.scheduler.schedule(
+            (REMOVE_ROOM, room_name),
+            room_settings["REMOVE_ROOM_DELAY"],
+            lambda: self.remove_room(room_name),
+        )
 
     async def remove_room(self, room_name: str):
         if self.room_manager.is_room_alive(room_name):
             return
         self.autosave.forget(room_name)
+        self.write_behind.forget(room_name)
         logger.debug("Snapshot room %s", room_name)
         await self.snapshot_room(room_name)
         logger.debug("Remove empty room %s", room_name)
         if not self.room_manager.is_room_alive(room_name):
             self.force_remove_room(room_name)
+            # Options and sessions of clients that never sent a disconnect
+            self.client_options.pop(room_name, None)
+            for session_room, conn_id in list(self.session_handles):
+                if session_room == room_name:
+                    self.close_session(room_name, conn_id)
+
+    async def evict_room(self, room_name: str):
+        """Snapshot and unload room ahead of its scheduled removal.
+
+        Options and sessions of connected clients are kept, the room is
+        loaded again with the next message or connect and the clients are
+        reconnected.
+        """
+        self.scheduler.cancel((REMOVE_ROOM, room_name))
+        self.autosave.forget(room_name)
+        self.write_behind.forget(room_name)
+        await self.snapshot_room(room_name)
+        if room_name in self.dirty_rooms:
+            # Edited while saving
+            return
+        self.force_remove_room(room_name)
 
     def force_remove_room(self, room_name: str):
         self.room_manager.remove_room(room_name)
+        self.dirty_rooms.discard(room_name)
+        self.memory.forget(room_name)
+        self.room_stats.pop(room_name, None)
 
     async def snapshot_room(self, room_name: str):
+        if room_name not in self.dirty_rooms:
+            logger.debug("Room %s unchanged since last snapshot", room_name)
+            return
         ydoc_bytes = self.room_manager.serialize_room(room_name)
         logger.debug(
             "Snapshot room %s with %s bytes", room_name, len(ydoc_bytes or b"")
         )
+        # Edits from here on mark the room dirty again
+        self.dirty_rooms.discard(room_name)
         if ydoc_bytes is None:
             # Room is gone!
             return
+        self.memory.set_size(room_name, len(ydoc_bytes))
         storage = self.get_storage(room_name)
-        await storage.save_snapshot(room_name, ydoc_bytes)
+        start = time.perf_counter()
+        try:
+            await storage.save_snapshot(room_name, ydoc_bytes)
+            self.metrics.observe("snapshot_save_seconds", time.perf_counter() - start)
+        except Exception:
+            self.dirty_rooms.add(room_name)
+            raise
+        self.get_stats(room_name).saved()
+
+    async def snapshot_rooms(self, room_names: List[str]):
+        """Snapshot edited rooms with one batch save per storage if the
+        storage supports it.
+        """
+        room_names = [
+            room_name for room_name in room_names if room_name in self.dirty_rooms
+        ]
+        for storage, storage_rooms in self.group_by_storage(room_names).items():
+            if not hasattr(storage, "save_snapshots"):
+                for room_name in storage_rooms:
+                    await self.snapshot_room(room_name)
+                continue
+            snapshots = {}
+            for room_name in storage_rooms:
+                ydoc_bytes = self.room_manager.serialize_room(room_name)
+                self.dirty_rooms.discard(room_name)
+                if ydoc_bytes is not None:
+                    self.memory.set_size(room_name, len(ydoc_bytes))
+                    snapshots[room_name] = ydoc_bytes
+            logger.debug("Snapshot %d rooms in batch", len(snapshots))
+            start = time.perf_counter()
+            try:
+                await storage.save_snapshots(snapshots)
+                self.metrics.observe(
+                    "snapshot_save_seconds", time.perf_counter() - start
+                )
+            except Exception:
+                self.dirty_rooms.update(snapshots)
+                raise
+            for room_name in snapshots:
+                self.get_stats(room_name).saved()
 
     async def shutdown(self, message) -> None:
         logger.info("Shutdown event received")
         await self.autosave.cancel_all()
-        cleanup_tasks = list(self.cleanup_tasks.values())
-        for task in cleanup_tasks:
-            task.cancel()
-        await asyncio.gather(*cleanup_tasks, return_exceptions=True)
-        self.cleanup_tasks = {}
+        for room_name in list(self.broadcast_buffers):
+            await self.flush_broadcast(room_name)
+        await self.scheduler.close()
+        await self.write_behind.close()
+        await self.memory.close()
+        await self.flush_updates()
+        compaction_tasks = list(self.compaction_tasks.values())
+        await asyncio.gather(*compaction_tasks, return_exceptions=True)
         logger.debug("Cleaned up tasks")
-        for room_name in self.room_manager.list_rooms():
-            logger.debug("Saving snapshot for %s", room_name)
-            await self.snapshot_room(room_name)
+        logger.debug("Saving snapshots")
+        await self.snapshot_rooms(self.room_manager.list_rooms())
         logger.debug("Done saving snapshots")
+        self.shutdown_storages()
+        await self.close_sessions()
         await self.send({"type": "shutdown.complete"})
+
+    def shutdown_storages(self) -> None:
+        """Stop the storage thread pools, all storage calls are done."""
+        for storage in self.storages.values():
+            executor = getattr(storage, "executor", None)
+            if executor is not None:
+                executor.shutdown()
+
+    async def close_sessions(self) -> None:
+        """Tell websocket consumers to go back to full messages, so they
+        get a new session from the next worker."""
+        for _room_name, _conn_id, channel_name in self.sessions.values():
+            await self.channel_layer.send(
+                channel_name, {"type": "yroom_session", "handle": None}
+            )
+        self.sessions.clear()
+        self.session_handles.clear()
@@ -0,0 +1,70 @@
+"""Compression of stored snapshots.
+
+Compressed snapshots start with a small header: the magic bytes
+`b"\\xffYR"`, a format version byte and a codec byte. Data without that
+header is an uncompressed snapshot as stored by earlier versions.
+"""
+
+import zlib
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .conf import get_room_settings
+
+HEADER_MAGIC = b"\xffYR"
+HEADER_VERSION = 1
+HEADER_LENGTH = len(HEADER_MAGIC) + 2
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODECS = {
+    "zlib": CODEC_ZLIB,
+    "zstd": CODEC_ZSTD,
+}
+
+
+def get_zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImproperlyConfigured(
+            "zstd snapshot compression requires the zstandard package."
+        ) from e
+    return zstandard
+
+
+def compress(data: bytes, codec: str, level=None) -> bytes:
+    if codec not in CODECS:
+        raise ImproperlyConfigured("Unknown snapshot compression %r" % codec)
+    if codec == "zlib":
+        compressed = zlib.compress(data, -1 if level is None else level)
+    else:
+        zstandard = get_zstandard()
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+        compressed = compressor.compress(data)
+    return HEADER_MAGIC + bytes([HEADER_VERSION, CODECS[codec]]) + compressed
+
+
+def decompress(blob: bytes) -> bytes:
+    """Decompress snapshot, passing through snapshots without header."""
+    if not blob.startswith(HEADER_MAGIC):
+        return blob
+    version = blob[len(HEADER_MAGIC)]
+    if version != HEADER_VERSION:
+        raise ValueError("Unknown snapshot header version %d" % version)
+    codec = blob[len(HEADER_MAGIC) + 1]
+    data = memoryview(blob)[HEADER_LENGTH:]
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_ZSTD:
+        return get_zstandard().ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown snapshot compression codec %d" % codec)
+
+
+def compress_snapshot(room_name: str, data: bytes) -> bytes:
+    """Compress snapshot as configured by `COMPRESSION` for the room."""
+    room_settings = get_room_settings(room_name)
+    codec = room_settings["COMPRESSION"]
+    if codec is None:
+        return data
+    return compress(data, codec, room_settings["COMPRESSION_LEVEL"])
@@ -4,12 +4,35 @@ DEFAULT_ROOM = "default"
 PREFIX_SEPARATOR = "."
 DEFAULTS = {
     "CHANNEL_NAME": "yroom",
+    "SHARDS": None,  # None for a single worker or number of worker shards
     "REMOVE_ROOM_DELAY": 30,  # in seconds
     "STORAGE_BACKEND": "channels_yroom.storage.YDocDatabaseStorage",
+    "STORAGE_OPTIONS": {},  # keyword arguments for storage backend
     "PROTOCOL_VERSION": 1,
     "PROTOCOL_NAME_PREFIX": False,
     "SERVER_START_SYNC": True,
     "AUTOSAVE_DELAY": None,  # None for disabled or in strictly positive seconds
+    "AUTOSAVE_MAX_STALENESS": None,  # None for unbounded or in seconds
+    "AUTOSAVE_MIN_EDITS": None,  # None or number of edits before delayed save
+    "AUTOSAVE_MIN_BYTES": None,  # None or bytes of edits before delayed save
+    "AUTOSAVE_JITTER": 0,  # in seconds, random extra delay
+    "WRITE_BEHIND": False,  # batch autosaves in a write-behind queue
+    "WRITE_BEHIND_MAX_BATCH": 100,  # rooms per batch save
+    "WRITE_BEHIND_MAX_DELAY": 1.0,  # in seconds
+    "MEMORY_BUDGET": None,  # None for unlimited or bytes of rooms per worker
+    "MEMORY_EVICTION_MIN_IDLE": 60,  # in seconds without edits before eviction
+    "METRICS_BACKEND": "channels_yroom.metrics.Metrics",  # discards metrics
+    "METRICS_OPTIONS": {},  # keyword arguments for metrics backend
+    "METRICS_INTERVAL": 1.0,  # in seconds, for gauges and event loop lag
+    "BROADCAST_COALESCE_WINDOW": None,  # in seconds, e.g. 0.005
+    "COMPACT_ENVELOPE": False,  # send messages with session handles
+    "EMBEDDED": False,  # handle rooms in the web process, without worker
+    "TRACE_SAMPLE_RATE": 0.0,  # fraction of websocket messages to trace
+    "TRACE_EXPORTER": "channels_yroom.tracing.log_spans",
+    "COMPRESSION": None,  # None, "zlib" or "zstd"
+    "COMPRESSION_LEVEL": None,  # None for codec default
+    "COMPACTION_MAX_UPDATES": 500,  # for incremental storage
+    "COMPACTION_MAX_BYTES": 1024 * 1024,  # for incremental storage
 }
 
 
@@ -1,12 +1,34 @@
 import logging
 import random
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 from yroom import YRoomClientOptions
 
 from .conf import get_room_settings
-from .utils import YroomChannelMessage, YroomChannelMessageType, YroomChannelResponse
+from .protocol import write_var_uint
+from .sharding import get_room_channel_name, get_session_group_name
+from .tracing import (
+    export_spans,
+    make_span,
+    new_span_id,
+    new_trace_id,
+    now,
+    should_trace,
+)
+from .utils import (
+    YroomChannelMessage,
+    YroomChannelMessageType,
+    YroomChannelPackedMessage,
+    YroomChannelReconnectMessage,
+    YroomChannelResponse,
+    YroomChannelSessionMessage,
+    YroomChannelSessionResetMessage,
+    serialize_client_options,
+)
+
+if TYPE_CHECKING:
+    from .embedded import EmbeddedEngine
 
 logger = logging.getLogger(__name__)
 
@@ -43,29 +65,67 @@ class YroomConsumer(AsyncWebsocketConsumer):
         Get the yroom connection options for the client.
         This determines if the client is read-only or not.
 
+        Called once when the client joins the room. Call
+        `update_client_options()` when they change during the connection.
+
         Returns:
             YRoomClientOptions
         """
-        return YRoomClientOptions()
+        return YRoomClientOptions(allow_write=True, allow_write_awareness=True)
 
     async def join_room(self) -> None:
         # Join room group
         self.room_name = self.get_room_name()
         self.conn_id = self.get_connection_id()
+        # Set by the worker with `COMPACT_ENVELOPE`
+        self.session_handle: Optional[int] = None
 
         logger.debug("joining room %s as %s", self.room_name, self.conn_id)
-        await self.channel_layer.group_add(self.room_name, self.channel_name)
-        await self.accept()
         self.room_settings = get_room_settings(self.room_name)
+        self.engine: Optional["EmbeddedEngine"] = None
+        if self.room_settings["EMBEDDED"]:
+            # Imported here as it loads the models
+            from .embedded import get_engine
+
+            self.engine = get_engine()
+            if getattr(self, "channel_name", None) is None:
+                # No channel layer configured
+                self.channel_name = self.engine.new_channel()
+            self.engine.register(self.channel_name, self.room_name, self)
+        else:
+            await self.channel_layer.group_add(self.room_name, self.channel_name)
+        await self.accept()
+        self.worker_channel_name = get_room_channel_name(self.room_name)
+        if self.engine is None and self.room_settings["COMPACT_ENVELOPE"]:
+            # Receives session resets of the worker
+            await self.channel_layer.group_add(
+                get_session_group_name(self.worker_channel_name), self.channel_name
+            )
+        await self.connect_to_worker()
+
+    async def connect_to_worker(self) -> None:
         options = await self.get_client_options()
-        await self.channel_layer.send(
-            self.room_settings["CHANNEL_NAME"],
+        await self.send_to_worker(
             YroomChannelMessage(
                 type=YroomChannelMessageType.connect.value,
                 room=self.room_name,
                 conn_id=self.conn_id,
                 channel_name=self.channel_name,
-                options=options,
+                options=serialize_client_options(options),
+            ),
+        )
+
+    async def update_client_options(self) -> None:
+        """Send the current result of `get_client_options()` to the worker,
+        e.g. after the permissions of the client changed."""
+        options = await self.get_client_options()
+        await self.send_to_worker(
+            YroomChannelMessage(
+                type=YroomChannelMessageType.update_options.value,
+                room=self.room_name,
+                conn_id=self.conn_id,
+                channel_name=self.channel_name,
+                options=serialize_client_options(options),
             ),
         )
 
@@ -75,17 +135,21 @@ class YroomConsumer(AsyncWebsocketConsumer):
     async def leave_room(self) -> None:
         # Leave room group
         logger.debug("leaving room %s as %s", self.room_name, self.conn_id)
-        await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        if self.engine is not None:
+            self.engine.unregister(self.channel_name, self.room_name)
+        else:
+            await self.channel_layer.group_discard(self.room_name, self.channel_name)
+            if self.room_settings["COMPACT_ENVELOPE"]:
+                await self.channel_layer.group_discard(
+                    get_session_group_name(self.worker_channel_name), self.channel_name
+                )
         # Tell yroom worker that client disconnected
-        options = await self.get_client_options()
-        await self.channel_layer.send(
-            self.room_settings["CHANNEL_NAME"],
+        await self.send_to_worker(
             YroomChannelMessage(
                 type=YroomChannelMessageType.disconnect.value,
                 room=self.room_name,
                 conn_id=self.conn_id,
                 channel_name=self.channel_name,
-                options=options,
             ),
         )
 
@@ -97,19 +161,89 @@ class YroomConsumer(AsyncWebsocketConsumer):
             await self.handle_room_message(bytes_data)
 
     async def handle_room_message(self, bytes_data: bytes) -> None:
-        options = await self.get_client_options()
-        await self.channel_layer.send(
-            self.room_settings["CHANNEL_NAME"],
-            YroomChannelMessage(
-                type=YroomChannelMessageType.message.value,
-                room=self.room_name,
-                conn_id=self.conn_id,
-                channel_name=self.channel_name,
-                payload=bytes_data,
-                options=options,
-            ),
+        received = now() if should_trace(self.room_name) else None
+        if self.session_handle is not None and received is None:
+            await self.send_to_worker(
+                YroomChannelPackedMessage(
+                    type=YroomChannelMessageType.packed.value,
+                    data=write_var_uint(self.session_handle) + bytes_data,
+                ),
+            )
+            return
+        message = YroomChannelMessage(
+            type=YroomChannelMessageType.message.value,
+            room=self.room_name,
+            conn_id=self.conn_id,
+            channel_name=self.channel_name,
+            payload=bytes_data,
         )
+        if received is None:
+            await self.send_to_worker(message)
+            return
+        trace_id = new_trace_id()
+        span_id = new_span_id()
+        message["trace"] = {"trace_id": trace_id, "span_id": span_id, "sent": now()}
+        await self.send_to_worker(message)
+        export_spans(
+            [
+                make_span(
+                    trace_id,
+                    span_id,
+                    None,
+                    "yroom.receive",
+                    received,
+                    now(),
+                    {"yroom.room": self.room_name, "yroom.size": len(bytes_data)},
+                )
+            ]
+        )
+
+    async def send_to_worker(self, message: dict) -> None:
+        """Send message to the yroom worker of the room or, with `EMBEDDED`,
+        handle it in the engine of this process."""
+        if self.engine is not None:
+            await self.engine.dispatch(message)
+        else:
+            await self.channel_layer.send(self.worker_channel_name, message)
+
+    async def yroom_session(self, message: YroomChannelSessionMessage) -> None:
+        self.session_handle = message["handle"]
+
+    async def yroom_session_reset(
+        self, message: YroomChannelSessionResetMessage
+    ) -> None:
+        # Worker doesn't know the session, e.g. after a crash. Connect again
+        # for a new session, the sync of the connect restores lost edits.
+        if self.session_handle is None or message["handle"] not in (
+            None,
+            self.session_handle,
+        ):
+            return
+        self.session_handle = None
+        await self.connect_to_worker()
+
+    async def yroom_reconnect(self, message: YroomChannelReconnectMessage) -> None:
+        # Worker didn't know the connection, e.g. after a restart. Connect
+        # again with the client options and resend the payload.
+        self.session_handle = None
+        await self.connect_to_worker()
+        await self.handle_room_message(message["payload"])
 
     async def forward_payload(self, message: YroomChannelResponse) -> None:
         for payload in message["payloads"]:
             await self.send(bytes_data=payload)
+        trace = message.get("trace")
+        if trace is not None:
+            export_spans(
+                [
+                    make_span(
+                        trace["trace_id"],
+                        new_span_id(),
+                        trace["span_id"],
+                        "yroom.deliver",
+                        trace["sent"],
+                        now(),
+                        {"yroom.room": self.room_name},
+                    )
+                ]
+            )
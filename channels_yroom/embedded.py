@@ -0,0 +1,196 @@
+"""In-process room engine for single-node deployments.
+
+With `EMBEDDED` set for a room, `YroomConsumer` hands its messages to the
+engine of its own process instead of sending them over the channel layer
+to a `yroom` worker. The engine runs the same `YRoomChannelConsumer` and
+acts as its channel layer: responses and broadcasts are delivered directly
+to the websocket consumers of the process.
+"""
+
+import asyncio
+import itertools
+import logging
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from channels.consumer import AsyncConsumer, get_handler_name
+
+from .channel import YRoomChannelConsumer
+from .utils import (
+    YroomChannelMessageType,
+    YroomChannelPreloadMessage,
+    YroomChannelRPCMessage,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddedEngine:
+    """Runs a `YRoomChannelConsumer` inside the current event loop.
+
+    Messages are dispatched one at a time, like a `yroom` worker without
+    batching does. Responses and broadcasts of a message are delivered to
+    the websocket consumers after the next message can be dispatched, so a
+    slow client doesn't hold up other rooms and handlers may dispatch
+    messages themselves.
+
+    Attributes:
+        consumer: The room consumer handling all messages.
+        consumers: Websocket consumers per channel name.
+        groups: Channel names per room.
+    """
+
+    consumer_class = YRoomChannelConsumer
+
+    def __init__(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.consumers: Dict[str, AsyncConsumer] = {}
+        self.groups: Dict[str, Set[str]] = {}
+        # Futures of pending RPC responses per reply channel
+        self.replies: Dict[str, asyncio.Future] = {}
+        self.counter = itertools.count()
+        self.lock = asyncio.Lock()
+        # Deliveries collected while dispatching a message
+        self.outbox: Optional[List[Tuple[AsyncConsumer, Dict[str, Any]]]] = None
+        self.consumer = self.consumer_class()
+        self.consumer.channel_layer = self
+        self.consumer.base_send = self.receive_from_consumer
+
+    def new_channel(self, prefix: str = "yroom.embedded") -> str:
+        return "%s!%d" % (prefix, next(self.counter))
+
+    def register(
+        self, channel_name: str, room_name: str, consumer: AsyncConsumer
+    ) -> None:
+        self.consumers[channel_name] = consumer
+        self.groups.setdefault(room_name, set()).add(channel_name)
+
+    def unregister(self, channel_name: str, room_name: str) -> None:
+        self.consumers.pop(channel_name, None)
+        channels = self.groups.get(room_name)
+        if channels is not None:
+            channels.discard(channel_name)
+            if not channels:
+                del self.groups[room_name]
+
+    def is_active(self) -> bool:
+        """Whether clients are connected or rooms are loaded."""
+        return bool(self.consumers or self.consumer.room_manager.list_rooms())
+
+    async def dispatch(self, message: Dict[str, Any]) -> None:
+        async with self.lock:
+            self.outbox = []
+            try:
+                await self.consumer.dispatch(message)
+            finally:
+                outbox, self.outbox = self.outbox, None
+        for consumer, event in outbox:
+            await self.deliver(consumer, event)
+
+    async def send(self, channel: str, message: Dict[str, Any]) -> None:
+        consumer = self.consumers.get(channel)
+        if consumer is not None:
+            await self.enqueue(consumer, message)
+            return
+        reply = self.replies.pop(channel, None)
+        if reply is not None and not reply.done():
+            reply.set_result(message)
+
+    async def group_send(self, group: str, message: Dict[str, Any]) -> None:
+        for channel in list(self.groups.get(group, ())):
+            consumer = self.consumers.get(channel)
+            if consumer is not None:
+                await self.enqueue(consumer, message)
+
+    async def enqueue(self, consumer: AsyncConsumer, message: Dict[str, Any]) -> None:
+        if self.outbox is not None:
+            self.outbox.append((consumer, message))
+        else:
+            # Sent outside of dispatch, e.g. by a scheduled broadcast
+            await self.deliver(consumer, message)
+
+    async def deliver(self, consumer: AsyncConsumer, message: Dict[str, Any]) -> None:
+        handler = getattr(consumer, get_handler_name(message), None)
+        if handler is None:
+            logger.warning("No handler for %s on %s", message["type"], consumer)
+            return
+        try:
+            await handler(message)
+        except Exception:
+            # One broken client must not break the broadcast to others
+            logger.exception("Could not deliver %s to %s", message["type"], consumer)
+
+    async def rpc(self, room_name: str, method: str, params: List[Any]) -> Any:
+        channel_name = self.new_channel("yroom.embedded.rpc")
+        reply = self.loop.create_future()
+        self.replies[channel_name] = reply
+        await self.dispatch(
+            YroomChannelRPCMessage(
+                type=YroomChannelMessageType.rpc.value,
+                room=room_name,
+                channel_name=channel_name,
+                method=method,
+                params=params,
+            )
+        )
+        if not reply.done():
+            # Bad method, no response
+            self.replies.pop(channel_name, None)
+            return None
+        return reply.result()["result"]
+
+    async def preload(self, room_names: List[str]) -> None:
+        await self.dispatch(
+            YroomChannelPreloadMessage(
+                type=YroomChannelMessageType.preload.value, rooms=room_names
+            )
+        )
+
+    async def receive_from_consumer(self, message: Dict[str, Any]) -> None:
+        if message["type"] != "shutdown.complete":
+            logger.warning("Unexpected message from room consumer: %s", message)
+
+    async def shutdown(self) -> None:
+        """Save all rooms like a `yroom` worker does on shutdown."""
+        await self.dispatch({"type": "shutdown", "signal": None})
+
+
+current_engine: Optional[EmbeddedEngine] = None
+
+
+def get_engine() -> EmbeddedEngine:
+    """Returns the engine of the running event loop, creating it if needed.
+
+    Raises `RuntimeError` if the engine of another, still open event loop
+    has connected clients or loaded rooms: replacing it would split rooms
+    and lose their unsaved edits. Shut it down with `shutdown_engine()`
+    from its own loop first.
+    """
+    global current_engine
+    loop = asyncio.get_running_loop()
+    engine = current_engine
+    if engine is not None and engine.loop is not loop and engine.is_active():
+        if not engine.loop.is_closed():
+            raise RuntimeError(
+                "Embedded room engine is in use by another event loop, "
+                "all EMBEDDED rooms have to be served from one event loop."
+            )
+        logger.error(
+            "Event loop of embedded room engine closed without "
+            "shutdown_engine(), unsaved edits of %d rooms are lost",
+            len(engine.consumer.dirty_rooms),
+        )
+    if engine is None or engine.loop is not loop:
+        current_engine = EmbeddedEngine()
+    return current_engine
+
+
+async def shutdown_engine() -> None:
+    """Save all rooms of the engine, e.g. from an ASGI lifespan shutdown
+    handler. Rooms are otherwise only saved by `AUTOSAVE_DELAY` and when
+    their last client leaves."""
+    global current_engine
+    engine = current_engine
+    if engine is None or engine.loop is not asyncio.get_running_loop():
+        return
+    current_engine = None
+    await engine.shutdown()
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+from .conf import get_default_room_settings
+
+if TYPE_CHECKING:
+    from .channel import YRoomChannelConsumer
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBudget:
+    """Keep the rooms of a worker within `MEMORY_BUDGET` bytes.
+
+    Room sizes are tracked from their serialized size: set when a room is
+    loaded or snapshotted and grown by the size of edits in between. Once
+    the total exceeds the budget, least recently used rooms without edits
+    for `MEMORY_EVICTION_MIN_IDLE` seconds are snapshotted and unloaded,
+    rooms without connected clients first. Evicted rooms are loaded again on
+    their next message or connect, with their clients reconnected.
+    `MEMORY_BUDGET` and `MEMORY_EVICTION_MIN_IDLE` apply to the whole worker
+    and are read from the default room settings.
+
+    Attributes:
+        consumer: Channel consumer owning the rooms.
+        time_func: Callable returning a monotonic timestamp.
+        room_sizes: Estimated size per room, least recently used first.
+        last_edits: Time of last edit per room.
+        total_size: Sum of all room sizes.
+        evictions: Number of evicted rooms.
+    """
+
+    def __init__(self, consumer: "YRoomChannelConsumer"):
+        self.consumer = consumer
+        self.time_func: Callable[[], float] = time.perf_counter
+        self.room_sizes: "OrderedDict[str, int]" = OrderedDict()
+        self.last_edits: Dict[str, float] = {}
+        self.total_size = 0
+        self.evictions = 0
+        self.evict_task: Optional[asyncio.Task] = None
+
+    def set_size(self, room_name: str, size: int) -> None:
+        """Set known size of room, e.g. after loading or serializing it."""
+        self.total_size += size - self.room_sizes.get(room_name, 0)
+        self.room_sizes[room_name] = size
+
+    def touch(self, room_name: str, edit_size: int = 0) -> None:
+        """Mark room as used, growing its size by an edit of `edit_size`."""
+        if room_name not in self.room_sizes:
+            self.room_sizes[room_name] = 0
+        else:
+            self.room_sizes.move_to_end(room_name)
+        if edit_size:
+            self.room_sizes[room_name] += edit_size
+            self.total_size += edit_size
+            self.last_edits[room_name] = self.time_func()
+
+    def forget(self, room_name: str) -> None:
+        self.total_size -= self.room_sizes.pop(room_name, 0)
+        self.last_edits.pop(room_name, None)
+
+    def is_over_budget(self) -> bool:
+        budget = get_default_room_settings()["MEMORY_BUDGET"]
+        return budget is not None and self.total_size > budget
+
+    def check(self) -> None:
+        """Start evicting rooms in the background if over budget."""
+        if self.evict_task is None and self.is_over_budget():
+            self.evict_task = asyncio.create_task(self.evict())
+            self.evict_task.add_done_callback(self.evict_done)
+
+    def evict_done(self, task: asyncio.Task) -> None:
+        self.evict_task = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Room eviction failed", exc_info=task.exception())
+
+    def is_evictable(self, room_name: str, now: float) -> bool:
+        min_idle = get_default_room_settings()["MEMORY_EVICTION_MIN_IDLE"]
+        if now - self.last_edits.get(room_name, float("-inf")) < min_idle:
+            return False
+        # Don't interfere with loads and compactions in flight
+        return (
+            room_name not in self.consumer.room_loads
+            and room_name not in self.consumer.compaction_tasks
+        )
+
+    async def evict(self) -> None:
+        """Evict least recently used idle rooms until within budget."""
+        now = self.time_func()
+        # Rooms with clients lose their awareness states, evict them last
+        room_names = sorted(
+            self.room_sizes, key=self.consumer.room_manager.is_room_alive
+        )
+        for room_name in room_names:
+            if not self.is_over_budget():
+                break
+            if room_name not in self.room_sizes or not self.is_evictable(
+                room_name, now
+            ):
+                continue
+            size = self.room_sizes[room_name]
+            try:
+                await self.consumer.evict_room(room_name)
+            except Exception:
+                logger.exception("Could not save room %s for eviction", room_name)
+                continue
+            if room_name not in self.room_sizes:
+                self.evictions += 1
+                logger.info("Evicted room %s of %d bytes", room_name, size)
+        if self.is_over_budget():
+            logger.warning(
+                "Rooms use %d bytes, over memory budget with no idle rooms left",
+                self.total_size,
+            )
+
+    async def close(self) -> None:
+        if self.evict_task is not None:
+            await asyncio.gather(self.evict_task, return_exceptions=True)
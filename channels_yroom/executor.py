@@ -0,0 +1,50 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from django.db import close_old_connections
+
+
+class StorageExecutor:
+    """Runs blocking storage calls on a dedicated pool of threads.
+
+    Unlike `sync_to_async` with its default `thread_sensitive=True`, calls
+    run in parallel on up to `threads` threads. Every thread keeps its own
+    Django database connection, which persists between calls according to
+    `CONN_MAX_AGE`. Stale or broken connections are closed before each call,
+    like Django does at the start of a request. The threads are started on
+    first use, so a storage cached for the process can still be used after
+    `shutdown()`.
+    """
+
+    def __init__(self, threads: int):
+        if threads < 1:
+            raise ValueError("Number of storage threads has to be positive")
+        self.threads = threads
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.threads, thread_name_prefix="yroom-storage"
+            )
+        return self.executor
+
+    @staticmethod
+    def call(func: Callable, *args) -> Any:
+        close_old_connections()
+        return func(*args)
+
+    async def run(self, func: Callable, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self.get_executor(), functools.partial(context.run, self.call, func, *args)
+        )
+
+    def shutdown(self) -> None:
+        executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
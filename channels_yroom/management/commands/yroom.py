@@ -5,6 +5,8 @@ from channels.layers import get_channel_layer
 from django.core.management import BaseCommand, CommandError
 
 from ...conf import get_default_room_settings
+from ...sharding import get_channel_shards, get_shard_channel_name
+from ...supervisor import YroomSupervisor
 from ...worker import YroomWorker
 
 logger = logging.getLogger("django.channels.worker")
@@ -13,6 +15,7 @@ logger = logging.getLogger("django.channels.worker")
 class Command(BaseCommand):
     leave_locale_alone = True
     worker_class = YroomWorker
+    supervisor_class = YroomSupervisor
 
     def add_arguments(self, parser):
         super(Command, self).add_arguments(parser)
@@ -30,6 +33,37 @@ class Command(BaseCommand):
             default=None,
             help="Channel layer alias to use, if not the default.",
         )
+        parser.add_argument(
+            "--shard",
+            action="store",
+            dest="shard",
+            type=int,
+            default=None,
+            help="Shard number to run when rooms are sharded via SHARDS setting.",
+        )
+        parser.add_argument(
+            "--processes",
+            action="store",
+            dest="processes",
+            type=int,
+            default=None,
+            help="Number of worker processes to supervise, one per shard.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            action="store",
+            dest="batch_size",
+            type=int,
+            default=None,
+            help="Dispatch up to this many queued messages as one batch per room.",
+        )
+        parser.add_argument(
+            "--concurrent",
+            action="store_true",
+            dest="concurrent",
+            default=False,
+            help="Dispatch messages of different rooms concurrently.",
+        )
 
     def handle(self, *args, **options):
         # Get the backend to use
@@ -45,11 +79,63 @@ class Command(BaseCommand):
         if "channel" in options:
             channel = options["channel"]
         if channel is None:
-            channel = get_default_room_settings()["CHANNEL_NAME"]
+            default_settings = get_default_room_settings()
+            channel = default_settings["CHANNEL_NAME"]
+            shards = default_settings["SHARDS"]
+        else:
+            shards = None
+        worker_kwargs = {}
+        if options.get("batch_size", None) is not None:
+            if options["batch_size"] < 1:
+                raise CommandError("Batch size has to be positive.")
+            worker_kwargs["batch_size"] = options["batch_size"]
+        if options.get("concurrent", False):
+            worker_kwargs["concurrent"] = True
+        shard = options.get("shard", None)
+        processes = options.get("processes", None)
+        if processes is not None:
+            if shard is not None:
+                raise CommandError("--processes and --shard can't be combined.")
+            if options.get("channel", None) is not None:
+                raise CommandError("--processes and --channel can't be combined.")
+            if processes < 1:
+                raise CommandError("Number of processes has to be positive.")
+            # Consumers only send to shard channels with SHARDS set
+            if shards != processes:
+                raise CommandError(
+                    "Number of processes has to match SHARDS setting (%s)." % shards
+                )
+            self.stdout.write(
+                "Running %d workers for channel '%s'\n" % (processes, channel)
+            )
+            supervisor = self.supervisor_class(
+                worker_class=self.worker_class,
+                channel=channel,
+                channel_layer=self.channel_layer,
+                processes=processes,
+                worker_kwargs=worker_kwargs,
+            )
+            supervisor.run()
+            return
+        if shard is not None:
+            if shard < 0:
+                raise CommandError("Shard number must not be negative.")
+            # Consumers only send to shards below SHARDS of their rooms
+            channel_shards = get_channel_shards(channel)
+            if channel_shards is None:
+                raise CommandError(
+                    "--shard needs SHARDS set for channel '%s'." % channel
+                )
+            if shard >= channel_shards:
+                raise CommandError(
+                    "Shard number has to be below SHARDS setting (%s)." % channel_shards
+                )
+            channel = get_shard_channel_name(channel, shard)
         # Run the worker
         self.stdout.write("Running worker for channel '%s'\n" % channel)
         worker = self.worker_class(
             channel=channel,
             channel_layer=self.channel_layer,
+            **worker_kwargs,
         )
         worker.run()
@@ -0,0 +1,307 @@
+"""Metrics of the yroom worker.
+
+The worker and its consumer report metrics to the sink configured by
+`METRICS_BACKEND` and `METRICS_OPTIONS` in the default room settings:
+
+- `input_queue_depth` (gauge): messages waiting for the consumer
+- `room_queue_depth` (gauge): messages waiting in the queues of their rooms
+  with `--concurrent`
+- `rooms` (gauge): rooms loaded in the worker
+- `event_loop_lag_seconds` (gauge): delay of the worker's event loop
+- `dispatch_seconds` (histogram, tag `type`): handling time per message
+- `respond_payloads` (counter, tag `target`): payloads sent to a `client`
+  or `broadcast` to a room
+- `broadcast_fanout` (histogram): clients of a room per broadcast
+- `snapshot_load_seconds` (histogram): time to load a room from storage
+- `snapshot_save_seconds` (histogram): time to save snapshots to storage
+- `unknown_sessions` (counter): packed messages with an unknown session
+  handle, dropped with a session reset of their websocket consumer, see
+  `COMPACT_ENVELOPE`
+- `unknown_connections` (counter): messages of connections unknown to the
+  worker, e.g. after a restart, returned to their websocket consumer
+"""
+
+import asyncio
+import bisect
+import json
+import logging
+import socket
+from typing import Callable, Dict, Optional, Sequence, Tuple, Union
+
+from django.utils.module_loading import import_string
+
+from .conf import get_default_room_settings
+
+logger = logging.getLogger(__name__)
+
+Tags = Optional[Dict[str, str]]
+
+
+class Metrics:
+    """Metrics sink that discards everything.
+
+    Subclasses override `increment()`, `gauge()` and `observe()`. The
+    worker calls `start()` and `close()` inside its event loop. Workers
+    supervised with `--processes` call `set_shard()` before `start()`.
+    """
+
+    def set_shard(self, shard: int) -> None:
+        """Adapt to the worker process of `shard`, e.g. to not share a port
+        with the other workers forked from the same settings."""
+        pass
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    def increment(self, name: str, value: float = 1, tags: Tags = None) -> None:
+        pass
+
+    def gauge(self, name: str, value: float, tags: Tags = None) -> None:
+        pass
+
+    def observe(self, name: str, value: float, tags: Tags = None) -> None:
+        """Record a value of a distribution, e.g. a latency in seconds."""
+        pass
+
+
+class CallbackMetrics(Metrics):
+    """Calls `callback(kind, name, value, tags)` for every metric with kind
+    `"increment"`, `"gauge"` or `"observe"`.
+
+    Args:
+        callback: callable or its import path
+    """
+
+    def __init__(self, callback: Union[str, Callable]):
+        if isinstance(callback, str):
+            callback = import_string(callback)
+        self.callback = callback
+
+    def increment(self, name: str, value: float = 1, tags: Tags = None) -> None:
+        self.callback("increment", name, value, tags)
+
+    def gauge(self, name: str, value: float, tags: Tags = None) -> None:
+        self.callback("gauge", name, value, tags)
+
+    def observe(self, name: str, value: float, tags: Tags = None) -> None:
+        self.callback("observe", name, value, tags)
+
+
+class StatsdMetrics(Metrics):
+    """Sends metrics as StatsD UDP datagrams. Observed values are sent as
+    timings in milliseconds.
+
+    Args:
+        host: StatsD host
+        port: StatsD port
+        prefix: prefix of metric names
+        dogstatsd_tags: send tags in DogStatsD `|#key:value` format,
+            otherwise append tag values to the metric name
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 8125,
+        prefix: str = "yroom",
+        dogstatsd_tags: bool = True,
+    ):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.dogstatsd_tags = dogstatsd_tags
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def format(self, name: str, value: float, kind: str, tags: Tags) -> bytes:
+        if tags and not self.dogstatsd_tags:
+            name = ".".join([name, *tags.values()])
+        line = "%s.%s:%g|%s" % (self.prefix, name, value, kind)
+        if tags and self.dogstatsd_tags:
+            line += "|#" + ",".join("%s:%s" % item for item in tags.items())
+        return line.encode("utf-8")
+
+    def send(self, name: str, value: float, kind: str, tags: Tags) -> None:
+        try:
+            self.socket.sendto(self.format(name, value, kind, tags), self.address)
+        except OSError:
+            # Metrics must never break the worker
+            pass
+
+    def increment(self, name: str, value: float = 1, tags: Tags = None) -> None:
+        self.send(name, value, "c", tags)
+
+    def gauge(self, name: str, value: float, tags: Tags = None) -> None:
+        self.send(name, value, "g", tags)
+
+    def observe(self, name: str, value: float, tags: Tags = None) -> None:
+        self.send(name, value * 1000, "ms", tags)
+
+    async def close(self) -> None:
+        self.socket.close()
+
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class PrometheusMetrics(Metrics):
+    """Serves metrics in Prometheus text exposition format over HTTP.
+
+    Observed values become histograms with the given buckets.
+
+    Args:
+        host: address to listen on
+        port: port to listen on, the worker of shard `n` supervised with
+            `--processes` listens on `port + n`
+        prefix: prefix of metric names
+        buckets: upper bounds of histogram buckets
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 9464,
+        prefix: str = "yroom",
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self.counters: Dict[MetricKey, float] = {}
+        self.gauges: Dict[MetricKey, float] = {}
+        # Per key: bucket counts (not cumulative), sum and count
+        self.histograms: Dict[MetricKey, list] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.port_offset = 0
+
+    @staticmethod
+    def key(name: str, tags: Tags) -> MetricKey:
+        return (name, tuple(sorted(tags.items())) if tags else ())
+
+    def increment(self, name: str, value: float = 1, tags: Tags = None) -> None:
+        key = self.key(name, tags)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, tags: Tags = None) -> None:
+        self.gauges[self.key(name, tags)] = value
+
+    def observe(self, name: str, value: float, tags: Tags = None) -> None:
+        key = self.key(name, tags)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self.histograms[key] = histogram
+        # Index of first bucket with upper bound >= value
+        histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    @staticmethod
+    def format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+        if not labels:
+            return ""
+        return "{%s}" % ",".join(
+            "%s=%s" % (label, json.dumps(str(value))) for label, value in labels
+        )
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+
+        def add_type(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s %s" % (name, kind))
+
+        for (name, labels), value in sorted(self.counters.items()):
+            name = "%s_%s_total" % (self.prefix, name)
+            add_type(name, "counter")
+            lines.append("%s%s %r" % (name, self.format_labels(labels), value))
+        for (name, labels), value in sorted(self.gauges.items()):
+            name = "%s_%s" % (self.prefix, name)
+            add_type(name, "gauge")
+            lines.append("%s%s %r" % (name, self.format_labels(labels), value))
+        for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+            name = "%s_%s" % (self.prefix, name)
+            add_type(name, "histogram")
+            cumulative = 0
+            bounds = [repr(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                lines.append(
+                    "%s_bucket%s %d"
+                    % (name, self.format_labels(labels + (("le", bound),)), cumulative)
+                )
+            lines.append("%s_sum%s %r" % (name, self.format_labels(labels), total))
+            lines.append("%s_count%s %d" % (name, self.format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    async def handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = self.render().encode("utf-8")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                b"Content-Length: %d\r\n"
+                b"Connection: close\r\n\r\n" % len(body)
+            )
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    def set_shard(self, shard: int) -> None:
+        self.port_offset = shard
+
+    async def start(self) -> None:
+        # Port 0 picks a free port for every worker
+        port = self.port + self.port_offset if self.port else self.port
+        self.server = await asyncio.start_server(self.handle_request, self.host, port)
+        logger.info("Serving Prometheus metrics on %s:%s", self.host, port)
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+metrics_cache = {}
+
+
+def get_metrics() -> Metrics:
+    """Returns the metrics sink configured in the default room settings."""
+    room_settings = get_default_room_settings()
+    backend = room_settings["METRICS_BACKEND"]
+    options = room_settings["METRICS_OPTIONS"]
+    cache_key = (backend, json.dumps(options, sort_keys=True, default=str))
+    if cache_key in metrics_cache:
+        return metrics_cache[cache_key]
+    metrics = import_string(backend)(**options)
+    metrics_cache[cache_key] = metrics
+    return metrics
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("channels_yroom", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="YDocIncrement",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=255)),
+                ("clock", models.BigIntegerField()),
+                ("data", models.BinaryField()),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["name", "clock"], name="channels_yr_name_622af2_idx"
+                    )
+                ],
+            },
+        ),
+    ]
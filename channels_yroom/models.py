@@ -1,22 +1,105 @@
-from typing import Optional
+from typing import Dict, Iterable, List, Optional
 
-from django.db import models
+import django
+from asgiref.sync import sync_to_async
+from django.db import connections, models, router, transaction
+from django.utils import timezone
+
+# Async queryset methods like `aget()` were added in Django 4.1
+ASYNC_ORM_SUPPORTED = django.VERSION >= (4, 1)
+
+
+def to_bytes(data) -> bytes:
+    if not isinstance(data, bytes):
+        # Postgres on psycopg2 returns memoryview
+        return bytes(data)
+    return data
 
 
 class YDocUpdateManager(models.Manager):
     def get_snapshot(self, name) -> Optional[bytes]:
         try:
-            result = self.get(name=name).data
-            if not isinstance(result, bytes):
-                # Postgres on psycopg2 returns memoryview
-                return bytes(result)
-            return result
+            return to_bytes(self.get(name=name).data)
+        except YDocUpdate.DoesNotExist:
+            return None
+
+    async def aget_snapshot(self, name) -> Optional[bytes]:
+        if not ASYNC_ORM_SUPPORTED:
+            return await sync_to_async(self.get_snapshot)(name)
+        try:
+            return to_bytes((await self.aget(name=name)).data)
         except YDocUpdate.DoesNotExist:
             return None
 
     def save_snapshot(self, name, data):
         return self.update_or_create(name=name, defaults={"data": data})
 
+    async def asave_snapshot(self, name, data):
+        if not ASYNC_ORM_SUPPORTED:
+            return await sync_to_async(self.save_snapshot)(name, data)
+        return await self.aupdate_or_create(name=name, defaults={"data": data})
+
+    def get_snapshots(self, names: Iterable[str]) -> Dict[str, bytes]:
+        return {
+            name: bytes(data)
+            for name, data in self.filter(name__in=list(names)).values_list(
+                "name", "data"
+            )
+        }
+
+    async def aget_snapshots(self, names: Iterable[str]) -> Dict[str, bytes]:
+        if not ASYNC_ORM_SUPPORTED:
+            return await sync_to_async(self.get_snapshots)(names)
+        return {
+            name: bytes(data)
+            async for name, data in self.filter(name__in=list(names)).values_list(
+                "name", "data"
+            )
+        }
+
+    def supports_upsert(self) -> bool:
+        connection = connections[router.db_for_write(self.model)]
+        return (
+            ASYNC_ORM_SUPPORTED
+            and connection.features.supports_update_conflicts_with_target
+        )
+
+    def get_upsert_objects(self, snapshots: Dict[str, bytes]) -> List["YDocUpdate"]:
+        now = timezone.now()
+        return [
+            self.model(name=name, data=data, timestamp=now)
+            for name, data in snapshots.items()
+        ]
+
+    def save_snapshots(self, snapshots: Dict[str, bytes]) -> None:
+        """Insert or update many snapshots at once."""
+        if not snapshots:
+            return
+        if not self.supports_upsert():
+            with transaction.atomic(using=router.db_for_write(self.model)):
+                for name, data in snapshots.items():
+                    self.save_snapshot(name, data)
+            return
+        self.bulk_create(
+            self.get_upsert_objects(snapshots),
+            update_conflicts=True,
+            unique_fields=["name"],
+            update_fields=["data", "timestamp"],
+        )
+
+    async def asave_snapshots(self, snapshots: Dict[str, bytes]) -> None:
+        if not snapshots:
+            return
+        if not self.supports_upsert():
+            # Falls back to a transaction which needs to stay on one thread
+            return await sync_to_async(self.save_snapshots)(snapshots)
+        await self.abulk_create(
+            self.get_upsert_objects(snapshots),
+            update_conflicts=True,
+            unique_fields=["name"],
+            update_fields=["data", "timestamp"],
+        )
+
 
 class YDocUpdate(models.Model):
     name = models.CharField(max_length=255, primary_key=True)
@@ -27,3 +110,38 @@ class YDocUpdate(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class YDocIncrementManager(models.Manager):
+    def get_increments(self, name) -> List[bytes]:
+        return [
+            bytes(data)
+            for data in self.filter(name=name)
+            .order_by("clock")
+            .values_list("data", flat=True)
+        ]
+
+    def append(self, name, clock, data):
+        return self.create(name=name, clock=clock, data=data)
+
+    def truncate(self, name, before_clock):
+        return self.filter(name=name, clock__lt=before_clock).delete()
+
+    def truncate_many(self, names, before_clock):
+        return self.filter(name__in=list(names), clock__lt=before_clock).delete()
+
+
+class YDocIncrement(models.Model):
+    """Incremental Yjs update of a document on top of its `YDocUpdate`."""
+
+    name = models.CharField(max_length=255)
+    clock = models.BigIntegerField()
+    data = models.BinaryField()
+
+    objects = YDocIncrementManager()
+
+    class Meta:
+        indexes = [models.Index(fields=["name", "clock"])]
+
+    def __str__(self):
+        return "%s@%s" % (self.name, self.clock)
@@ -0,0 +1,94 @@
+"""Minimal reading and writing of Yjs sync protocol messages.
+
+Only what is needed to get document updates in and out of protocol messages:
+a message starts with a var uint message type (`0` for sync), followed by
+a var uint sync message type (`1` for sync step 2, `2` for update) and the
+update as var uint length-prefixed bytes.
+"""
+
+from typing import Optional, Tuple
+
+MESSAGE_SYNC = 0
+SYNC_STEP_2 = 1
+SYNC_UPDATE = 2
+
+
+def read_var_uint(data: bytes, pos: int) -> Tuple[int, int]:
+    """Read variable length unsigned integer at position.
+
+    Returns:
+        Tuple[int, int]: the integer and the position after it
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def write_var_uint(num: int) -> bytes:
+    buf = bytearray()
+    while num > 0x7F:
+        buf.append(0x80 | (num & 0x7F))
+        num >>= 7
+    buf.append(num)
+    return bytes(buf)
+
+
+def read_var_bytes(data: bytes, pos: int) -> Tuple[bytes, int]:
+    length, pos = read_var_uint(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise IndexError("Var bytes exceed data")
+    return data[pos:end], end
+
+
+def read_sync_update(payload: bytes, name_prefixed: bool = False) -> Optional[bytes]:
+    """Extract the document update of a sync step 2 or update message.
+
+    Args:
+        payload: protocol message as received from a client
+        name_prefixed: whether the message starts with a document name
+
+    Returns:
+        Optional[bytes]: the update or `None` if payload is no (valid)
+            message carrying an update
+    """
+    try:
+        pos = 0
+        if name_prefixed:
+            _name, pos = read_var_bytes(payload, pos)
+        message_type, pos = read_var_uint(payload, pos)
+        if message_type != MESSAGE_SYNC:
+            return None
+        sync_type, pos = read_var_uint(payload, pos)
+        if sync_type not in (SYNC_STEP_2, SYNC_UPDATE):
+            return None
+        update, _pos = read_var_bytes(payload, pos)
+        return update
+    except IndexError:
+        return None
+
+
+def write_sync_update(update: bytes, name: Optional[str] = None) -> bytes:
+    """Wrap a document update in a sync update message.
+
+    Args:
+        update: the document update
+        name: document name to prefix the message with, if any
+    """
+    prefix = b""
+    if name is not None:
+        encoded_name = name.encode("utf-8")
+        prefix = write_var_uint(len(encoded_name)) + encoded_name
+    return (
+        prefix
+        + write_var_uint(MESSAGE_SYNC)
+        + write_var_uint(SYNC_UPDATE)
+        + write_var_uint(len(update))
+        + update
+    )
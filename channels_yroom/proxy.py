@@ -4,8 +4,10 @@ from typing import Any, Dict, List
 from channels.layers import get_channel_layer
 
 from .conf import get_room_settings
+from .sharding import get_room_channel_name
 from .utils import (
     YroomChannelMessageType,
+    YroomChannelPreloadMessage,
     YroomChannelRPCMessage,
     YroomChannelRPCResponse,
 )
@@ -15,6 +17,46 @@ class DataUnavailable(LookupError):
     pass
 
 
+async def preload_rooms(room_names: List[str], channel_layer=None) -> None:
+    """Ask yroom workers to load the given rooms from storage ahead of time.
+    Workers load rooms in one batch per storage where possible and remove
+    them again if no client connects within `REMOVE_ROOM_DELAY`.
+
+    Args:
+        room_names (List[str]): names of rooms to load
+        channel_layer (optional): A channel layer. Defaults to default
+            channel layer.
+    """
+    embedded_rooms = [
+        room_name
+        for room_name in room_names
+        if get_room_settings(room_name)["EMBEDDED"]
+    ]
+    if embedded_rooms:
+        # Imported here as it loads the models
+        from .embedded import get_engine
+
+        await get_engine().preload(embedded_rooms)
+        if len(embedded_rooms) == len(room_names):
+            return
+    if channel_layer is None:
+        channel_layer = get_channel_layer()
+    rooms_by_channel: Dict[str, List[str]] = {}
+    for room_name in room_names:
+        if room_name in embedded_rooms:
+            continue
+        rooms_by_channel.setdefault(get_room_channel_name(room_name), []).append(
+            room_name
+        )
+    for channel_name, rooms in rooms_by_channel.items():
+        await channel_layer.send(
+            channel_name,
+            YroomChannelPreloadMessage(
+                type=YroomChannelMessageType.preload.value, rooms=rooms
+            ),
+        )
+
+
 class YroomDocument:
     """
     A proxy object for a Ydoc in the yroom process
@@ -114,6 +156,23 @@ class YroomDocument:
         """
         return await self._export_type("export_xml_text", name)
 
+    async def get_stats(self) -> Dict[str, Any]:
+        """Get runtime statistics of the room from its yroom worker.
+        Raises `DataUnavailable` if the room is not loaded in the worker.
+
+        Returns:
+            Dict[str, Any]: connected `clients`, `messages_in_per_second`,
+                `bytes_in_per_second`, `messages_out_per_second`,
+                `bytes_out_per_second`, `edits_per_second`, unix timestamps
+                of `last_edit` and `last_save` and the estimated `size` in
+                bytes: serialized size at last load or save plus the size of
+                edits since
+        """
+        result = await self._send_rpc("stats", [])
+        if result is None:
+            raise DataUnavailable(self.room_name)
+        return result
+
     async def _export_type_json(self, method: str, name: str) -> Any:
         data = await self._export_type(method, name)
         return json.loads(data)
@@ -125,10 +184,13 @@ class YroomDocument:
         return result
 
     async def _send_rpc(self, method: str, params: List[Any]) -> Any:
+        if get_room_settings(self.room_name)["EMBEDDED"]:
+            from .embedded import get_engine
+
+            return await get_engine().rpc(self.room_name, method, params)
         channel_name: str = await self.channel_layer.new_channel()
-        room_settings = get_room_settings(self.room_name)
         await self.channel_layer.send(
-            room_settings["CHANNEL_NAME"],
+            get_room_channel_name(self.room_name),
             YroomChannelRPCMessage(
                 type=YroomChannelMessageType.rpc.value,
                 room=self.room_name,
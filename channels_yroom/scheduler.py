@@ -0,0 +1,155 @@
+import asyncio
+import heapq
+import itertools
+import time
+from asyncio import Event, Task
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+Callback = Callable[[], Awaitable[Any]]
+
+
+class Deadline:
+    __slots__ = ("key", "when", "heap_when", "callback")
+
+    def __init__(self, key: Hashable, when: float, callback: Callback):
+        self.key = key
+        self.when = when
+        # Time of this deadline's entry in the heap, may be before `when`
+        self.heap_when = when
+        self.callback = callback
+
+
+class Scheduler:
+    """Runs coroutine callbacks at deadlines from a single task.
+
+    Deadlines are kept in a heap which one runner task sleeps on. Postponing
+    a deadline – as every autosave `nudge()` does – only updates it in place:
+    its heap entry fires early and is pushed again with the postponed time.
+    Moving a deadline forward pushes a new heap entry and leaves the old one
+    to be skipped. A task is only created when a callback actually runs.
+
+    Attributes:
+        time_func: Callable returning a monotonic timestamp.
+        deadlines: Pending deadline per key.
+        running: Tasks of callbacks currently running per key.
+    """
+
+    def __init__(self):
+        self.time_func: Callable[[], float] = time.perf_counter
+        self.deadlines: Dict[Hashable, Deadline] = {}
+        self.heap: List[Tuple[float, int, Deadline]] = []
+        self.running: Dict[Hashable, Task] = {}
+        self.runner: Optional[Task] = None
+        self.wakeup: Optional[Event] = None
+        self.counter = itertools.count()
+
+    def schedule(self, key: Hashable, delay: float, callback: Callback) -> None:
+        """Run `callback()` in `delay` seconds, replacing any pending
+        deadline for the same key.
+        """
+        when = self.time_func() + delay
+        deadline = self.deadlines.get(key)
+        if deadline is not None and deadline.heap_when <= when:
+            deadline.when = when
+            deadline.callback = callback
+            return
+        deadline = Deadline(key, when, callback)
+        self.deadlines[key] = deadline
+        self.push(deadline)
+
+    def push(self, deadline: Deadline) -> None:
+        deadline.heap_when = deadline.when
+        heapq.heappush(self.heap, (deadline.when, next(self.counter), deadline))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.compact()
+        if self.runner is None:
+            # Created here to bind to the running event loop
+            self.wakeup = Event()
+            self.runner = asyncio.create_task(self.run())
+        elif self.heap[0][2] is deadline:
+            self.wakeup.set()
+
+    def compact(self) -> None:
+        """Drop heap entries of cancelled or moved deadlines."""
+        self.heap = [
+            entry
+            for entry in self.heap
+            if self.deadlines.get(entry[2].key) is entry[2]
+            and entry[2].heap_when == entry[0]
+        ]
+        heapq.heapify(self.heap)
+
+    def cancel(self, key: Hashable) -> None:
+        """Cancel pending deadline. Running callbacks are not interrupted."""
+        self.deadlines.pop(key, None)
+        if not self.deadlines and self.wakeup is not None:
+            # Let the runner exit instead of sleeping on a stale entry
+            self.wakeup.set()
+
+    def is_scheduled(self, key: Hashable) -> bool:
+        return key in self.deadlines
+
+    async def run(self) -> None:
+        try:
+            while self.deadlines:
+                when, _count, deadline = self.heap[0]
+                now = self.time_func()
+                if when > now:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), when - now)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                heapq.heappop(self.heap)
+                if (
+                    self.deadlines.get(deadline.key) is not deadline
+                    or deadline.heap_when != when
+                ):
+                    # Cancelled or moved forward
+                    continue
+                if deadline.when > now:
+                    # Postponed
+                    self.push(deadline)
+                    continue
+                del self.deadlines[deadline.key]
+                self.start(deadline)
+        finally:
+            # Unregister without yielding, so push() starts a new runner
+            self.runner = None
+            if not self.deadlines:
+                self.heap.clear()
+
+    def start(self, deadline: Deadline) -> None:
+        task = asyncio.create_task(deadline.callback())
+        self.running[deadline.key] = task
+        task.add_done_callback(lambda task: self.task_done(deadline.key, task))
+
+    def task_done(self, key: Hashable, task: Task) -> None:
+        if self.running.get(key) is task:
+            del self.running[key]
+        if task.cancelled() or task.exception() is None:
+            return
+        task.get_loop().call_exception_handler(
+            {
+                "message": "Exception in scheduled callback for %r" % (key,),
+                "exception": task.exception(),
+                "task": task,
+            }
+        )
+
+    async def join(self) -> None:
+        """Wait until no deadlines are pending and no callbacks are running."""
+        while self.runner is not None or self.running:
+            if self.runner is not None:
+                await asyncio.shield(self.runner)
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+
+    async def close(self) -> None:
+        """Drop all pending deadlines and wait for running callbacks."""
+        self.deadlines.clear()
+        self.heap.clear()
+        if self.runner is not None:
+            self.runner.cancel()
+            await asyncio.gather(self.runner, return_exceptions=True)
+        await asyncio.gather(*self.running.values(), return_exceptions=True)
@@ -0,0 +1,72 @@
+import hashlib
+from typing import Optional
+
+from .conf import get_room_settings, get_settings
+
+SHARD_SEPARATOR = "."
+SESSION_GROUP_SUFFIX = "__sessions"
+
+
+def room_hash(room_name: str) -> int:
+    """Stable 64-bit hash of a room name.
+
+    Python's builtin `hash()` is randomized per process and can't be used
+    to agree on a shard between consumers and workers.
+    """
+    digest = hashlib.blake2b(room_name.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def jump_consistent_hash(key: int, num_buckets: int) -> int:
+    """Jump consistent hash (Lamping & Veach).
+
+    Maps `key` to a bucket in `range(num_buckets)` so that growing the
+    bucket count from n to n + 1 only moves 1/(n + 1) of the keys.
+    """
+    if num_buckets < 1:
+        raise ValueError("Number of buckets has to be strictly positive")
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def get_room_shard(room_name: str) -> Optional[int]:
+    """Returns the shard of a room or `None` if its prefix is not sharded."""
+    shards = get_room_settings(room_name)["SHARDS"]
+    if not shards:
+        return None
+    return jump_consistent_hash(room_hash(room_name), shards)
+
+
+def get_channel_shards(channel_name: str) -> Optional[int]:
+    """Returns the number of shards behind a worker channel, the largest
+    `SHARDS` of all room settings using that `CHANNEL_NAME`, or `None` if
+    none of them is sharded."""
+    shards = None
+    for prefix in get_settings():
+        room_settings = get_room_settings(prefix)
+        if room_settings["CHANNEL_NAME"] == channel_name and room_settings["SHARDS"]:
+            shards = max(shards or 0, room_settings["SHARDS"])
+    return shards
+
+
+def get_shard_channel_name(channel_name: str, shard: int) -> str:
+    return "%s%s%d" % (channel_name, SHARD_SEPARATOR, shard)
+
+
+def get_session_group_name(channel_name: str) -> str:
+    """Returns the group of websocket consumers with `COMPACT_ENVELOPE`
+    sending to a worker channel."""
+    return channel_name + SESSION_GROUP_SUFFIX
+
+
+def get_room_channel_name(room_name: str) -> str:
+    """Returns the worker channel name responsible for a room."""
+    channel_name = get_room_settings(room_name)["CHANNEL_NAME"]
+    shard = get_room_shard(room_name)
+    if shard is None:
+        return channel_name
+    return get_shard_channel_name(channel_name, shard)
@@ -0,0 +1,91 @@
+import math
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+# Time constant of per second rates in seconds
+RATE_WINDOW = 10.0
+
+
+class Rate:
+    """Exponentially decaying estimate of events per second.
+
+    Every event adds `amount / window` and the value decays with time
+    constant `window`, so a steady stream of `r` events per second
+    converges to `r`.
+    """
+
+    __slots__ = ("window", "value", "updated")
+
+    def __init__(self, window: float = RATE_WINDOW):
+        self.window = window
+        self.value = 0.0
+        self.updated = 0.0
+
+    def get(self, now: float) -> float:
+        return self.value * math.exp(-(now - self.updated) / self.window)
+
+    def add(self, amount: float, now: float) -> None:
+        self.value = self.get(now) + amount / self.window
+        self.updated = now
+
+
+class RoomStats:
+    """Runtime statistics of one room.
+
+    Attributes:
+        clients: Connection ids of connected clients.
+        messages_in: Rate of received messages.
+        bytes_in: Rate of received payload bytes.
+        messages_out: Rate of sent payloads.
+        bytes_out: Rate of sent payload bytes, broadcasts counted once.
+        edits: Rate of messages that edited the document.
+        last_edit: Unix timestamp of last edit.
+        last_save: Unix timestamp of last successful snapshot save.
+    """
+
+    def __init__(self, time_func: Callable[[], float] = time.perf_counter):
+        self.time_func = time_func
+        self.clients: Set[int] = set()
+        self.messages_in = Rate()
+        self.bytes_in = Rate()
+        self.messages_out = Rate()
+        self.bytes_out = Rate()
+        self.edits = Rate()
+        self.last_edit: Optional[float] = None
+        self.last_save: Optional[float] = None
+
+    def message_received(self, payload: bytes, has_edits: bool) -> None:
+        now = self.time_func()
+        self.messages_in.add(1, now)
+        self.bytes_in.add(len(payload), now)
+        if has_edits:
+            self.edits.add(1, now)
+            self.last_edit = time.time()
+
+    def payloads_sent(self, payloads: Iterable[bytes]) -> None:
+        count = 0
+        size = 0
+        for payload in payloads:
+            count += 1
+            size += len(payload)
+        if count:
+            now = self.time_func()
+            self.messages_out.add(count, now)
+            self.bytes_out.add(size, now)
+
+    def saved(self) -> None:
+        self.last_save = time.time()
+
+    def as_dict(self, size: Optional[int] = None) -> Dict[str, Any]:
+        now = self.time_func()
+        return {
+            "clients": len(self.clients),
+            "messages_in_per_second": self.messages_in.get(now),
+            "bytes_in_per_second": self.bytes_in.get(now),
+            "messages_out_per_second": self.messages_out.get(now),
+            "bytes_out_per_second": self.bytes_out.get(now),
+            "edits_per_second": self.edits.get(now),
+            "last_edit": self.last_edit,
+            "last_save": self.last_save,
+            "size": size,
+        }
@@ -1,10 +1,22 @@
-from typing import Optional, Protocol
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from pathlib import Path
+from typing import Dict, List, Optional, Protocol
 
 from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 from django.utils.module_loading import import_string
 
+from .compression import compress_snapshot, decompress
 from .conf import get_room_settings
-from .models import YDocUpdate
+from .executor import StorageExecutor
+from .models import ASYNC_ORM_SUPPORTED, YDocIncrement, YDocUpdate
 
 
 class YDocStorage(Protocol):
@@ -15,6 +27,20 @@ class YDocStorage(Protocol):
         ...
 
 
+class YDocBatchStorage(YDocStorage, Protocol):
+    """Storage that can also load and save snapshots of many rooms at once.
+
+    The batch methods are optional, callers check for their presence.
+    """
+
+    async def get_snapshots(self, names: List[str]) -> Dict[str, bytes]:
+        """Returns snapshots by room name, rooms without snapshot are missing."""
+        ...
+
+    async def save_snapshots(self, snapshots: Dict[str, bytes]) -> None:
+        ...
+
+
 class YDocDummyStorage(YDocStorage):
     async def get_snapshot(self, name: str) -> Optional[bytes]:
         return None
@@ -28,28 +54,395 @@ class YDocMemoryStorage(YDocStorage):
         self._snapshots = {}
 
     async def get_snapshot(self, name: str) -> Optional[bytes]:
-        return self._snapshots.get(name)
+        blob = self._snapshots.get(name)
+        if blob is None:
+            return None
+        return await sync_to_async(decompress, thread_sensitive=False)(blob)
 
     async def save_snapshot(self, name: str, data: bytes) -> None:
-        self._snapshots[name] = data
+        self._snapshots[name] = await sync_to_async(
+            compress_snapshot, thread_sensitive=False
+        )(name, data)
+
+    async def get_snapshots(self, names: List[str]) -> Dict[str, bytes]:
+        snapshots = {}
+        for name in names:
+            snapshot = await self.get_snapshot(name)
+            if snapshot is not None:
+                snapshots[name] = snapshot
+        return snapshots
+
+    async def save_snapshots(self, snapshots: Dict[str, bytes]) -> None:
+        for name, data in snapshots.items():
+            await self.save_snapshot(name, data)
 
 
-@sync_to_async
 def get_db_snapshot(room_name: str) -> Optional[bytes]:
-    return YDocUpdate.objects.get_snapshot(room_name)
+    blob = YDocUpdate.objects.get_snapshot(room_name)
+    if blob is None:
+        return None
+    return decompress(blob)
 
 
-@sync_to_async
 def save_db_snapshot(room_name: str, data: bytes) -> None:
-    YDocUpdate.objects.save_snapshot(room_name, data)
+    YDocUpdate.objects.save_snapshot(room_name, compress_snapshot(room_name, data))
+
+
+def decompress_blobs(blobs: Dict[str, bytes]) -> Dict[str, bytes]:
+    return {name: decompress(blob) for name, blob in blobs.items()}
+
+
+def compress_snapshots(snapshots: Dict[str, bytes]) -> Dict[str, bytes]:
+    return {name: compress_snapshot(name, data) for name, data in snapshots.items()}
+
+
+def get_db_snapshots(room_names: List[str]) -> Dict[str, bytes]:
+    return decompress_blobs(YDocUpdate.objects.get_snapshots(room_names))
+
+
+def save_db_snapshots(snapshots: Dict[str, bytes]) -> None:
+    YDocUpdate.objects.save_snapshots(compress_snapshots(snapshots))
 
 
-class YDocDatabaseStorage(YDocStorage):
+class YDocFileStorage(YDocStorage):
+    """Stores snapshots as files in a directory tree.
+
+    Each room's snapshot is stored under the SHA-256 hex digest of its name,
+    sharded into two levels of sub directories (e.g. `ab/cd/abcd...`).
+    Writes go to a temporary file that is renamed over the snapshot, so
+    readers never see partial snapshots.
+
+    Args:
+        directory: root directory of the snapshot files
+        fsync: whether to flush file and directory to disk before a write
+            returns. Disable to trade durability on power loss for speed.
+    """
+
+    def __init__(self, directory=None, fsync: bool = True):
+        if directory is None:
+            raise ImproperlyConfigured(
+                "YDocFileStorage needs a directory in STORAGE_OPTIONS."
+            )
+        self.directory = Path(directory)
+        self.fsync = fsync
+
+    def get_path(self, name: str) -> Path:
+        digest = hashlib.sha256(name.encode("utf-8")).hexdigest()
+        return self.directory / digest[:2] / digest[2:4] / digest
+
+    def read_snapshot(self, name: str) -> Optional[bytes]:
+        try:
+            # Unbuffered read into a single bytes object
+            with open(self.get_path(name), "rb", buffering=0) as f:
+                blob = f.readall()
+        except FileNotFoundError:
+            return None
+        return decompress(blob)
+
+    def write_snapshot(self, name: str, data: bytes) -> None:
+        path = self.get_path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        blob = compress_snapshot(name, data)
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with open(fd, "wb", buffering=0) as f:
+                view = memoryview(blob)
+                while view:
+                    view = view[f.write(view) :]
+                if self.fsync:
+                    os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(temp_path)
+            raise
+        if self.fsync:
+            dir_fd = os.open(path.parent, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    async def get_snapshot(self, name: str) -> Optional[bytes]:
+        return await sync_to_async(self.read_snapshot, thread_sensitive=False)(name)
+
+    async def save_snapshot(self, name: str, data: bytes) -> None:
+        await sync_to_async(self.write_snapshot, thread_sensitive=False)(name, data)
+
+
+class YDocDatabaseStorage(YDocBatchStorage):
+    """Stores snapshots in the database via the `YDocUpdate` model.
+
+    Args:
+        threads: number of threads to run database queries on in parallel.
+            By default queries run one at a time on Django's shared
+            `sync_to_async` thread.
+        async_orm: load and save snapshots with Django's async queryset
+            methods (Django 4.1+) directly from the event loop.
+    """
+
+    def __init__(self, threads: Optional[int] = None, async_orm: bool = False):
+        if async_orm and not ASYNC_ORM_SUPPORTED:
+            raise ImproperlyConfigured("async_orm requires Django 4.1 or later.")
+        if async_orm and threads is not None:
+            raise ImproperlyConfigured("async_orm and threads can't be combined.")
+        self.async_orm = async_orm
+        self.executor = None
+        if threads is not None:
+            self.executor = StorageExecutor(threads)
+
+    async def run_sync(self, func, *args):
+        if self.executor is None:
+            return await sync_to_async(func)(*args)
+        return await self.executor.run(func, *args)
+
     async def get_snapshot(self, name: str) -> Optional[bytes]:
-        return await get_db_snapshot(name)
+        if not self.async_orm:
+            return await self.run_sync(get_db_snapshot, name)
+        blob = await YDocUpdate.objects.aget_snapshot(name)
+        if blob is None:
+            return None
+        return await sync_to_async(decompress, thread_sensitive=False)(blob)
 
     async def save_snapshot(self, name: str, data: bytes) -> None:
-        await save_db_snapshot(name, data)
+        if not self.async_orm:
+            return await self.run_sync(save_db_snapshot, name, data)
+        blob = await sync_to_async(compress_snapshot, thread_sensitive=False)(
+            name, data
+        )
+        await YDocUpdate.objects.asave_snapshot(name, blob)
+
+    async def get_snapshots(self, names: List[str]) -> Dict[str, bytes]:
+        if not self.async_orm:
+            return await self.run_sync(get_db_snapshots, names)
+        blobs = await YDocUpdate.objects.aget_snapshots(names)
+        return await sync_to_async(decompress_blobs, thread_sensitive=False)(blobs)
+
+    async def save_snapshots(self, snapshots: Dict[str, bytes]) -> None:
+        if not self.async_orm:
+            return await self.run_sync(save_db_snapshots, snapshots)
+        blobs = await sync_to_async(compress_snapshots, thread_sensitive=False)(
+            snapshots
+        )
+        await YDocUpdate.objects.asave_snapshots(blobs)
+
+
+def get_db_increments(room_name: str) -> List[bytes]:
+    return YDocIncrement.objects.get_increments(room_name)
+
+
+def append_db_increment(room_name: str, clock: int, data: bytes) -> None:
+    YDocIncrement.objects.append(room_name, clock, data)
+
+
+def save_db_compacted_snapshots(snapshots: Dict[str, bytes], clock: int) -> None:
+    snapshots = {
+        name: compress_snapshot(name, data) for name, data in snapshots.items()
+    }
+    with transaction.atomic():
+        YDocUpdate.objects.save_snapshots(snapshots)
+        YDocIncrement.objects.truncate_many(snapshots.keys(), clock)
+
+
+class YDocIncrementalDatabaseStorage(YDocDatabaseStorage):
+    """Stores edits as small incremental update rows on top of a snapshot.
+
+    `append_update()` adds one row per document update. Once a room has more
+    than `COMPACTION_MAX_UPDATES` updates or `COMPACTION_MAX_BYTES` bytes
+    pending, `needs_compaction()` tells the worker to save a fresh snapshot
+    which replaces the update rows. Saving a snapshot without pending updates
+    is skipped.
+    """
+
+    def __init__(self, threads: Optional[int] = None, async_orm: bool = False):
+        super().__init__(threads=threads, async_orm=async_orm)
+        self._last_clock = 0
+        self._pending_updates: Dict[str, int] = {}
+        self._pending_bytes: Dict[str, int] = {}
+
+    def clock(self) -> int:
+        """Strictly increasing nanosecond timestamp for ordering updates."""
+        self._last_clock = max(time.time_ns(), self._last_clock + 1)
+        return self._last_clock
+
+    async def get_updates(self, name: str) -> List[bytes]:
+        updates = await self.run_sync(get_db_increments, name)
+        self._pending_updates[name] = len(updates)
+        self._pending_bytes[name] = sum(len(update) for update in updates)
+        return updates
+
+    async def append_update(self, name: str, update: bytes) -> None:
+        clock = self.clock()
+        self._pending_updates[name] = self._pending_updates.get(name, 0) + 1
+        self._pending_bytes[name] = self._pending_bytes.get(name, 0) + len(update)
+        await self.run_sync(append_db_increment, name, clock, update)
+
+    def mark_unsaved(self, name: str) -> None:
+        """Signal edits that were not appended, so next snapshot is saved."""
+        self._pending_updates.pop(name, None)
+        self._pending_bytes.pop(name, None)
+
+    def needs_compaction(self, name: str) -> bool:
+        room_settings = get_room_settings(name)
+        return (
+            self._pending_updates.get(name, 0)
+            >= room_settings["COMPACTION_MAX_UPDATES"]
+            or self._pending_bytes.get(name, 0) >= room_settings["COMPACTION_MAX_BYTES"]
+        )
+
+    async def save_snapshot(self, name: str, data: bytes) -> None:
+        await self.save_snapshots({name: data})
+
+    async def save_snapshots(self, snapshots: Dict[str, bytes]) -> None:
+        snapshots = {
+            name: data
+            for name, data in snapshots.items()
+            # Without pending updates the stored snapshot is up to date
+            if self._pending_updates.get(name, None) != 0
+        }
+        if not snapshots:
+            return
+        # Updates appended after this point are not part of the snapshots
+        clock = self.clock()
+        compacted = {
+            name: (self._pending_updates.get(name), self._pending_bytes.get(name, 0))
+            for name in snapshots
+        }
+        await self.run_sync(save_db_compacted_snapshots, snapshots, clock)
+        # Only count updates appended during the write as pending, a failed
+        # write keeps all of them so the retry is not skipped
+        for name, (updates, size) in compacted.items():
+            if name not in self._pending_updates:
+                # Unknown before or marked unsaved meanwhile, save again
+                continue
+            self._pending_updates[name] = max(
+                self._pending_updates[name] - (updates or 0), 0
+            )
+            self._pending_bytes[name] = max(self._pending_bytes.get(name, 0) - size, 0)
+
+
+class YDocCachedStorage(YDocBatchStorage):
+    """Keeps recently used snapshots of another storage backend in memory.
+
+    Reads are served from a least-recently-used cache bounded by the total
+    size of the cached snapshots, misses read through to the wrapped
+    backend. Saves write through to the wrapped backend and update the
+    cache. Other methods of the wrapped backend are passed through.
+
+    Args:
+        backend: import path of the wrapped storage backend
+        options: keyword arguments for the wrapped storage backend
+        max_bytes: upper bound of the total size of cached snapshots
+
+    Attributes:
+        hits: Number of snapshot reads served from the cache.
+        misses: Number of snapshot reads passed to the wrapped backend.
+        evictions: Number of snapshots evicted to stay within `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        backend: str = "channels_yroom.storage.YDocDatabaseStorage",
+        options: Optional[dict] = None,
+        max_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.storage: YDocStorage = import_string(backend)(**(options or {}))
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the cache itself
+        if name == "storage":
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._cache),
+            "bytes": self.size,
+        }
+
+    def _get(self, name: str) -> Optional[bytes]:
+        data = self._cache.get(name)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._cache.move_to_end(name)
+        return data
+
+    def _put(self, name: str, data: bytes) -> None:
+        self._discard(name)
+        if len(data) > self.max_bytes:
+            return
+        self._cache[name] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _name, evicted = self._cache.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def _discard(self, name: str) -> None:
+        data = self._cache.pop(name, None)
+        if data is not None:
+            self.size -= len(data)
+
+    async def get_snapshot(self, name: str) -> Optional[bytes]:
+        data = self._get(name)
+        if data is not None:
+            return data
+        data = await self.storage.get_snapshot(name)
+        if data is not None:
+            self._put(name, data)
+        return data
+
+    async def save_snapshot(self, name: str, data: bytes) -> None:
+        # Don't serve an outdated snapshot if saving fails
+        self._discard(name)
+        await self.storage.save_snapshot(name, data)
+        self._put(name, data)
+
+    async def get_snapshots(self, names: List[str]) -> Dict[str, bytes]:
+        snapshots = {}
+        missing = []
+        for name in names:
+            data = self._get(name)
+            if data is None:
+                missing.append(name)
+            else:
+                snapshots[name] = data
+        if not missing:
+            return snapshots
+        if hasattr(self.storage, "get_snapshots"):
+            loaded = await self.storage.get_snapshots(missing)
+        else:
+            loaded = {}
+            for name in missing:
+                data = await self.storage.get_snapshot(name)
+                if data is not None:
+                    loaded[name] = data
+        for name, data in loaded.items():
+            self._put(name, data)
+        snapshots.update(loaded)
+        return snapshots
+
+    async def save_snapshots(self, snapshots: Dict[str, bytes]) -> None:
+        for name in snapshots:
+            self._discard(name)
+        if hasattr(self.storage, "save_snapshots"):
+            await self.storage.save_snapshots(snapshots)
+        else:
+            for name, data in snapshots.items():
+                await self.storage.save_snapshot(name, data)
+        for name, data in snapshots.items():
+            self._put(name, data)
 
 
 storage_cache = {}
@@ -58,8 +451,10 @@ storage_cache = {}
 def get_ydoc_storage(room_name) -> YDocStorage:
     room_settings = get_room_settings(room_name)
     backend = room_settings["STORAGE_BACKEND"]
-    if backend in storage_cache:
-        return storage_cache[backend]
-    storage = import_string(backend)()
-    storage_cache[backend] = storage
+    options = room_settings["STORAGE_OPTIONS"]
+    cache_key = (backend, json.dumps(options, sort_keys=True, default=str))
+    if cache_key in storage_cache:
+        return storage_cache[cache_key]
+    storage = import_string(backend)(**options)
+    storage_cache[cache_key] = storage
     return storage
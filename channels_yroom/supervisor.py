@@ -0,0 +1,137 @@
+import logging
+import multiprocessing
+import multiprocessing.synchronize
+import os
+import signal
+import time
+from typing import Dict, Optional
+
+from django.db import connections
+
+from .sharding import get_shard_channel_name
+
+logger = logging.getLogger(__name__)
+
+
+class YroomSupervisor:
+    """Forks and supervises one `YroomWorker` process per shard.
+
+    Every child runs the worker for its shard channel. Crashed children
+    are restarted after `restart_delay` seconds, children that exited
+    cleanly are not. Children run in their own process group, so a Ctrl-C
+    in the terminal only reaches the supervisor. On shutdown signals the
+    supervisor forwards SIGTERM to all children that aren't shutting down
+    already, e.g. after a signal to the whole control group, and waits for
+    them, so every worker can flush its room snapshots.
+    """
+
+    SIGNALS = (
+        signal.SIGHUP,
+        signal.SIGTERM,
+        signal.SIGINT,
+    )
+    restart_delay = 1.0  # in seconds
+    poll_interval = 0.5  # in seconds
+
+    def __init__(
+        self,
+        worker_class,
+        channel,
+        channel_layer,
+        processes: int,
+        worker_kwargs: Optional[dict] = None,
+    ):
+        self.worker_class = worker_class
+        self.worker_kwargs = worker_kwargs or {}
+        self.channel = channel
+        self.channel_layer = channel_layer
+        self.processes = processes
+        self.context = multiprocessing.get_context("fork")
+        self.children: Dict[int, multiprocessing.Process] = {}
+        self.restart_at: Dict[int, float] = {}
+        # Set by a child when its worker starts shutting down
+        self.stopping: Dict[int, multiprocessing.synchronize.Event] = {}
+        self.shutting_down = False
+
+    def run(self):
+        self._setup_signal_handlers()
+        for shard in range(self.processes):
+            self.start_process(shard)
+        while not self.shutting_down:
+            self.check_processes()
+            time.sleep(self.poll_interval)
+        self.stop_processes()
+
+    def _setup_signal_handlers(self):
+        for sig in self.SIGNALS:
+            signal.signal(sig, self.handle_signal)
+
+    def handle_signal(self, sig, frame):
+        logger.info("Supervisor received signal %s...", signal.Signals(sig).name)
+        self.shutting_down = True
+
+    def start_process(self, shard: int) -> None:
+        # Children must not share the parent's database connections
+        connections.close_all()
+        self.stopping[shard] = self.context.Event()
+        process = self.context.Process(
+            target=self.run_worker,
+            args=(shard,),
+            name="yroom-worker-%d" % shard,
+        )
+        process.start()
+        logger.info("Started worker %s for shard %d", process.pid, shard)
+        self.children[shard] = process
+        self.restart_at.pop(shard, None)
+
+    def run_worker(self, shard: int) -> None:
+        # Only get signals forwarded by the supervisor, not those sent to
+        # the terminal's foreground process group
+        os.setpgrp()
+        # Drop the supervisor's handlers, the worker installs its own
+        for sig in self.SIGNALS:
+            signal.signal(sig, signal.SIG_DFL)
+        worker = self.worker_class(
+            channel=get_shard_channel_name(self.channel, shard),
+            channel_layer=self.channel_layer,
+            shard=shard,
+            on_shutdown=self.stopping[shard].set,
+            **self.worker_kwargs,
+        )
+        worker.run()
+
+    def check_processes(self, now: Optional[float] = None) -> None:
+        """Restart crashed children, respecting the restart delay."""
+        if now is None:
+            now = time.monotonic()
+        for shard, process in list(self.children.items()):
+            if process.is_alive():
+                continue
+            if process.exitcode == 0:
+                logger.info("Worker %s for shard %d exited", process.pid, shard)
+                del self.children[shard]
+                continue
+            if shard not in self.restart_at:
+                logger.error(
+                    "Worker %s for shard %d exited with code %s",
+                    process.pid,
+                    shard,
+                    process.exitcode,
+                )
+                self.restart_at[shard] = now + self.restart_delay
+            if now >= self.restart_at[shard]:
+                self.start_process(shard)
+
+    def stop_processes(self) -> None:
+        """Forward SIGTERM to all children and wait for their shutdown."""
+        for shard, process in self.children.items():
+            stopping = self.stopping.get(shard)
+            if stopping is not None and stopping.is_set():
+                # Signalled directly, a second SIGTERM would not help
+                continue
+            if process.is_alive():
+                process.terminate()
+        for shard, process in self.children.items():
+            process.join()
+            logger.info("Worker for shard %d stopped", shard)
+        self.children.clear()
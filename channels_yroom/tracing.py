@@ -0,0 +1,171 @@
+"""Latency tracing of websocket messages through the yroom worker.
+
+A sampled message (see `TRACE_SAMPLE_RATE`) carries a trace context from
+the websocket consumer to the worker and on into the `forward_payload`
+events. Every process exports its part of the trace as spans in the
+OpenTelemetry (OTLP/JSON) span format to `TRACE_EXPORTER`:
+
+- `yroom.receive` (websocket consumer): from receiving the websocket
+  message until it is sent to the channel layer; root span
+- `yroom.channel_layer` (worker): from sending to the worker receiving it
+- `yroom.input_queue` (worker): waiting for the consumer
+- `yroom.handle_message` (worker): applying the message to the room
+- `yroom.fan_out` (worker): sending responses and broadcasts
+- `yroom.deliver` (websocket consumers): from the worker sending a
+  payload until it is written to the websocket of a client
+
+Timestamps are wall clock nanoseconds, so spans from different hosts are
+only as comparable as their clocks.
+"""
+
+import json
+import logging
+import random
+import secrets
+import time
+from typing import Any, Dict, List, Optional
+
+from django.utils.module_loading import import_string
+
+from .conf import get_default_room_settings, get_room_settings
+from .utils import YroomTraceContext
+
+logger = logging.getLogger(__name__)
+
+Span = Dict[str, Any]
+
+
+def should_trace(room_name: str) -> bool:
+    rate = get_room_settings(room_name)["TRACE_SAMPLE_RATE"]
+    return bool(rate) and random.random() < rate
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def new_span_id() -> str:
+    return secrets.token_hex(8)
+
+
+def now() -> int:
+    return time.time_ns()
+
+
+def make_span(
+    trace_id: str,
+    span_id: str,
+    parent_span_id: Optional[str],
+    name: str,
+    start: int,
+    end: int,
+    attributes: Optional[Dict[str, Any]] = None,
+) -> Span:
+    """Returns a span in OTLP/JSON format."""
+    span = {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "name": name,
+        "kind": 1,  # SPAN_KIND_INTERNAL
+        "startTimeUnixNano": str(start),
+        "endTimeUnixNano": str(end),
+        "attributes": [
+            {"key": key, "value": attribute_value(value)}
+            for key, value in (attributes or {}).items()
+        ],
+    }
+    if parent_span_id is not None:
+        span["parentSpanId"] = parent_span_id
+    return span
+
+
+def attribute_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # OTLP/JSON encodes 64 bit integers as strings
+        return {"intValue": str(value)}
+    return {"stringValue": str(value)}
+
+
+def worker_spans(
+    trace: YroomTraceContext,
+    room_name: str,
+    handle_start: int,
+    handle_end: int,
+    fan_out_span_id: str,
+    fan_out_end: int,
+) -> List[Span]:
+    """Spans of a traced message in the worker."""
+    trace_id = trace["trace_id"]
+    parent = trace["span_id"]
+    attributes = {"yroom.room": room_name}
+    spans = []
+    received = trace.get("worker_received")
+    if received is not None:
+        spans.append(
+            make_span(
+                trace_id,
+                new_span_id(),
+                parent,
+                "yroom.channel_layer",
+                trace["sent"],
+                received,
+                attributes,
+            )
+        )
+        spans.append(
+            make_span(
+                trace_id,
+                new_span_id(),
+                parent,
+                "yroom.input_queue",
+                received,
+                handle_start,
+                attributes,
+            )
+        )
+    spans.append(
+        make_span(
+            trace_id,
+            new_span_id(),
+            parent,
+            "yroom.handle_message",
+            handle_start,
+            handle_end,
+            attributes,
+        )
+    )
+    spans.append(
+        make_span(
+            trace_id,
+            fan_out_span_id,
+            parent,
+            "yroom.fan_out",
+            handle_end,
+            fan_out_end,
+            attributes,
+        )
+    )
+    return spans
+
+
+def log_spans(spans: List[Span]) -> None:
+    """Default exporter, logs spans as JSON on the `channels_yroom.tracing`
+    logger."""
+    for span in spans:
+        logger.info(json.dumps(span))
+
+
+exporter_cache = {}
+
+
+def export_spans(spans: List[Span]) -> None:
+    path = get_default_room_settings()["TRACE_EXPORTER"]
+    if path not in exporter_cache:
+        exporter_cache[path] = import_string(path)
+    try:
+        exporter_cache[path](spans)
+    except Exception:
+        # Tracing must never break message handling
+        logger.exception("Could not export %d spans", len(spans))
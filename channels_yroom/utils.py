@@ -4,16 +4,61 @@ from typing import Any, List, Optional, TypedDict
 from yroom import YRoomClientOptions
 
 
-class YroomChannelResponse(TypedDict):
+class YroomTraceContext(TypedDict, total=False):
+    trace_id: str
+    # Span to use as parent
+    span_id: str
+    # Unix time in nanoseconds when the message was sent
+    sent: int
+    # Unix time in nanoseconds when the worker received the message
+    worker_received: int
+
+
+class _YroomChannelResponse(TypedDict):
     type: str
     payloads: List[bytes]
 
 
+class YroomChannelResponse(_YroomChannelResponse, total=False):
+    trace: YroomTraceContext
+
+
 class YroomChannelMessageType(str, Enum):
     connect = "connect"
     disconnect = "disconnect"
     message = "message"
+    update_options = "update_options"
+    packed = "packed"
     rpc = "rpc"
+    preload = "preload"
+
+
+class YroomChannelClientOptions(TypedDict):
+    allow_write: bool
+    allow_write_awareness: bool
+
+
+def serialize_client_options(
+    options: Optional[YRoomClientOptions],
+) -> Optional[YroomChannelClientOptions]:
+    """Convert client options to a dict any channel layer can serialize."""
+    if options is None:
+        return None
+    return YroomChannelClientOptions(
+        allow_write=options.allow_write,
+        allow_write_awareness=options.allow_write_awareness,
+    )
+
+
+def deserialize_client_options(
+    data: Optional[YroomChannelClientOptions],
+) -> Optional[YRoomClientOptions]:
+    if data is None:
+        return None
+    return YRoomClientOptions(
+        allow_write=data["allow_write"],
+        allow_write_awareness=data["allow_write_awareness"],
+    )
 
 
 class _YroomChannelMessage(TypedDict):  # implicitly total=True
@@ -25,7 +70,33 @@ class _YroomChannelMessage(TypedDict):  # implicitly total=True
 
 class YroomChannelMessage(_YroomChannelMessage, total=False):
     payload: bytes
-    options: Optional[YRoomClientOptions]
+    # Only sent with connect and update_options messages
+    options: Optional[YroomChannelClientOptions]
+    trace: YroomTraceContext
+
+
+class YroomChannelPackedMessage(TypedDict):
+    type: str
+    # Var uint session handle followed by the payload
+    data: bytes
+
+
+class YroomChannelSessionMessage(TypedDict):
+    type: str
+    # Session handle or None if the session was closed
+    handle: Optional[int]
+
+
+class YroomChannelSessionResetMessage(TypedDict):
+    type: str
+    # Stale session handle or None to reset all sessions
+    handle: Optional[int]
+
+
+class YroomChannelReconnectMessage(TypedDict):
+    type: str
+    # Payload of a message from a connection unknown to the worker
+    payload: bytes
 
 
 class YroomChannelRPCMessage(TypedDict):
@@ -36,6 +107,11 @@ class YroomChannelRPCMessage(TypedDict):
     params: List[Any]
 
 
+class YroomChannelPreloadMessage(TypedDict):
+    type: str
+    rooms: List[str]
+
+
 class YroomChannelRPCResponse(TypedDict):
     type: str
     result: Optional[str]
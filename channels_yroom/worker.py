@@ -1,8 +1,13 @@
 import asyncio
 import logging
 import signal
+import time
+from typing import Dict, Optional
 
 from .channel import YRoomChannelConsumer
+from .conf import get_default_room_settings
+from .metrics import get_metrics
+from .tracing import now
 
 logger = logging.getLogger(__name__)
 
@@ -15,9 +20,38 @@ class YroomWorker:
     )
     consumer_class = YRoomChannelConsumer
 
-    def __init__(self, channel, channel_layer):
+    def __init__(
+        self,
+        channel,
+        channel_layer,
+        batch_size=None,
+        concurrent=False,
+        shard=None,
+        on_shutdown=None,
+    ):
+        """Args:
+        channel: Channel name to receive messages on.
+        channel_layer: Channel layer instance.
+        batch_size: If set, drain up to this many queued messages at once and
+            dispatch them as one batch grouped by room.
+        concurrent: If set, dispatch messages of different rooms concurrently.
+            Messages of the same room keep their order.
+        shard: Shard index if this worker is one of several processes
+            supervised with `--processes`.
+        on_shutdown: Called without arguments when the shutdown starts.
+        """
+        if batch_size is not None and batch_size < 1:
+            raise ValueError("Batch size has to be strictly positive")
         self.channel = channel
         self.channel_layer = channel_layer
+        self.batch_size = batch_size
+        self.concurrent = concurrent
+        self.room_queues: Dict[Optional[str], asyncio.Queue] = {}
+        self.metrics = get_metrics()
+        if shard is not None:
+            self.metrics.set_shard(shard)
+        self.metrics_task: Optional[asyncio.Task] = None
+        self.on_shutdown = on_shutdown
         self.shutting_down = False
 
     def run(self):
@@ -51,7 +85,9 @@ class YroomWorker:
         and runs the consumer directly to have better error handling.
         """
         self.input_queue = asyncio.Queue()
+        await self.metrics.start()
         asyncio.create_task(self.run_consumer())
+        self.metrics_task = asyncio.create_task(self.report_metrics())
 
         while True:
             if self.shutting_down:
@@ -60,6 +96,8 @@ class YroomWorker:
             message = await self.channel_layer.receive(self.channel)
             if not message.get("type", None):
                 raise ValueError("Worker received message with no type.")
+            if "trace" in message:
+                message["trace"]["worker_received"] = now()
             # Add message to queue
             await self.input_queue.put(message)
 
@@ -68,16 +106,102 @@ class YroomWorker:
         Runs the consumer loop.
         """
         self.consumer = self.consumer_class()
+        self.consumer.scope = {"type": "channel", "channel": self.channel}
         self.consumer.channel_layer = self.channel_layer
         self.consumer.base_send = self.receive_from_worker
+        # Sessions of a previous worker on this channel are gone
+        await self.consumer.reset_sessions()
 
         while True:
             if self.shutting_down:
                 # Stop
                 break
-            message = await self.input_queue.get()
+            message = self.consumer.unpack_message(await self.input_queue.get())
+            if self.concurrent:
+                self.dispatch_to_room(message)
+            else:
+                await self.dispatch_from_queue(message, self.input_queue)
+
+    async def dispatch_from_queue(self, message, queue: asyncio.Queue):
+        """
+        Dispatches message to the consumer, together with further queued
+        messages if batching is enabled.
+        """
+        start = time.perf_counter()
+        if self.batch_size is None:
             # Dispatch directly to the consumer
             await self.consumer.dispatch(message)
+            message_type = message["type"]
+        else:
+            messages = [message]
+            while len(messages) < self.batch_size and not queue.empty():
+                messages.append(self.consumer.unpack_message(queue.get_nowait()))
+            await self.consumer.dispatch_batch(messages)
+            message_type = "batch"
+        self.metrics.observe(
+            "dispatch_seconds", time.perf_counter() - start, {"type": message_type}
+        )
+
+    async def report_metrics(self):
+        """
+        Periodically reports gauges and the event loop lag, measured as the
+        delay of waking up from sleep.
+        """
+        interval = get_default_room_settings()["METRICS_INTERVAL"]
+        loop = asyncio.get_running_loop()
+        while not self.shutting_down:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = loop.time() - start - interval
+            self.metrics.gauge("event_loop_lag_seconds", max(lag, 0.0))
+            self.metrics.gauge("input_queue_depth", self.input_queue.qsize())
+            # With --concurrent, messages wait in the queues of their rooms
+            self.metrics.gauge(
+                "room_queue_depth",
+                sum(queue.qsize() for queue in self.room_queues.values()),
+            )
+            consumer = getattr(self, "consumer", None)
+            if consumer is not None:
+                self.metrics.gauge("rooms", len(consumer.room_manager.list_rooms()))
+
+    def dispatch_to_room(self, message):
+        """
+        Puts message on the ordered queue of its room and starts a room
+        task to work through that queue if there is none.
+        """
+        room_name = message.get("room", None)
+        if room_name in self.room_queues:
+            self.room_queues[room_name].put_nowait(message)
+            return
+        queue = asyncio.Queue()
+        queue.put_nowait(message)
+        self.room_queues[room_name] = queue
+        task = asyncio.create_task(self.run_room(room_name, queue))
+        task.add_done_callback(self.room_task_done)
+
+    async def run_room(self, room_name: Optional[str], queue: asyncio.Queue):
+        """
+        Dispatches queued messages of one room in order until queue is empty.
+        """
+        try:
+            while not queue.empty():
+                if self.shutting_down:
+                    break
+                await self.dispatch_from_queue(queue.get_nowait(), queue)
+        finally:
+            self.room_queues.pop(room_name, None)
+
+    def room_task_done(self, task: asyncio.Task):
+        if task.cancelled() or task.exception() is None:
+            return
+        # Room tasks are not awaited, report to the loop's exception handler
+        asyncio.get_running_loop().call_exception_handler(
+            {
+                "message": "Exception in yroom room task",
+                "exception": task.exception(),
+                "task": task,
+            }
+        )
 
     def handle_exception(self, loop, context):
         msg = context.get("exception", context["message"])
@@ -101,9 +225,14 @@ class YroomWorker:
         Shuts down worker gracefully.
         """
         if self.shutting_down:
+            # Keep saving rooms, e.g. when both a supervisor and its process
+            # group got the signal
+            if signal:
+                logger.info(f"Already shutting down, ignoring {signal.name}")
             return
         self.shutting_down = True
-        self._clear_signal_handlers(loop)
+        if self.on_shutdown is not None:
+            self.on_shutdown()
         if signal:
             logger.info(f"Received signal {signal.name}...")
             shutdown_message = {"type": "shutdown", "signal": signal.name}
@@ -119,6 +248,12 @@ class YroomWorker:
         await self.complete_shutdown(loop)
 
     async def complete_shutdown(self, loop):
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+            await asyncio.gather(self.metrics_task, return_exceptions=True)
+            self.metrics_task = None
+        await self.metrics.close()
+        self._clear_signal_handlers(loop)
         tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
         [task.cancel() for task in tasks]
         logger.info(f"Cancelling {len(tasks)} outstanding tasks")
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import time
+from asyncio import Event, Task
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+from .conf import get_default_room_settings
+
+if TYPE_CHECKING:
+    from .channel import YRoomChannelConsumer
+    from .storage import YDocStorage
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    """Queue rooms due for saving and save them in batches.
+
+    Rooms are queued per storage with `enqueue()`. A flusher task per
+    storage saves queued rooms with one `snapshot_rooms()` call – and so one
+    batch save – once `WRITE_BEHIND_MAX_BATCH` rooms are queued or the
+    oldest queued room waited `WRITE_BEHIND_MAX_DELAY` seconds. Both are
+    read from the default room settings. Rooms queued again before they are
+    flushed are saved only once. Rooms of a failed flush are queued again
+    and retried after `retry_delay` seconds, doubling with every further
+    failure up to `max_retry_delay`.
+
+    Attributes:
+        consumer: Channel consumer for snapshotting rooms.
+        time_func: Callable returning a monotonic timestamp.
+        retry_delay: Seconds to wait before retrying a failed flush.
+        max_retry_delay: Upper bound of the retry delay.
+        queues: Queued rooms with their enqueue time per storage.
+        flusher_tasks: Flusher task per storage.
+        failures: Number of consecutive failed flushes per storage.
+        retry_times: Time before which a failed storage is not flushed.
+        flush_count: Number of flushed batches.
+        failed_flushes: Number of failed batches.
+        flushed_rooms: Number of rooms in flushed batches.
+        last_flush_latency: Duration of last flush in seconds.
+        max_flush_latency: Longest flush duration in seconds.
+    """
+
+    def __init__(self, consumer: "YRoomChannelConsumer"):
+        """Args:
+        consumer: YroomConsumer instance used for snapshot_rooms() saving.
+        """
+        self.consumer = consumer
+        self.time_func: Callable[[], float] = time.perf_counter
+        self.retry_delay = 1.0
+        self.max_retry_delay = 60.0
+        self.queues: Dict["YDocStorage", Dict[str, float]] = {}
+        self.flush_events: Dict["YDocStorage", Event] = {}
+        self.flusher_tasks: Dict["YDocStorage", Task] = {}
+        self.failures: Dict["YDocStorage", int] = {}
+        self.retry_times: Dict["YDocStorage", float] = {}
+        self.closing = False
+        self.flush_count = 0
+        self.failed_flushes = 0
+        self.flushed_rooms = 0
+        self.last_flush_latency: Optional[float] = None
+        self.max_flush_latency = 0.0
+
+    @property
+    def depth(self) -> int:
+        """Number of queued rooms."""
+        return sum(len(queue) for queue in self.queues.values())
+
+    def get_stats(self) -> Dict[str, Optional[float]]:
+        return {
+            "depth": self.depth,
+            "flush_count": self.flush_count,
+            "failed_flushes": self.failed_flushes,
+            "flushed_rooms": self.flushed_rooms,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+        }
+
+    def enqueue(self, room_name: str) -> None:
+        """Queue room for saving with the next batch of its storage."""
+        storage = self.consumer.get_storage(room_name)
+        queue = self.queues.setdefault(storage, {})
+        # Keep the first enqueue time, so the delay is not postponed
+        queue.setdefault(room_name, self.time_func())
+
+        self.start_flusher(storage)
+        max_batch = get_default_room_settings()["WRITE_BEHIND_MAX_BATCH"]
+        if len(queue) >= max_batch:
+            self.flush_events[storage].set()
+
+    def start_flusher(self, storage: "YDocStorage") -> None:
+        if storage not in self.flusher_tasks:
+            self.flush_events[storage] = Event()
+            self.flusher_tasks[storage] = asyncio.create_task(self.run_flusher(storage))
+
+    def forget(self, room_name: str) -> None:
+        """Remove room from its queue."""
+        queue = self.queues.get(self.consumer.get_storage(room_name))
+        if queue is not None:
+            queue.pop(room_name, None)
+
+    async def run_flusher(self, storage: "YDocStorage") -> None:
+        room_settings = get_default_room_settings()
+        max_batch = room_settings["WRITE_BEHIND_MAX_BATCH"]
+        max_delay = room_settings["WRITE_BEHIND_MAX_DELAY"]
+        event = self.flush_events[storage]
+        try:
+            while self.queues.get(storage):
+                timeout = self.get_timeout(storage, max_batch, max_delay)
+                if not self.closing and timeout > 0:
+                    try:
+                        await asyncio.wait_for(event.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    event.clear()
+                    # Check again, the wait may have ended early
+                    continue
+                event.clear()
+                await self.flush(storage, max_batch)
+        finally:
+            # Unregister without yielding, so enqueue() starts a new flusher
+            self.flusher_tasks.pop(storage, None)
+
+    def get_timeout(
+        self, storage: "YDocStorage", max_batch: int, max_delay: float
+    ) -> float:
+        """Seconds until the queued rooms of a storage are due for saving."""
+        queue = self.queues[storage]
+        now = self.time_func()
+        if len(queue) >= max_batch:
+            timeout = 0.0
+        else:
+            oldest = next(iter(queue.values()))
+            timeout = oldest + max_delay - now
+        retry_time = self.retry_times.get(storage)
+        if retry_time is not None:
+            # Full batches wait for the retry as well
+            timeout = max(timeout, retry_time - now)
+        return timeout
+
+    async def flush(
+        self, storage: "YDocStorage", max_batch: Optional[int] = None
+    ) -> None:
+        """Save up to `max_batch` queued rooms of a storage, oldest first."""
+        queue = self.queues.get(storage, {})
+        batch = {room_name: queue[room_name] for room_name in list(queue)[:max_batch]}
+        for room_name in batch:
+            del queue[room_name]
+        if not batch:
+            return
+        room_names = list(batch)
+        start = self.time_func()
+        try:
+            await self.consumer.snapshot_rooms(room_names)
+        except Exception:
+            self.failed_flushes += 1
+            if self.closing:
+                # Rooms stay dirty and are saved by the final snapshots
+                logger.exception(
+                    "Write-behind save of %d rooms failed", len(room_names)
+                )
+            else:
+                delay = self.requeue(storage, batch)
+                logger.exception(
+                    "Write-behind save of %d rooms failed, retrying in %.1fs",
+                    len(room_names),
+                    delay,
+                )
+        else:
+            self.failures.pop(storage, None)
+            self.retry_times.pop(storage, None)
+        finally:
+            latency = self.time_func() - start
+            self.flush_count += 1
+            self.flushed_rooms += len(room_names)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+        logger.debug(
+            "Write-behind saved %d rooms in %.3fs, %d queued",
+            len(room_names),
+            latency,
+            self.depth,
+        )
+
+    def requeue(self, storage: "YDocStorage", batch: Dict[str, float]) -> float:
+        """Queue rooms of a failed flush again in front of rooms queued
+        since, and back off the next flush of the storage.
+
+        Returns:
+            float: seconds until the next flush
+        """
+        failures = self.failures.get(storage, 0) + 1
+        self.failures[storage] = failures
+        delay = min(self.retry_delay * 2 ** (failures - 1), self.max_retry_delay)
+        self.retry_times[storage] = self.time_func() + delay
+        queue = dict(batch)
+        for room_name, enqueued in self.queues.get(storage, {}).items():
+            queue.setdefault(room_name, enqueued)
+        self.queues[storage] = queue
+        self.start_flusher(storage)
+        return delay
+
+    async def close(self) -> None:
+        """Flush all queued rooms and wait for the flusher tasks."""
+        self.closing = True
+        for event in self.flush_events.values():
+            event.set()
+        await asyncio.gather(*self.flusher_tasks.values(), return_exceptions=True)
+        self.flush_events.clear()
+        self.closing = False
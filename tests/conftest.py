@@ -32,6 +32,8 @@ class YData:
     # Sync step two + empty awareness update
     SYNC_STEP_2 = b"\x00\x01\x02\x00\x00\x01\x01\x00"
     AWARENESS_UPDATE = b"\x01\x01\x00"
+    # Update message appending "world" to text of doc data
+    DOC_UPDATE = b"\x00\x02\x12\x01\x01*\x00\x84\xe9\xdb\x9a\x90\x01\x05\x05world\x00"
     # state as update of a doc {"test": "hello"}
 
 
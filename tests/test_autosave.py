@@ -22,7 +22,7 @@ def test_autosave_is_turned_off_by_default_and_nuding_has_no_effect():
     autosave.nudge("not_present")
 
     assert not autosave.due_times
-    assert not autosave.saver_tasks
+    assert autosave.scheduler.runner is None
 
 
 @pytest.mark.django_db
@@ -50,7 +50,7 @@ async def test_nuding_multiple_times_postpones_saving(settings):
     autosave.nudge("some_room")
     await asyncio.sleep(0.1)
 
-    await asyncio.gather(*autosave.saver_tasks.values())
+    await autosave.scheduler.join()
 
     assert consumer.savedRooms == ["some_room"]
 
@@ -69,7 +69,7 @@ async def test_faster_autosaving_overtakes_slower_one(settings):
     autosave.nudge("fast")
     await asyncio.sleep(0.1)
 
-    await asyncio.gather(*autosave.saver_tasks.values())
+    await autosave.scheduler.join()
 
     assert consumer.savedRooms == ["fast", "slow"]
 
@@ -89,7 +89,7 @@ async def test_forgetting_about_room_aborts_saving_and_is_graceful(settings):
     autosave.forget("some_room")  # Graceful?
     await asyncio.sleep(0.1)
 
-    await asyncio.gather(*autosave.saver_tasks.values())
+    await autosave.scheduler.join()
 
     assert consumer.savedRooms == []
 
@@ -105,12 +105,94 @@ async def test_canceling_everything(settings):
 
     autosave.nudge("some_room")
     autosave.nudge("another_room")
-    tasks = list(autosave.saver_tasks.values())
+    assert sorted(autosave.due_times) == ["another_room", "some_room"]
 
     await autosave.cancel_all()
 
-    for task in tasks:
-        assert task.cancelled()
+    assert not autosave.due_times
+    await autosave.scheduler.join()
+    assert autosave.scheduler.runner is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_max_staleness_saves_during_continuous_editing(settings):
+    settings.YROOM_SETTINGS = {
+        "busy": {"AUTOSAVE_DELAY": 0.05, "AUTOSAVE_MAX_STALENESS": 0.1},
+    }
+    consumer = FakeChannelConsumer()
+    autosave = Autosave(consumer)
+
+    for _ in range(8):
+        autosave.nudge("busy")
+        await asyncio.sleep(0.02)
+    assert consumer.savedRooms == ["busy"]
+
+    await autosave.scheduler.join()
+    assert consumer.savedRooms == ["busy", "busy"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_min_edits_and_bytes_gate_delayed_save(settings):
+    settings.YROOM_SETTINGS = {
+        "edits": {"AUTOSAVE_DELAY": 0.01, "AUTOSAVE_MIN_EDITS": 3},
+        "bytes": {"AUTOSAVE_DELAY": 0.01, "AUTOSAVE_MIN_BYTES": 100},
+        "stale": {
+            "AUTOSAVE_DELAY": 0.01,
+            "AUTOSAVE_MIN_EDITS": 3,
+            "AUTOSAVE_MAX_STALENESS": 0.05,
+        },
+    }
+    consumer = FakeChannelConsumer()
+    autosave = Autosave(consumer)
+
+    autosave.nudge("edits")
+    autosave.nudge("bytes", 60)
+    autosave.nudge("stale")
+    await asyncio.sleep(0.03)
+    assert consumer.savedRooms == []
+    assert autosave.edit_counts == {"edits": 1, "bytes": 1, "stale": 1}
 
+    autosave.nudge("edits")
+    autosave.nudge("edits")
+    autosave.nudge("bytes", 60)
+    await autosave.scheduler.join()
+
+    assert sorted(consumer.savedRooms) == ["bytes", "edits", "stale"]
+    assert not autosave.edit_counts
+    assert not autosave.edit_bytes
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_jitter_is_added_to_due_times(settings, monkeypatch):
+    settings.YROOM_SETTINGS = {
+        "jitter": {"AUTOSAVE_DELAY": 10, "AUTOSAVE_JITTER": 5},
+    }
+    monkeypatch.setattr("channels_yroom.autosave.random.uniform", lambda a, b: b)
+    consumer = FakeChannelConsumer()
+    autosave = Autosave(consumer)
+    now = 100.0
+    autosave.scheduler.time_func = lambda: now
+
+    autosave.nudge("jitter")
+    assert autosave.due_times == {"jitter": 115.0}
+
+    # Scheduler runner starts with the clock at the due time
+    now = 115.0
+    await autosave.scheduler.join()
+
+    assert consumer.savedRooms == ["jitter"]
     assert not autosave.due_times
-    assert not autosave.saver_tasks
+
+
+@pytest.mark.django_db
+def test_max_staleness_needs_to_be_strictly_positive(settings):
+    settings.YROOM_SETTINGS = {"invalid": {"AUTOSAVE_MAX_STALENESS": 0}}
+    autosave = Autosave(consumer=None)
+
+    with pytest.raises(ValueError) as e:
+        autosave.nudge("invalid")
+
+    assert "Autosave max staleness has to be strictly positive" in str(e.value)
@@ -8,12 +8,14 @@ import y_py as Y
 from asgiref.testing import ApplicationCommunicator
 from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
+from yroom import YRoomClientOptions
 
-from channels_yroom.channel import YRoomChannelConsumer
+from channels_yroom.channel import REMOVE_ROOM, YRoomChannelConsumer
 from channels_yroom.conf import get_room_settings
 from channels_yroom.consumer import YroomConsumer
-from channels_yroom.models import YDocUpdate
-from channels_yroom.proxy import DataUnavailable, YroomDocument
+from channels_yroom.models import YDocIncrement, YDocUpdate
+from channels_yroom.protocol import write_sync_update, write_var_uint
+from channels_yroom.proxy import DataUnavailable, YroomDocument, preload_rooms
 from channels_yroom.storage import get_ydoc_storage
 
 
@@ -23,6 +25,7 @@ class FakeWorker:
         self.channel = channel
         self.worker_communicator = worker_communicator
         self.messages = deque()
+        self.event = asyncio.Event()
 
     @classmethod
     def from_defaults(
@@ -39,7 +42,6 @@ class FakeWorker:
         return cls(channel_layer, channel, worker_communicator)
 
     async def run_fake_worker(self):
-        self.event = asyncio.Event()
         while True:
             # Receive message on channel layer...
             message = await self.channel_layer.receive(self.channel)
@@ -254,8 +256,9 @@ async def test_snapshot_yroom_consumer(settings, ydata):
         await fake_worker.shutdown()
         assert worker_results["shutdown"]
 
+        # Room without edits is not saved again
         ydoc_update = await YDocUpdate.objects.aget(name=room_name)
-        assert ydoc_update.timestamp > timestamp
+        assert ydoc_update.timestamp == timestamp
 
 
 @pytest.mark.asyncio
@@ -325,3 +328,515 @@ async def test_export_bad_room(yroom_worker):
         await proxy.export_map("map")
     with pytest.raises(DataUnavailable):
         await proxy.export_xml_element("xml_element")
+
+
+@pytest.mark.asyncio
+async def test_concurrent_room_loads_share_one_snapshot_fetch(ydata):
+    class SlowStorage:
+        def __init__(self):
+            self.fetches = 0
+            self.release = asyncio.Event()
+
+        async def get_snapshot(self, name):
+            self.fetches += 1
+            await self.release.wait()
+            return ydata.DOC_DATA
+
+    storage = SlowStorage()
+    consumer = YRoomChannelConsumer()
+    consumer.storages["shared"] = storage
+    consumer.channel_layer = get_channel_layer()
+
+    room_name = "shared.1"
+    connects = [
+        asyncio.create_task(
+            consumer.connect(
+                {
+                    "type": "connect",
+                    "room": room_name,
+                    "conn_id": conn_id,
+                    "channel_name": "client.%d" % conn_id,
+                }
+            )
+        )
+        for conn_id in range(1, 4)
+    ]
+    loads = [asyncio.create_task(consumer.load_room(room_name)) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert list(consumer.room_loads) == [room_name]
+
+    storage.release.set()
+    await asyncio.gather(*connects)
+    assert await asyncio.gather(*loads) == [True, True]
+
+    assert storage.fetches == 1
+    assert not consumer.room_loads
+    assert consumer.room_manager.is_room_alive(room_name)
+    for conn_id in range(1, 4):
+        message = await consumer.channel_layer.receive("client.%d" % conn_id)
+        assert message["payloads"] == [ydata.SYNC_STEP_1_DATA]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_incremental_storage_appends_updates_and_restores(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": (
+                "channels_yroom.storage.YDocIncrementalDatabaseStorage"
+            ),
+            "REMOVE_ROOM_DELAY": 0,
+        }
+    }
+    room_name = "incremental.1"
+    consumer = YRoomChannelConsumer()
+    consumer.channel_layer = get_channel_layer()
+    message = {
+        "type": "connect",
+        "room": room_name,
+        "conn_id": 1,
+        "channel_name": "incremental_client",
+    }
+    await consumer.connect(message)
+
+    doc = Y.YDoc()
+    text = doc.get_text("text")
+    for chunk in ("hello", " world"):
+        state_vector = Y.encode_state_vector(doc)
+        with doc.begin_transaction() as txn:
+            text.extend(txn, chunk)
+        update = Y.encode_state_as_update(doc, state_vector)
+        await consumer.message(
+            dict(message, type="message", payload=write_sync_update(update))
+        )
+
+    await consumer.flush_updates(room_name)
+    assert await YDocIncrement.objects.acount() == 2
+    assert not await YDocUpdate.objects.filter(name=room_name).aexists()
+
+    # Fresh worker restores document from updates alone
+    restored = YRoomChannelConsumer()
+    assert await restored.load_room(room_name)
+    assert restored.room_manager.export_text(room_name, "text") == "hello world"
+    # Loaded updates get compacted when the room is saved
+    assert room_name in restored.dirty_rooms
+
+    # Snapshot compacts updates
+    await consumer.snapshot_room(room_name)
+    assert await YDocIncrement.objects.acount() == 0
+    assert await YDocUpdate.objects.filter(name=room_name).aexists()
+
+
+@pytest.mark.asyncio
+async def test_updates_are_appended_in_background(settings):
+    settings.YROOM_SETTINGS = {"default": {"REMOVE_ROOM_DELAY": 0}}
+
+    class SlowStorage:
+        def __init__(self):
+            self.appended = []
+            self.release = asyncio.Event()
+
+        async def get_snapshot(self, name):
+            return None
+
+        async def append_update(self, name, update):
+            await self.release.wait()
+            self.appended.append(update)
+
+        def needs_compaction(self, name):
+            return False
+
+    storage = SlowStorage()
+    consumer = YRoomChannelConsumer()
+    consumer.storages["slow"] = storage
+    consumer.channel_layer = get_channel_layer()
+    message = {
+        "type": "connect",
+        "room": "slow.1",
+        "conn_id": 1,
+        "channel_name": "slow_client",
+    }
+    await consumer.connect(message)
+    await consumer.channel_layer.receive("slow_client")
+
+    doc = Y.YDoc()
+    text = doc.get_text("text")
+    updates = []
+    for chunk in ("hello", " world"):
+        state_vector = Y.encode_state_vector(doc)
+        with doc.begin_transaction() as txn:
+            text.extend(txn, chunk)
+        updates.append(Y.encode_state_as_update(doc, state_vector))
+        await consumer.message(
+            dict(message, type="message", payload=write_sync_update(updates[-1]))
+        )
+
+    # Edits were handled while the storage is still busy
+    assert consumer.room_manager.export_text("slow.1", "text") == "hello world"
+    assert storage.appended == []
+
+    storage.release.set()
+    await consumer.flush_updates("slow.1")
+    assert storage.appended == updates
+    assert "slow.1" not in consumer.append_tasks
+
+
+@pytest.mark.asyncio
+async def test_only_edited_rooms_are_snapshotted(ydata):
+    class FlakyStorage:
+        def __init__(self):
+            self.saved = []
+            self.fail = False
+
+        async def get_snapshot(self, name):
+            return ydata.DOC_DATA
+
+        async def save_snapshot(self, name, data):
+            if self.fail:
+                raise IOError("Storage down")
+            self.saved.append(name)
+
+    storage = FlakyStorage()
+    consumer = YRoomChannelConsumer()
+    consumer.storages["dirty"] = storage
+    consumer.channel_layer = get_channel_layer()
+    message = {
+        "type": "connect",
+        "room": "dirty.1",
+        "conn_id": 1,
+        "channel_name": "dirty_client",
+    }
+    await consumer.connect(message)
+    await consumer.message(dict(message, type="message", payload=ydata.SYNC_STEP_1))
+    await consumer.message(
+        dict(message, type="message", payload=ydata.AWARENESS_UPDATE)
+    )
+    await consumer.snapshot_room("dirty.1")
+    assert storage.saved == []
+
+    await consumer.message(dict(message, type="message", payload=ydata.DOC_UPDATE))
+    assert consumer.dirty_rooms == {"dirty.1"}
+
+    storage.fail = True
+    with pytest.raises(IOError):
+        await consumer.snapshot_room("dirty.1")
+    assert consumer.dirty_rooms == {"dirty.1"}
+
+    storage.fail = False
+    await consumer.snapshot_room("dirty.1")
+    await consumer.snapshot_room("dirty.1")
+    assert storage.saved == ["dirty.1"]
+    assert not consumer.dirty_rooms
+
+
+@pytest.mark.asyncio
+async def test_preload_and_shutdown_use_batch_storage(ydata):
+    class BatchStorage:
+        def __init__(self):
+            self.calls = []
+
+        async def get_snapshots(self, names):
+            self.calls.append(("get_snapshots", sorted(names)))
+            return {name: ydata.DOC_DATA for name in names if name != "batch.none"}
+
+        async def save_snapshots(self, snapshots):
+            self.calls.append(("save_snapshots", sorted(snapshots)))
+
+    storage = BatchStorage()
+    consumer = YRoomChannelConsumer()
+    consumer.storages["batch"] = storage
+    consumer.channel_layer = get_channel_layer()
+
+    await preload_rooms(["batch.1", "batch.2", "batch.none"])
+    message = await consumer.channel_layer.receive("yroom")
+    assert message == {"type": "preload", "rooms": ["batch.1", "batch.2", "batch.none"]}
+    await consumer.preload(message)
+
+    assert storage.calls == [("get_snapshots", ["batch.1", "batch.2", "batch.none"])]
+    assert sorted(consumer.room_manager.list_rooms()) == ["batch.1", "batch.2"]
+    assert consumer.room_manager.export_text("batch.1", "test") == "hello "
+    # Unused preloaded rooms get removed again
+    assert sorted(consumer.scheduler.deadlines) == [
+        (REMOVE_ROOM, "batch.1"),
+        (REMOVE_ROOM, "batch.2"),
+    ]
+    await consumer.scheduler.close()
+
+    for room_name in ("batch.1", "batch.2"):
+        message = {
+            "type": "connect",
+            "room": room_name,
+            "conn_id": 1,
+            "channel_name": "batch_client",
+        }
+        await consumer.connect(message)
+        await consumer.message(dict(message, type="message", payload=ydata.DOC_UPDATE))
+    sent = []
+    consumer.base_send = lambda message: asyncio.sleep(0, sent.append(message))
+    await consumer.shutdown({"type": "shutdown"})
+    assert sent == [{"type": "shutdown.complete"}]
+    assert storage.calls[-1] == ("save_snapshots", ["batch.1", "batch.2"])
+
+
+@pytest.mark.asyncio
+async def test_idle_rooms_are_evicted_over_memory_budget(settings, ydata):
+    class DictStorage:
+        def __init__(self):
+            self.snapshots = {"evict.1": ydata.DOC_DATA, "evict.2": ydata.DOC_DATA}
+            self.saved = []
+
+        async def get_snapshot(self, name):
+            return self.snapshots.get(name)
+
+        async def save_snapshot(self, name, data):
+            self.saved.append(name)
+            self.snapshots[name] = data
+
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocDummyStorage",
+            "REMOVE_ROOM_DELAY": 60,
+            "MEMORY_BUDGET": 2 * len(ydata.DOC_DATA) + 5,
+            "MEMORY_EVICTION_MIN_IDLE": 0,
+        }
+    }
+    storage = DictStorage()
+    consumer = YRoomChannelConsumer()
+    consumer.storages["evict"] = storage
+    consumer.channel_layer = get_channel_layer()
+
+    for room_name in ("evict.1", "evict.2"):
+        await consumer.connect(
+            {
+                "type": "connect",
+                "room": room_name,
+                "conn_id": 1,
+                "channel_name": "evict_client",
+            }
+        )
+    assert consumer.memory.total_size == 2 * len(ydata.DOC_DATA)
+    assert consumer.memory.evict_task is None
+
+    # Room without clients waits for its removal
+    await consumer.disconnect({"type": "disconnect", "room": "evict.1", "conn_id": 1})
+    message = {
+        "type": "message",
+        "room": "evict.2",
+        "conn_id": 1,
+        "channel_name": "evict_client",
+        "payload": ydata.DOC_UPDATE,
+    }
+    await consumer.message(message)
+    await consumer.memory.evict_task
+
+    # Least recently used room without clients is unloaded without saving
+    assert not consumer.room_manager.has_room("evict.1")
+    assert not consumer.scheduler.is_scheduled((REMOVE_ROOM, "evict.1"))
+    assert consumer.room_manager.has_room("evict.2")
+    assert consumer.memory.evictions == 1
+    assert storage.saved == []
+
+    # Idle room with connected client is saved and evicted
+    settings.YROOM_SETTINGS["default"]["MEMORY_BUDGET"] = 1
+    consumer.memory.check()
+    await consumer.memory.evict_task
+    assert consumer.room_manager.list_rooms() == []
+    assert storage.saved == ["evict.2"]
+    assert consumer.memory.evictions == 2
+    assert consumer.memory.total_size == 0
+    assert not consumer.scheduler.deadlines
+
+    # Next message loads the room again with its client reconnected
+    settings.YROOM_SETTINGS["default"]["MEMORY_BUDGET"] = None
+    await consumer.message(dict(message, payload=ydata.SYNC_STEP_1_DATA))
+    assert consumer.room_manager.export_text("evict.2", "test") == "hello world"
+    assert consumer.room_manager.is_room_alive("evict.2")
+    await consumer.disconnect({"type": "disconnect", "room": "evict.2", "conn_id": 1})
+    assert not consumer.room_manager.is_room_alive("evict.2")
+    assert consumer.scheduler.is_scheduled((REMOVE_ROOM, "evict.2"))
+
+    # Evicted room without clients is restored on next connect
+    await consumer.connect(dict(message, type="connect", room="evict.1"))
+    assert consumer.room_manager.export_text("evict.1", "test") == "hello "
+    await consumer.scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_room_stats_rpc(settings, ydata, yroom_worker):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocDummyStorage",
+            "REMOVE_ROOM_DELAY": 60,
+        }
+    }
+    room_name = "stats.1"
+    proxy = YroomDocument(room_name)
+    with pytest.raises(DataUnavailable):
+        await proxy.get_stats()
+
+    channel_layer = get_channel_layer()
+    message = {
+        "type": "connect",
+        "room": room_name,
+        "conn_id": 1,
+        "channel_name": "stats_client",
+    }
+    await channel_layer.send("yroom", message)
+    await channel_layer.send(
+        "yroom", dict(message, type="message", payload=ydata.DOC_UPDATE)
+    )
+    await channel_layer.send(
+        "yroom", dict(message, type="message", payload=ydata.AWARENESS_UPDATE)
+    )
+
+    stats = await proxy.get_stats()
+    assert stats["clients"] == 1
+    assert stats["messages_in_per_second"] > 0
+    assert stats["bytes_in_per_second"] > 0
+    assert stats["messages_out_per_second"] > 0
+    assert stats["bytes_out_per_second"] > 0
+    assert stats["edits_per_second"] > 0
+    assert stats["last_edit"] is not None
+    assert stats["last_save"] is None
+    assert stats["size"] > 0
+
+    await channel_layer.send("yroom", dict(message, type="disconnect"))
+    stats = await proxy.get_stats()
+    assert stats["clients"] == 0
+
+
+@pytest.mark.asyncio
+async def test_client_options_are_sent_once_per_connection(ydata):
+    option_calls = []
+
+    class ReadOnlyConsumer(YroomConsumer):
+        allow_write = False
+
+        async def get_client_options(self):
+            option_calls.append(self.allow_write)
+            return YRoomClientOptions(
+                allow_write=self.allow_write, allow_write_awareness=True
+            )
+
+    app = ReadOnlyConsumer()
+    fake_worker = FakeWorker.from_defaults(room_name=app.get_room_name())
+    async with fake_worker.start():
+        client = WebsocketCommunicator(app, "/testws/")
+        await client.connect()
+        message = await fake_worker.wait_for_message()
+        assert message["options"] == {
+            "allow_write": False,
+            "allow_write_awareness": True,
+        }
+        await client.receive_from()
+
+        # Read-only client can't edit
+        await client.send_to(bytes_data=ydata.DOC_UPDATE)
+        message = await fake_worker.wait_for_message()
+        assert "options" not in message
+        assert await client.receive_nothing()
+
+        app.allow_write = True
+        await app.update_client_options()
+        message = await fake_worker.wait_for_message()
+        assert message["type"] == "update_options"
+        await client.send_to(bytes_data=ydata.DOC_UPDATE)
+        await fake_worker.wait_for_message()
+        assert await client.receive_from() == ydata.DOC_UPDATE
+        assert option_calls == [False, True]
+
+        await client.disconnect()
+        message = await fake_worker.wait_for_message()
+        assert message["type"] == "disconnect"
+        await fake_worker.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_unknown_connection_reconnects_with_its_options(ydata):
+    class ReadOnlyConsumer(YroomConsumer):
+        async def get_client_options(self):
+            return YRoomClientOptions(allow_write=False, allow_write_awareness=True)
+
+    app = ReadOnlyConsumer()
+    client = WebsocketCommunicator(app, "/testws/")
+    fake_worker = FakeWorker.from_defaults(room_name=app.get_room_name())
+    async with fake_worker.start():
+        await client.connect()
+        await fake_worker.wait_for_message()
+        await client.receive_from()
+        await fake_worker.shutdown()
+
+    # Restarted worker doesn't know the connection and its options
+    fake_worker = FakeWorker.from_defaults(room_name=app.get_room_name())
+    async with fake_worker.start():
+        await client.send_to(bytes_data=ydata.DOC_UPDATE)
+        message = await fake_worker.wait_for_message()
+        assert message["type"] == "message"
+        # Returned to the consumer, which connects again before resending
+        message = await fake_worker.wait_for_message()
+        assert message["type"] == "connect"
+        assert message["options"] == {
+            "allow_write": False,
+            "allow_write_awareness": True,
+        }
+        message = await fake_worker.wait_for_message()
+        assert message["type"] == "message"
+        assert message["payload"] == ydata.DOC_UPDATE
+        # Sync step of the connect, the read-only client still can't edit
+        await client.receive_from()
+        assert await client.receive_nothing()
+
+        await client.disconnect()
+        await fake_worker.wait_for_message()
+        await fake_worker.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_compact_envelope(settings, ydata):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocDummyStorage",
+            "REMOVE_ROOM_DELAY": 0,
+            "COMPACT_ENVELOPE": True,
+        }
+    }
+    app = YroomConsumer()
+    fake_worker = FakeWorker.from_defaults(room_name=app.get_room_name())
+    async with fake_worker.start():
+        client = WebsocketCommunicator(app, "/testws/")
+        await client.connect()
+        await fake_worker.wait_for_message()
+        assert await client.receive_from() == ydata.SYNC_STEP_1
+        assert app.session_handle is not None
+
+        await client.send_to(bytes_data=ydata.DOC_UPDATE)
+        message = await fake_worker.wait_for_message()
+        assert message == {
+            "type": "packed",
+            "data": write_var_uint(app.session_handle) + ydata.DOC_UPDATE,
+        }
+        assert await client.receive_from() == ydata.DOC_UPDATE
+
+        # Stale handle, e.g. of a crashed worker: the worker drops the
+        # message and resets the session, client connects again
+        app.session_handle = 1
+        await client.send_to(bytes_data=ydata.AWARENESS_UPDATE)
+        message = await fake_worker.wait_for_message()
+        assert message["type"] == "packed"
+        message = await fake_worker.wait_for_message()
+        assert message["type"] == "connect"
+        # Sync step of the connect
+        await client.receive_from()
+        assert await client.receive_nothing()
+        assert app.session_handle not in (None, 1)
+
+        # Shutdown closes sessions, client goes back to full messages
+        await fake_worker.shutdown()
+        assert await client.receive_nothing()
+        assert app.session_handle is None
+        await client.send_to(bytes_data=ydata.AWARENESS_UPDATE)
+        message = await fake_worker.wait_for_message()
+        assert message["type"] == "message"
+        assert message["payload"] == ydata.AWARENESS_UPDATE
+        await client.disconnect()
+        await fake_worker.wait_for_message()
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+import y_py as Y
+from channels.testing import WebsocketCommunicator
+
+from channels_yroom.consumer import YroomConsumer
+from channels_yroom.embedded import get_engine, shutdown_engine
+from channels_yroom.protocol import write_sync_update
+from channels_yroom.proxy import DataUnavailable, YroomDocument
+
+
+@pytest.mark.asyncio
+async def test_embedded_engine(settings, ydata):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocDummyStorage",
+            "REMOVE_ROOM_DELAY": 0,
+            "EMBEDDED": True,
+        }
+    }
+    # No channel layer and no worker needed
+    settings.CHANNEL_LAYERS = {}
+
+    app = YroomConsumer()
+    app_2 = YroomConsumer()
+    room_name = app.get_room_name()
+    client_1 = WebsocketCommunicator(app, "/testws/")
+    client_2 = WebsocketCommunicator(app_2, "/testws/")
+    connected, _ = await client_1.connect()
+    assert connected
+    assert await client_1.receive_from() == ydata.SYNC_STEP_1
+    connected, _ = await client_2.connect()
+    assert connected
+    assert await client_2.receive_from() == ydata.SYNC_STEP_1
+    assert app.channel_layer is None
+    assert set(get_engine().groups[room_name]) == {app.channel_name, app_2.channel_name}
+
+    doc = Y.YDoc()
+    text = doc.get_text("text")
+    with doc.begin_transaction() as txn:
+        text.extend(txn, "hello")
+    update = write_sync_update(Y.encode_state_as_update(doc))
+    await client_1.send_to(bytes_data=update)
+    assert await client_1.receive_from() == update
+    assert await client_2.receive_from() == update
+
+    # Proxy talks to the engine as well
+    document = YroomDocument(room_name)
+    assert await document.export_text("text") == "hello"
+    assert (await document.get_stats())["clients"] == 2
+    with pytest.raises(DataUnavailable):
+        await YroomDocument("other_room").get_stats()
+
+    await client_2.disconnect()
+    # Awareness update about the client leaving
+    assert await client_1.receive_from() == ydata.AWARENESS_UPDATE
+    assert set(get_engine().groups[room_name]) == {app.channel_name}
+    await client_1.disconnect()
+    assert room_name not in get_engine().groups
+
+    await shutdown_engine()
+
+
+class RecordingClient:
+    def __init__(self, engine):
+        self.engine = engine
+        self.received = []
+
+    async def forward_payload(self, message):
+        # Engine is free for further messages during delivery
+        assert not self.engine.lock.locked()
+        self.received.append(message["payloads"])
+        if len(self.received) == 1:
+            await self.engine.dispatch(
+                {"type": "disconnect", "room": "embedded.1", "conn_id": 1}
+            )
+
+
+@pytest.mark.asyncio
+async def test_embedded_engine_delivers_outside_of_lock(settings, ydata):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocDummyStorage",
+            "REMOVE_ROOM_DELAY": 0,
+            "EMBEDDED": True,
+        }
+    }
+    engine = get_engine()
+    client = RecordingClient(engine)
+    engine.register("client.1", "embedded.1", client)
+
+    await engine.dispatch(
+        {
+            "type": "connect",
+            "room": "embedded.1",
+            "conn_id": 1,
+            "channel_name": "client.1",
+        }
+    )
+
+    # Disconnect dispatched by the client's handler didn't deadlock
+    assert client.received == [[ydata.SYNC_STEP_1], [ydata.AWARENESS_UPDATE]]
+    assert not engine.consumer.room_manager.is_room_alive("embedded.1")
+    engine.unregister("client.1", "embedded.1")
+    await shutdown_engine()
+
+
+@pytest.mark.asyncio
+async def test_embedded_engine_is_bound_to_one_loop(settings, caplog):
+    settings.YROOM_SETTINGS = {"default": {"EMBEDDED": True}}
+    engine = get_engine()
+    assert get_engine() is engine
+    engine.register("client.1", "embedded.1", RecordingClient(engine))
+    other_loop = asyncio.new_event_loop()
+    engine.loop = other_loop
+
+    # Engine in use by an open loop is not replaced
+    with pytest.raises(RuntimeError):
+        get_engine()
+
+    other_loop.close()
+    new_engine = get_engine()
+    assert new_engine is not engine
+    assert "closed without shutdown_engine()" in caplog.text
+
+    await new_engine.receive_from_consumer({"type": "unexpected"})
+    assert "Unexpected message from room consumer" in caplog.text
+    await shutdown_engine()
@@ -0,0 +1,177 @@
+import asyncio
+import socket
+
+import pytest
+from channels.layers import get_channel_layer
+
+from channels_yroom.channel import YRoomChannelConsumer
+from channels_yroom.metrics import (
+    CallbackMetrics,
+    Metrics,
+    PrometheusMetrics,
+    StatsdMetrics,
+    get_metrics,
+)
+from channels_yroom.worker import YroomWorker
+
+recorded = []
+
+
+def record_metric(kind, name, value, tags):
+    recorded.append((kind, name, value, tags))
+
+
+def test_default_metrics_discard_everything():
+    metrics = get_metrics()
+    assert type(metrics) is Metrics
+    metrics.increment("foo")
+    metrics.observe("bar", 1.0, {"type": "message"})
+
+
+def test_statsd_metrics():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(1)
+    port = receiver.getsockname()[1]
+
+    metrics = StatsdMetrics(host="127.0.0.1", port=port)
+    metrics.increment("respond_payloads", 2, {"target": "client"})
+    metrics.gauge("rooms", 3)
+    metrics.observe("dispatch_seconds", 0.25, {"type": "message"})
+    assert receiver.recv(1024) == b"yroom.respond_payloads:2|c|#target:client"
+    assert receiver.recv(1024) == b"yroom.rooms:3|g"
+    assert receiver.recv(1024) == b"yroom.dispatch_seconds:250|ms|#type:message"
+
+    metrics = StatsdMetrics(host="127.0.0.1", port=port, dogstatsd_tags=False)
+    metrics.increment("respond_payloads", 1, {"target": "client"})
+    assert receiver.recv(1024) == b"yroom.respond_payloads.client:1|c"
+    receiver.close()
+
+
+@pytest.mark.asyncio
+async def test_prometheus_metrics():
+    metrics = PrometheusMetrics(port=0, buckets=(0.1, 1.0))
+    metrics.increment("respond_payloads", 2, {"target": "client"})
+    metrics.gauge("rooms", 3)
+    metrics.observe("dispatch_seconds", 0.05, {"type": "message"})
+    metrics.observe("dispatch_seconds", 0.5, {"type": "message"})
+    metrics.observe("dispatch_seconds", 5, {"type": "message"})
+
+    await metrics.start()
+    port = metrics.server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    response = await reader.read()
+    writer.close()
+    await metrics.close()
+
+    head, body = response.split(b"\r\n\r\n", 1)
+    assert head.startswith(b"HTTP/1.1 200 OK")
+    assert body.decode("utf-8").splitlines() == [
+        "# TYPE yroom_respond_payloads_total counter",
+        'yroom_respond_payloads_total{target="client"} 2',
+        "# TYPE yroom_rooms gauge",
+        "yroom_rooms 3",
+        "# TYPE yroom_dispatch_seconds histogram",
+        'yroom_dispatch_seconds_bucket{type="message",le="0.1"} 1',
+        'yroom_dispatch_seconds_bucket{type="message",le="1.0"} 2',
+        'yroom_dispatch_seconds_bucket{type="message",le="+Inf"} 3',
+        'yroom_dispatch_seconds_sum{type="message"} 5.55',
+        'yroom_dispatch_seconds_count{type="message"} 3',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_prometheus_metrics_port_per_shard(settings, monkeypatch):
+    # Don't leak the shard's metrics instance to other tests
+    monkeypatch.setattr("channels_yroom.metrics.metrics_cache", {})
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        free_port = sock.getsockname()[1]
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "METRICS_BACKEND": "channels_yroom.metrics.PrometheusMetrics",
+            "METRICS_OPTIONS": {"port": free_port - 2},
+        }
+    }
+    worker = YroomWorker("metrics", get_channel_layer(), shard=2)
+    metrics = worker.metrics
+    assert isinstance(metrics, PrometheusMetrics)
+    await metrics.start()
+    try:
+        assert metrics.server.sockets[0].getsockname()[1] == free_port
+    finally:
+        await metrics.close()
+
+
+@pytest.mark.asyncio
+async def test_worker_and_consumer_report_metrics(settings, ydata):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocDummyStorage",
+            "REMOVE_ROOM_DELAY": 0,
+            "METRICS_BACKEND": "channels_yroom.metrics.CallbackMetrics",
+            "METRICS_OPTIONS": {"callback": "tests.test_metrics.record_metric"},
+        }
+    }
+    recorded.clear()
+    channel_layer = get_channel_layer()
+    worker = YroomWorker("metrics", channel_layer)
+    assert isinstance(worker.metrics, CallbackMetrics)
+    worker.consumer = YRoomChannelConsumer()
+    worker.consumer.channel_layer = channel_layer
+
+    message = {
+        "type": "connect",
+        "room": "metrics.1",
+        "conn_id": 1,
+        "channel_name": "metrics_client",
+    }
+    queue = asyncio.Queue()
+    await worker.dispatch_from_queue(message, queue)
+    await worker.dispatch_from_queue(
+        dict(message, type="message", payload=ydata.DOC_UPDATE), queue
+    )
+
+    names = [(kind, name) for kind, name, _value, _tags in recorded]
+    assert ("observe", "snapshot_load_seconds") in names
+    assert ("increment", "respond_payloads") in names
+    assert ("observe", "broadcast_fanout") in names
+    dispatch_tags = [
+        tags for _kind, name, _value, tags in recorded if name == "dispatch_seconds"
+    ]
+    assert dispatch_tags == [{"type": "connect"}, {"type": "message"}]
+    fanout = [
+        value for _kind, name, value, _tags in recorded if name == "broadcast_fanout"
+    ]
+    assert fanout == [1]
+
+
+@pytest.mark.asyncio
+async def test_worker_reports_queue_depths(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "METRICS_BACKEND": "channels_yroom.metrics.CallbackMetrics",
+            "METRICS_OPTIONS": {"callback": "tests.test_metrics.record_metric"},
+            "METRICS_INTERVAL": 0.01,
+        }
+    }
+    recorded.clear()
+    worker = YroomWorker("metrics", get_channel_layer(), concurrent=True)
+    # Set up by run_worker()
+    worker.input_queue = asyncio.Queue()
+    worker.input_queue.put_nowait({"type": "connect"})
+    for room_name, size in (("metrics.1", 2), ("metrics.2", 3)):
+        worker.room_queues[room_name] = asyncio.Queue()
+        for _ in range(size):
+            worker.room_queues[room_name].put_nowait({"type": "message"})
+
+    task = asyncio.create_task(worker.report_metrics())
+    while not any(name == "room_queue_depth" for _kind, name, *_ in recorded):
+        await asyncio.sleep(0.01)
+    worker.shutting_down = True
+    await task
+
+    gauges = {name: value for kind, name, value, _tags in recorded if kind == "gauge"}
+    assert gauges["input_queue_depth"] == 1
+    assert gauges["room_queue_depth"] == 5
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from channels_yroom.scheduler import Scheduler
+
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+
+    def callback(self, name):
+        async def record():
+            self.calls.append(name)
+
+        return record
+
+
+@pytest.mark.asyncio
+async def test_callbacks_run_in_deadline_order():
+    scheduler = Scheduler()
+    recorder = Recorder()
+
+    scheduler.schedule("slow", 0.05, recorder.callback("slow"))
+    scheduler.schedule("fast", 0.01, recorder.callback("fast"))
+    scheduler.schedule("cancelled", 0.02, recorder.callback("cancelled"))
+    scheduler.cancel("cancelled")
+    await scheduler.join()
+
+    assert recorder.calls == ["fast", "slow"]
+    assert not scheduler.deadlines
+    assert scheduler.runner is None
+
+
+@pytest.mark.asyncio
+async def test_postponing_updates_deadline_in_place():
+    scheduler = Scheduler()
+    recorder = Recorder()
+
+    scheduler.schedule("room", 0.02, recorder.callback("first"))
+    for _ in range(100):
+        scheduler.schedule("room", 0.04, recorder.callback("postponed"))
+    assert len(scheduler.heap) == 1
+    await asyncio.sleep(0.03)
+    assert recorder.calls == []
+
+    await scheduler.join()
+    assert recorder.calls == ["postponed"]
+
+
+@pytest.mark.asyncio
+async def test_moving_deadline_forward_wakes_runner():
+    scheduler = Scheduler()
+    recorder = Recorder()
+
+    scheduler.schedule("room", 10, recorder.callback("late"))
+    await asyncio.sleep(0)
+    scheduler.schedule("room", 0.01, recorder.callback("early"))
+    await asyncio.wait_for(scheduler.join(), 1)
+
+    assert recorder.calls == ["early"]
+    assert not scheduler.heap
+
+
+@pytest.mark.asyncio
+async def test_stale_heap_entries_are_compacted():
+    scheduler = Scheduler()
+    recorder = Recorder()
+
+    for i in range(200):
+        scheduler.schedule("room", 10, recorder.callback("late"))
+        scheduler.cancel("room")
+    scheduler.schedule("room", 0.01, recorder.callback("room"))
+    assert len(scheduler.heap) <= 2 * len(scheduler.deadlines) + 64
+
+    await scheduler.join()
+    assert recorder.calls == ["room"]
+
+
+@pytest.mark.asyncio
+async def test_callback_exceptions_are_reported():
+    loop = asyncio.get_running_loop()
+    contexts = []
+    loop.set_exception_handler(lambda loop, context: contexts.append(context))
+    scheduler = Scheduler()
+
+    async def fail():
+        raise ValueError("Boom")
+
+    scheduler.schedule("room", 0, fail)
+    await scheduler.join()
+    await asyncio.sleep(0)
+    loop.set_exception_handler(None)
+
+    assert len(contexts) == 1
+    assert isinstance(contexts[0]["exception"], ValueError)
+
+
+@pytest.mark.asyncio
+async def test_close_drops_deadlines_and_waits_for_running_callbacks():
+    scheduler = Scheduler()
+    finished = []
+
+    async def slow():
+        await asyncio.sleep(0.02)
+        finished.append("slow")
+
+    scheduler.schedule("slow", 0, slow)
+    scheduler.schedule("pending", 10, slow)
+    await asyncio.sleep(0.01)
+    await scheduler.close()
+
+    assert finished == ["slow"]
+    assert not scheduler.deadlines
+    assert scheduler.runner is None
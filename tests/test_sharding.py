@@ -0,0 +1,49 @@
+from collections import Counter
+
+import pytest
+
+from channels_yroom.sharding import (
+    get_channel_shards,
+    get_room_channel_name,
+    get_room_shard,
+    jump_consistent_hash,
+    room_hash,
+)
+
+
+def test_room_hash_is_stable():
+    assert room_hash("textcollab.1") == room_hash("textcollab.1")
+    assert room_hash("textcollab.1") != room_hash("textcollab.2")
+    assert room_hash("") == 0xE4A6A0577479B2B4
+
+
+def test_jump_consistent_hash_distribution_and_stability():
+    keys = [room_hash("room.%d" % i) for i in range(2000)]
+    buckets = [jump_consistent_hash(key, 4) for key in keys]
+    counts = Counter(buckets)
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > 400
+
+    # Adding a shard only moves keys to the new shard
+    grown = [jump_consistent_hash(key, 5) for key in keys]
+    for before, after in zip(buckets, grown):
+        assert after == before or after == 4
+
+    with pytest.raises(ValueError):
+        jump_consistent_hash(1, 0)
+
+
+def test_room_channel_name(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {},
+        "sharded": {"CHANNEL_NAME": "collab", "SHARDS": 3},
+    }
+    assert get_room_shard("unsharded") is None
+    assert get_room_channel_name("unsharded") == "yroom"
+
+    shard = get_room_shard("sharded.42")
+    assert shard in range(3)
+    assert get_room_channel_name("sharded.42") == "collab.%d" % shard
+
+    assert get_channel_shards("yroom") is None
+    assert get_channel_shards("collab") == 3
@@ -1,8 +1,20 @@
+import asyncio
+import threading
+
 import pytest
+from channels.layers import get_channel_layer
+from django.core.exceptions import ImproperlyConfigured
 
-from channels_yroom.models import YDocUpdate
+from channels_yroom import storage as storage_module
+from channels_yroom.channel import YRoomChannelConsumer
+from channels_yroom.compression import compress, decompress
+from channels_yroom.models import YDocIncrement, YDocUpdate
+from channels_yroom.protocol import read_sync_update, write_sync_update
 from channels_yroom.storage import (
+    YDocCachedStorage,
     YDocDatabaseStorage,
+    YDocFileStorage,
+    YDocIncrementalDatabaseStorage,
     YDocMemoryStorage,
     get_ydoc_storage,
 )
@@ -51,3 +63,419 @@ def test_database_storage_model(settings):
     assert upd.data == b"test2"
     assert YDocUpdate.objects.get_snapshot("test") == b"test2"
     assert YDocUpdate.objects.get_snapshot("not-there") is None
+
+
+def test_protocol_sync_update_roundtrip():
+    update = b"\x01\x01\xe9\xdb\x9a\x90\x01\x00\x04\x01\x04test\x06hello \x00" * 10
+    message = write_sync_update(update)
+    assert message[:4] == b"\x00\x02\xe6\x01"
+    assert read_sync_update(message) == update
+    # Sync step 2 carries an update as well
+    assert read_sync_update(b"\x00\x01\x02ab") == b"ab"
+    # Sync step 1 and awareness messages don't
+    assert read_sync_update(b"\x00\x00\x01\x00") is None
+    assert read_sync_update(b"\x01\x01\x00") is None
+    # Truncated message
+    assert read_sync_update(b"\x00\x02\x05ab") is None
+
+    prefixed = write_sync_update(b"ab", name="room")
+    assert prefixed == b"\x04room\x00\x02\x02ab"
+    assert read_sync_update(prefixed, name_prefixed=True) == b"ab"
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_incremental_database_storage(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": (
+                "channels_yroom.storage.YDocIncrementalDatabaseStorage"
+            ),
+            "COMPACTION_MAX_UPDATES": 2,
+        }
+    }
+    storage = get_ydoc_storage("test")
+    assert isinstance(storage, YDocIncrementalDatabaseStorage)
+    assert await storage.get_snapshot("test") is None
+    assert await storage.get_updates("test") == []
+
+    await storage.append_update("test", b"one")
+    assert not storage.needs_compaction("test")
+    await storage.append_update("test", b"two")
+    assert storage.needs_compaction("test")
+    assert await storage.get_updates("test") == [b"one", b"two"]
+
+    await storage.save_snapshot("test", b"onetwo")
+    assert not storage.needs_compaction("test")
+    assert await storage.get_snapshot("test") == b"onetwo"
+    assert await storage.get_updates("test") == []
+    assert await YDocIncrement.objects.acount() == 0
+
+    # Nothing pending, nothing to save
+    await storage.save_snapshot("test", b"ignored")
+    assert await storage.get_snapshot("test") == b"onetwo"
+
+
+def test_compression_roundtrip_and_legacy_data():
+    data = b"\x01\x01\xe9\xdb\x9a\x90\x01\x00\x04\x01\x04test\x06hello \x00" * 50
+    blob = compress(data, "zlib")
+    assert blob.startswith(b"\xffYR\x01\x01")
+    assert len(blob) < len(data)
+    assert decompress(blob) == data
+    # Uncompressed snapshots without header load unchanged
+    assert decompress(data) == data
+
+    with pytest.raises(ImproperlyConfigured):
+        compress(data, "lzma")
+    with pytest.raises(ValueError):
+        decompress(b"\xffYR\x02\x01")
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_database_storage_compression(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocDatabaseStorage",
+        },
+        "compressed": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocDatabaseStorage",
+            "COMPRESSION": "zlib",
+            "COMPRESSION_LEVEL": 9,
+        },
+    }
+    data = b"hello " * 100
+    storage = get_ydoc_storage("compressed.1")
+    await storage.save_snapshot("compressed.1", data)
+    await storage.save_snapshot("plain", data)
+
+    row = await YDocUpdate.objects.aget(name="compressed.1")
+    assert bytes(row.data).startswith(b"\xffYR")
+    assert len(row.data) < len(data)
+    row = await YDocUpdate.objects.aget(name="plain")
+    assert bytes(row.data) == data
+
+    assert await storage.get_snapshot("compressed.1") == data
+    assert await storage.get_snapshot("plain") == data
+
+
+@pytest.mark.django_db(transaction=True)
+def test_database_storage_model_batch():
+    YDocUpdate.objects.save_snapshot("a", b"old")
+    YDocUpdate.objects.save_snapshots({"a": b"new", "b": b"b"})
+    YDocUpdate.objects.save_snapshots({})
+
+    assert YDocUpdate.objects.get_snapshots(["a", "b", "c"]) == {
+        "a": b"new",
+        "b": b"b",
+    }
+    assert YDocUpdate.objects.get_snapshots([]) == {}
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_incremental_database_storage_batch_save(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": (
+                "channels_yroom.storage.YDocIncrementalDatabaseStorage"
+            ),
+        }
+    }
+    storage = YDocIncrementalDatabaseStorage()
+    await storage.get_updates("clean")
+    await storage.append_update("a", b"a1")
+    await storage.append_update("b", b"b1")
+
+    await storage.save_snapshots({"a": b"A", "b": b"B", "clean": b"C"})
+
+    assert await storage.get_snapshots(["a", "b", "clean"]) == {"a": b"A", "b": b"B"}
+    assert await YDocIncrement.objects.acount() == 0
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_incremental_database_storage_failed_save(monkeypatch, settings):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": (
+                "channels_yroom.storage.YDocIncrementalDatabaseStorage"
+            ),
+            "COMPACTION_MAX_UPDATES": 1,
+        }
+    }
+    storage = YDocIncrementalDatabaseStorage()
+    await storage.append_update("test", b"one")
+
+    def fail(snapshots, clock):
+        raise RuntimeError("database down")
+
+    monkeypatch.setattr(storage_module, "save_db_compacted_snapshots", fail)
+    with pytest.raises(RuntimeError):
+        await storage.save_snapshot("test", b"one")
+    # The update is still pending, so the retry is not skipped
+    assert storage.needs_compaction("test")
+
+    monkeypatch.undo()
+    await storage.save_snapshot("test", b"one")
+    assert await storage.get_snapshot("test") == b"one"
+    assert not storage.needs_compaction("test")
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_incremental_database_storage_append_during_save(monkeypatch, settings):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": (
+                "channels_yroom.storage.YDocIncrementalDatabaseStorage"
+            ),
+            "COMPACTION_MAX_UPDATES": 1,
+        }
+    }
+    storage = YDocIncrementalDatabaseStorage()
+    await storage.append_update("test", b"one")
+    save = storage_module.save_db_compacted_snapshots
+
+    def save_with_append(snapshots, clock):
+        # Edit arriving while the snapshot is written
+        storage._pending_updates["test"] += 1
+        storage._pending_bytes["test"] += 3
+        save(snapshots, clock)
+
+    monkeypatch.setattr(storage_module, "save_db_compacted_snapshots", save_with_append)
+    await storage.save_snapshot("test", b"one")
+    assert storage.needs_compaction("test")
+    assert storage._pending_bytes["test"] == 3
+
+
+@pytest.mark.asyncio
+async def test_file_storage(settings, tmp_path):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocFileStorage",
+            "STORAGE_OPTIONS": {"directory": tmp_path, "fsync": False},
+        },
+        "compressed": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocFileStorage",
+            "STORAGE_OPTIONS": {"directory": tmp_path},
+            "COMPRESSION": "zlib",
+        },
+    }
+    storage = get_ydoc_storage("test")
+    assert isinstance(storage, YDocFileStorage)
+    assert storage.fsync is False
+    assert await storage.get_snapshot("test") is None
+    await storage.save_snapshot("test", b"test")
+    assert await storage.get_snapshot("test") == b"test"
+    await storage.save_snapshot("test", b"test2")
+    assert await storage.get_snapshot("test") == b"test2"
+
+    path = storage.get_path("test")
+    assert path.relative_to(tmp_path).parts == (
+        path.name[:2],
+        path.name[2:4],
+        path.name,
+    )
+    assert path.read_bytes() == b"test2"
+
+    compressed_storage = get_ydoc_storage("compressed.1")
+    assert compressed_storage is not storage
+    assert compressed_storage.fsync is True
+    data = b"hello " * 100
+    await compressed_storage.save_snapshot("compressed.1", data)
+    assert len(compressed_storage.get_path("compressed.1").read_bytes()) < len(data)
+    assert await compressed_storage.get_snapshot("compressed.1") == data
+
+    # No temporary files are left behind
+    assert not [p for p in tmp_path.rglob("*") if p.name.startswith(".tmp-")]
+
+    with pytest.raises(ImproperlyConfigured):
+        YDocFileStorage()
+
+
+@pytest.mark.asyncio
+async def test_cached_storage(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocCachedStorage",
+            "STORAGE_OPTIONS": {
+                "backend": "channels_yroom.storage.YDocMemoryStorage",
+                "max_bytes": 10,
+            },
+        }
+    }
+    storage = get_ydoc_storage("test")
+    assert isinstance(storage, YDocCachedStorage)
+    assert isinstance(storage.storage, YDocMemoryStorage)
+    assert not hasattr(storage, "get_updates")
+
+    await storage.storage.save_snapshot("a", b"aaaa")
+    assert await storage.get_snapshot("a") == b"aaaa"
+    assert await storage.get_snapshot("a") == b"aaaa"
+    assert storage.get_stats() == {
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+        "entries": 1,
+        "bytes": 4,
+    }
+
+    # Write through
+    await storage.save_snapshot("b", b"bbbb")
+    assert await storage.storage.get_snapshot("b") == b"bbbb"
+    assert await storage.get_snapshot("b") == b"bbbb"
+    assert storage.hits == 2
+
+    # Least recently used snapshot is evicted
+    await storage.get_snapshot("a")
+    await storage.save_snapshot("c", b"cccc")
+    assert storage.evictions == 1
+    assert storage.size == 8
+    assert await storage.get_snapshots(["a", "b", "c", "d"]) == {
+        "a": b"aaaa",
+        "b": b"bbbb",
+        "c": b"cccc",
+    }
+    assert storage.misses == 3
+
+    # Too large to cache
+    await storage.save_snapshot("large", b"x" * 11)
+    assert await storage.get_snapshot("large") == b"x" * 11
+    assert storage.misses == 4
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_cached_storage_passes_through_incremental_methods():
+    storage = YDocCachedStorage(
+        backend="channels_yroom.storage.YDocIncrementalDatabaseStorage"
+    )
+    assert await storage.get_updates("test") == []
+    await storage.append_update("test", b"one")
+    assert await storage.get_updates("test") == [b"one"]
+
+
+@pytest.mark.asyncio
+async def test_database_storage_threads(monkeypatch):
+    barrier = threading.Barrier(2, timeout=5)
+    thread_names = set()
+
+    def get_snapshot_in_parallel(room_name):
+        # Only passes if both calls run at the same time
+        barrier.wait()
+        thread_names.add(threading.current_thread().name)
+        return room_name.encode()
+
+    monkeypatch.setattr(storage_module, "get_db_snapshot", get_snapshot_in_parallel)
+    storage = YDocDatabaseStorage(threads=2)
+    results = await asyncio.gather(storage.get_snapshot("a"), storage.get_snapshot("b"))
+    storage.executor.shutdown()
+
+    assert results == [b"a", b"b"]
+    assert len(thread_names) == 2
+    assert all(name.startswith("yroom-storage") for name in thread_names)
+
+    with pytest.raises(ValueError):
+        YDocDatabaseStorage(threads=0)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_database_storage_threads_roundtrip():
+    storage = YDocDatabaseStorage(threads=2)
+    # SQLite's shared in-memory test database locks on concurrent writes
+    await storage.save_snapshot("a", b"a")
+    await storage.save_snapshot("b", b"b")
+    assert await asyncio.gather(
+        storage.get_snapshot("a"), storage.get_snapshot("b")
+    ) == [b"a", b"b"]
+    storage.executor.shutdown()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_worker_shutdown_stops_storage_threads(settings):
+    settings.YROOM_SETTINGS = {"default": {}}
+    consumer = YRoomChannelConsumer()
+    consumer.channel_layer = get_channel_layer()
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    consumer.base_send = send
+    storage = YDocDatabaseStorage(threads=1)
+    consumer.storages["threads"] = storage
+
+    await consumer.shutdown({"type": "shutdown", "signal": None})
+    assert sent == [{"type": "shutdown.complete"}]
+    assert storage.executor.executor is None
+
+    # Storages are cached per process, the next worker reuses them
+    await storage.save_snapshot("threads.1", b"data")
+    assert await storage.get_snapshot("threads.1") == b"data"
+    storage.executor.shutdown()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_database_storage_async_orm(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocDatabaseStorage",
+            "STORAGE_OPTIONS": {"async_orm": True},
+            "COMPRESSION": "zlib",
+        },
+    }
+    data = b"hello " * 100
+    storage = get_ydoc_storage("async.1")
+    assert storage.async_orm
+    assert await storage.get_snapshot("async.1") is None
+
+    await storage.save_snapshot("async.1", b"old")
+    await storage.save_snapshot("async.1", data)
+    row = await YDocUpdate.objects.aget(name="async.1")
+    assert bytes(row.data).startswith(b"\xffYR")
+    assert await storage.get_snapshot("async.1") == data
+
+    await storage.save_snapshots({"async.1": b"a", "async.2": b"b"})
+    await storage.save_snapshots({})
+    assert await storage.get_snapshots(["async.1", "async.2", "async.3"]) == {
+        "async.1": b"a",
+        "async.2": b"b",
+    }
+
+    with pytest.raises(ImproperlyConfigured):
+        YDocDatabaseStorage(threads=2, async_orm=True)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_database_storage_async_orm_compresses_off_loop(monkeypatch):
+    loop_thread = threading.current_thread()
+    threads = []
+
+    def record_thread(func):
+        def wrapper(*args):
+            threads.append(threading.current_thread())
+            return func(*args)
+
+        return wrapper
+
+    monkeypatch.setattr(
+        storage_module,
+        "compress_snapshot",
+        record_thread(storage_module.compress_snapshot),
+    )
+    monkeypatch.setattr(
+        storage_module, "decompress", record_thread(storage_module.decompress)
+    )
+    storage = YDocDatabaseStorage(async_orm=True)
+    await storage.save_snapshot("async.1", b"a")
+    await storage.save_snapshots({"async.2": b"b"})
+    assert await storage.get_snapshot("async.1") == b"a"
+    assert await storage.get_snapshots(["async.2"]) == {"async.2": b"b"}
+
+    assert len(threads) == 4
+    assert loop_thread not in threads
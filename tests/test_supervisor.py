@@ -0,0 +1,181 @@
+from io import StringIO
+
+import pytest
+from django.core.management import CommandError, call_command
+
+from channels_yroom.management.commands.yroom import Command as YroomCommand
+from channels_yroom.supervisor import YroomSupervisor
+
+
+class FakeProcess:
+    def __init__(self, shard):
+        self.shard = shard
+        self.pid = 1000 + shard
+        self.exitcode = None
+        self.alive = True
+        self.terminated = False
+
+    def is_alive(self):
+        return self.alive
+
+    def terminate(self):
+        self.terminated = True
+        self.alive = False
+
+    def join(self):
+        pass
+
+
+class FakeSupervisor(YroomSupervisor):
+    def start_process(self, shard):
+        self.children[shard] = FakeProcess(shard)
+        self.restart_at.pop(shard, None)
+        self.started.append(shard)
+
+
+def make_supervisor(processes=2):
+    supervisor = FakeSupervisor(
+        worker_class=None, channel="yroom", channel_layer=None, processes=processes
+    )
+    supervisor.started = []
+    for shard in range(processes):
+        supervisor.start_process(shard)
+    return supervisor
+
+
+def test_supervisor_runs_worker_of_shard(monkeypatch):
+    workers = []
+
+    class FakeWorker:
+        def __init__(self, **kwargs):
+            workers.append(kwargs)
+
+        def run(self):
+            pass
+
+    # Don't reset the signal handlers or process group of the test process
+    monkeypatch.setattr("channels_yroom.supervisor.signal.signal", lambda *args: None)
+    process_groups = []
+    monkeypatch.setattr(
+        "channels_yroom.supervisor.os.setpgrp", lambda: process_groups.append(True)
+    )
+    supervisor = YroomSupervisor(
+        worker_class=FakeWorker,
+        channel="yroom",
+        channel_layer=None,
+        processes=4,
+        worker_kwargs={"batch_size": 10},
+    )
+    supervisor.stopping[2] = supervisor.context.Event()
+    supervisor.run_worker(2)
+
+    assert process_groups == [True]
+    assert workers == [
+        {
+            "channel": "yroom.2",
+            "channel_layer": None,
+            "shard": 2,
+            "on_shutdown": supervisor.stopping[2].set,
+            "batch_size": 10,
+        }
+    ]
+
+
+def test_supervisor_restarts_crashed_worker_after_delay():
+    supervisor = make_supervisor()
+    assert supervisor.started == [0, 1]
+
+    supervisor.children[1].alive = False
+    supervisor.children[1].exitcode = 1
+    supervisor.check_processes(now=10.0)
+    assert supervisor.started == [0, 1]
+    assert supervisor.restart_at == {1: 10.0 + supervisor.restart_delay}
+
+    supervisor.check_processes(now=10.0 + supervisor.restart_delay)
+    assert supervisor.started == [0, 1, 1]
+    assert supervisor.children[1].is_alive()
+    assert not supervisor.restart_at
+
+
+def test_supervisor_does_not_restart_clean_exit():
+    supervisor = make_supervisor()
+    supervisor.children[1].alive = False
+    supervisor.children[1].exitcode = 0
+    supervisor.check_processes(now=10.0)
+    supervisor.check_processes(now=10.0 + supervisor.restart_delay)
+    assert supervisor.started == [0, 1]
+    assert list(supervisor.children) == [0]
+
+
+def test_supervisor_forwards_termination():
+    supervisor = make_supervisor(processes=3)
+    children = list(supervisor.children.values())
+    supervisor.handle_signal(15, None)
+    assert supervisor.shutting_down
+
+    supervisor.stop_processes()
+    assert all(child.terminated for child in children)
+    assert not supervisor.children
+
+
+def test_supervisor_skips_stopping_worker():
+    supervisor = make_supervisor(processes=2)
+    children = list(supervisor.children.values())
+    # Worker 0 got the signal directly and is already saving its rooms
+    supervisor.stopping[0] = supervisor.context.Event()
+    supervisor.stopping[0].set()
+    supervisor.handle_signal(15, None)
+
+    supervisor.stop_processes()
+    assert not children[0].terminated
+    assert children[1].terminated
+
+
+def test_yroom_command_processes(monkeypatch, settings):
+    runs = []
+
+    class CommandSupervisor:
+        def __init__(
+            self, worker_class, channel, channel_layer, processes, worker_kwargs
+        ):
+            runs.append((channel, processes, worker_kwargs))
+
+        def run(self):
+            pass
+
+    monkeypatch.setattr(YroomCommand, "supervisor_class", CommandSupervisor)
+    settings.YROOM_SETTINGS = {"default": {"SHARDS": 4}}
+    out = StringIO()
+    call_command(
+        "yroom",
+        "--processes",
+        "4",
+        "--batch-size",
+        "50",
+        stdout=out,
+        stderr=StringIO(),
+    )
+    assert "Running 4 workers for channel 'yroom'\n" == out.getvalue()
+    assert runs == [("yroom", 4, {"batch_size": 50})]
+
+    with pytest.raises(CommandError):
+        call_command("yroom", "--processes", "2", stdout=out, stderr=StringIO())
+    with pytest.raises(CommandError):
+        call_command(
+            "yroom", "--processes", "4", "--shard", "1", stdout=out, stderr=StringIO()
+        )
+    with pytest.raises(CommandError):
+        call_command(
+            "yroom",
+            "--processes",
+            "4",
+            "--channel",
+            "yroom",
+            stdout=out,
+            stderr=StringIO(),
+        )
+    # Without SHARDS consumers send to the unsharded channel only
+    settings.YROOM_SETTINGS = {"default": {}}
+    with pytest.raises(CommandError):
+        call_command("yroom", "--processes", "4", stdout=out, stderr=StringIO())
+    assert len(runs) == 1
@@ -0,0 +1,119 @@
+import pytest
+from channels.testing import WebsocketCommunicator
+
+from channels_yroom.consumer import YroomConsumer
+from channels_yroom.tracing import export_spans, make_span, worker_spans
+
+from .test_consumer import FakeWorker
+
+exported = []
+
+
+def record_spans(spans):
+    exported.extend(spans)
+
+
+def failing_exporter(spans):
+    raise RuntimeError("collector down")
+
+
+def test_make_span():
+    span = make_span(
+        "a" * 32, "b" * 16, "c" * 16, "yroom.test", 1000, 2500, {"yroom.size": 3}
+    )
+    assert span == {
+        "traceId": "a" * 32,
+        "spanId": "b" * 16,
+        "parentSpanId": "c" * 16,
+        "name": "yroom.test",
+        "kind": 1,
+        "startTimeUnixNano": "1000",
+        "endTimeUnixNano": "2500",
+        "attributes": [{"key": "yroom.size", "value": {"intValue": "3"}}],
+    }
+    assert "parentSpanId" not in make_span("a" * 32, "b" * 16, None, "root", 0, 1)
+
+
+def test_worker_spans():
+    trace = {"trace_id": "t", "span_id": "root", "sent": 10, "worker_received": 20}
+    spans = worker_spans(trace, "room", 30, 40, "fanout", 50)
+    assert [
+        (span["name"], span["startTimeUnixNano"], span["endTimeUnixNano"])
+        for span in spans
+    ] == [
+        ("yroom.channel_layer", "10", "20"),
+        ("yroom.input_queue", "20", "30"),
+        ("yroom.handle_message", "30", "40"),
+        ("yroom.fan_out", "40", "50"),
+    ]
+    assert all(span["parentSpanId"] == "root" for span in spans)
+    assert spans[-1]["spanId"] == "fanout"
+
+    del trace["worker_received"]
+    spans = worker_spans(trace, "room", 30, 40, "fanout", 50)
+    assert [span["name"] for span in spans] == ["yroom.handle_message", "yroom.fan_out"]
+
+
+def test_export_spans_ignores_exporter_errors(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {"TRACE_EXPORTER": "tests.test_tracing.failing_exporter"}
+    }
+    export_spans([make_span("a" * 32, "b" * 16, None, "root", 0, 1)])
+
+
+@pytest.mark.asyncio
+async def test_traced_message(settings, ydata):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocDummyStorage",
+            "TRACE_SAMPLE_RATE": 1.0,
+            "TRACE_EXPORTER": "tests.test_tracing.record_spans",
+        }
+    }
+    exported.clear()
+    app = YroomConsumer()
+    app_2 = YroomConsumer()
+    fake_worker = FakeWorker.from_defaults(room_name=app.get_room_name())
+    async with fake_worker.start():
+        client_1 = WebsocketCommunicator(app, "/testws/")
+        client_2 = WebsocketCommunicator(app_2, "/testws/")
+        await client_1.connect()
+        await fake_worker.wait_for_message()
+        await client_1.receive_from()
+        await client_2.connect()
+        await fake_worker.wait_for_message()
+        await client_2.receive_from()
+        assert exported == []
+
+        await client_1.send_to(bytes_data=ydata.AWARENESS_UPDATE)
+        message = await fake_worker.wait_for_message()
+        trace = message["trace"]
+        assert await client_1.receive_from() == ydata.AWARENESS_UPDATE
+        assert await client_2.receive_from() == ydata.AWARENESS_UPDATE
+
+        await client_1.disconnect()
+        await fake_worker.wait_for_message()
+        await client_2.disconnect()
+        await fake_worker.wait_for_message()
+        await fake_worker.shutdown()
+
+    assert {span["traceId"] for span in exported} == {trace["trace_id"]}
+    spans = {}
+    for span in exported:
+        spans.setdefault(span["name"], []).append(span)
+    assert set(spans) == {
+        "yroom.receive",
+        "yroom.handle_message",
+        "yroom.fan_out",
+        "yroom.deliver",
+    }
+    (receive,) = spans["yroom.receive"]
+    assert receive["spanId"] == trace["span_id"]
+    assert "parentSpanId" not in receive
+    (fan_out,) = spans["yroom.fan_out"]
+    assert fan_out["parentSpanId"] == receive["spanId"]
+    # One delivery per client of the broadcast
+    assert len(spans["yroom.deliver"]) == 2
+    for deliver in spans["yroom.deliver"]:
+        assert deliver["parentSpanId"] == fan_out["spanId"]
+        assert int(deliver["startTimeUnixNano"]) <= int(deliver["endTimeUnixNano"])
@@ -4,18 +4,19 @@ from io import StringIO
 import pytest
 from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
-from django.core.management import call_command
+from django.core.management import CommandError, call_command
 
 from channels_yroom.channel import YRoomChannelConsumer
 from channels_yroom.conf import get_default_room_settings
 from channels_yroom.consumer import YroomConsumer
 from channels_yroom.management.commands.yroom import Command as YroomCommand
 from channels_yroom.models import YDocUpdate
+from channels_yroom.protocol import write_var_uint
 from channels_yroom.storage import get_ydoc_storage
 from channels_yroom.worker import YroomWorker
 
 
-def test_yroom_command(monkeypatch):
+def test_yroom_command(monkeypatch, settings):
     class FakeWorker:
         def __init__(self, channel, channel_layer):
             self.channel = channel
@@ -43,6 +44,42 @@ def test_yroom_command(monkeypatch):
     )
     assert "Running worker for channel 'foobar'\n" == out.getvalue()
 
+    # Without SHARDS consumers send to the unsharded channel only
+    with pytest.raises(CommandError):
+        call_command("yroom", "--shard", "2", stdout=out, stderr=StringIO())
+
+    settings.YROOM_SETTINGS = {
+        "default": {"SHARDS": 3},
+        "collab": {"CHANNEL_NAME": "collab", "SHARDS": 2},
+    }
+    out = StringIO()
+    call_command(
+        "yroom",
+        "--shard",
+        "2",
+        stdout=out,
+        stderr=StringIO(),
+    )
+    assert "Running worker for channel 'yroom.2'\n" == out.getvalue()
+    with pytest.raises(CommandError):
+        call_command("yroom", "--shard", "3", stdout=out, stderr=StringIO())
+
+    out = StringIO()
+    call_command(
+        "yroom", "--channel", "collab", "--shard", "1", stdout=out, stderr=StringIO()
+    )
+    assert "Running worker for channel 'collab.1'\n" == out.getvalue()
+    with pytest.raises(CommandError):
+        call_command(
+            "yroom",
+            "--channel",
+            "collab",
+            "--shard",
+            "2",
+            stdout=out,
+            stderr=StringIO(),
+        )
+
 
 @pytest.mark.asyncio
 @pytest.mark.django_db
@@ -77,7 +114,12 @@ async def test_yroom_worker(settings, ydata):
 
     fake_loop = FakeLoop()
 
-    worker = YroomWorker(channel=channel, channel_layer=channel_layer)
+    shutdowns = []
+    worker = YroomWorker(
+        channel=channel,
+        channel_layer=channel_layer,
+        on_shutdown=lambda: shutdowns.append(True),
+    )
     worker._setup_signal_handlers(fake_loop)
     assert fake_loop.added_signals == set(worker.SIGNALS)
     worker_task = asyncio.create_task(worker.run_worker())
@@ -97,10 +139,20 @@ async def test_yroom_worker(settings, ydata):
     payload = await client_1.receive_from()
     assert payload == ydata.SYNC_STEP_1_DATA
 
+    # Edit document, update is broadcast back
+    await client_1.send_to(bytes_data=ydata.DOC_UPDATE)
+    payload = await client_1.receive_from()
+    assert payload == ydata.DOC_UPDATE
+
     fake_loop = FakeLoop()
     await worker.shutdown_worker(fake_loop, FakeSignal)
     assert loop_state["stopped"]
     assert fake_loop.removed_signals == set(worker.SIGNALS)
+    assert shutdowns == [True]
+
+    # A repeated signal doesn't start another shutdown
+    await worker.shutdown_worker(fake_loop, FakeSignal)
+    assert shutdowns == [True]
 
     ydoc_update = await YDocUpdate.objects.aget(name=room_name)
     assert ydoc_update.timestamp > timestamp_before
@@ -202,3 +254,270 @@ def test_worker_exception_handling_during_shutdown(event_loop, capsys, caplog):
 
     assert worker.shutting_down
     assert event_loop.is_closed()
+
+
+class RecordingChannelLayer:
+    def __init__(self):
+        self.sent = []
+        self.group_sent = []
+
+    async def send(self, channel, message):
+        self.sent.append((channel, message))
+
+    async def group_send(self, group, message):
+        self.group_sent.append((group, message))
+
+
+@pytest.mark.asyncio
+async def test_dispatch_batch_merges_responses_per_room(ydata):
+    consumer = YRoomChannelConsumer()
+    consumer.channel_layer = RecordingChannelLayer()
+
+    def make_message(room, conn_id, payload, type="message"):
+        return {
+            "type": type,
+            "room": room,
+            "conn_id": conn_id,
+            "channel_name": "client.%d" % conn_id,
+            "payload": payload,
+        }
+
+    # Clients connected in an earlier batch
+    for room, conn_id in (("room_b", 2), ("room_a", 3), ("room_b", 4)):
+        await consumer.connect(make_message(room, conn_id, None, type="connect"))
+    consumer.channel_layer.sent.clear()
+    consumer.channel_layer.group_sent.clear()
+
+    await consumer.dispatch_batch(
+        [
+            make_message("room_a", 1, None, type="connect"),
+            make_message("room_a", 1, ydata.SYNC_STEP_1),
+            make_message("room_b", 2, ydata.AWARENESS_UPDATE),
+            make_message("room_a", 1, ydata.AWARENESS_UPDATE),
+            make_message("room_a", 3, ydata.AWARENESS_UPDATE),
+            make_message("room_b", 4, ydata.AWARENESS_UPDATE),
+        ]
+    )
+
+    assert consumer.channel_layer.sent == [
+        # connect response
+        ("client.1", {"type": "forward_payload", "payloads": [ydata.SYNC_STEP_1]}),
+        # sync step 1 response
+        ("client.1", {"type": "forward_payload", "payloads": [ydata.SYNC_STEP_2]}),
+    ]
+    assert consumer.channel_layer.group_sent == [
+        (
+            "room_a",
+            {
+                "type": "forward_payload",
+                "payloads": [ydata.AWARENESS_UPDATE, ydata.AWARENESS_UPDATE],
+            },
+        ),
+        (
+            "room_b",
+            {
+                "type": "forward_payload",
+                "payloads": [ydata.AWARENESS_UPDATE, ydata.AWARENESS_UPDATE],
+            },
+        ),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_broadcasts_are_coalesced_per_room(settings, ydata):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "STORAGE_BACKEND": "channels_yroom.storage.YDocDummyStorage",
+            "BROADCAST_COALESCE_WINDOW": 0.05,
+        }
+    }
+    consumer = YRoomChannelConsumer()
+    consumer.channel_layer = RecordingChannelLayer()
+
+    for conn_id in (1, 2, 3, 4):
+        await consumer.connect(
+            {
+                "type": "connect",
+                "room": "room_a",
+                "conn_id": conn_id,
+                "channel_name": "client.%d" % conn_id,
+            }
+        )
+    await consumer.scheduler.join()
+    consumer.channel_layer.group_sent.clear()
+
+    for conn_id in (1, 2, 3):
+        message = {
+            "type": "message",
+            "room": "room_a",
+            "conn_id": conn_id,
+            "channel_name": "client.%d" % conn_id,
+            "payload": ydata.AWARENESS_UPDATE,
+        }
+        await consumer.message(message)
+    assert consumer.channel_layer.group_sent == []
+    assert consumer.coalesce_windows == {"room_a": 0.05}
+
+    await consumer.scheduler.join()
+    assert consumer.channel_layer.group_sent == [
+        (
+            "room_a",
+            {"type": "forward_payload", "payloads": [ydata.AWARENESS_UPDATE] * 3},
+        )
+    ]
+    assert consumer.broadcast_buffers == {}
+
+    # Pending broadcasts are sent on shutdown
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    consumer.base_send = send
+    await consumer.message(dict(message, conn_id=4))
+    await consumer.shutdown({"type": "shutdown"})
+    assert sent == [{"type": "shutdown.complete"}]
+    assert len(consumer.channel_layer.group_sent) == 2
+
+
+@pytest.mark.asyncio
+async def test_worker_batches_queued_messages():
+    batches = []
+
+    class BatchRecordingConsumer(YRoomChannelConsumer):
+        async def dispatch_batch(self, messages):
+            batches.append([message["n"] for message in messages])
+
+    class BatchingWorker(YroomWorker):
+        consumer_class = BatchRecordingConsumer
+
+    with pytest.raises(ValueError):
+        YroomWorker(channel="yroom", channel_layer=None, batch_size=0)
+
+    worker = BatchingWorker(channel="yroom", channel_layer=None, batch_size=2)
+    worker.input_queue = asyncio.Queue()
+    for n in range(5):
+        worker.input_queue.put_nowait({"type": "message", "n": n})
+    consumer_task = asyncio.create_task(worker.run_consumer())
+    await asyncio.sleep(0)
+    consumer_task.cancel()
+
+    assert batches == [[0, 1], [2, 3], [4]]
+
+
+@pytest.mark.asyncio
+async def test_worker_unpacks_compact_messages(ydata):
+    batches = []
+
+    class BatchRecordingConsumer(YRoomChannelConsumer):
+        async def dispatch_batch(self, messages):
+            batches.append(messages)
+
+    class BatchingWorker(YroomWorker):
+        consumer_class = BatchRecordingConsumer
+
+    channel_layer = RecordingChannelLayer()
+    worker = BatchingWorker(channel="yroom", channel_layer=channel_layer, batch_size=10)
+    worker.input_queue = asyncio.Queue()
+    consumer_task = asyncio.create_task(worker.run_consumer())
+    await asyncio.sleep(0)
+    # Sessions of a previous worker are reset on start
+    assert channel_layer.group_sent == [
+        ("yroom__sessions", {"type": "yroom_session_reset", "handle": None})
+    ]
+    worker.consumer.sessions[5] = ("room_a", 1, "client.1")
+    for handle in (5, 6, 5):
+        worker.input_queue.put_nowait(
+            {"type": "packed", "data": write_var_uint(handle) + ydata.AWARENESS_UPDATE}
+        )
+    await asyncio.sleep(0)
+    consumer_task.cancel()
+
+    message = {
+        "type": "message",
+        "room": "room_a",
+        "conn_id": 1,
+        "channel_name": "client.1",
+        "payload": ydata.AWARENESS_UPDATE,
+    }
+    # Message of unknown session 6 is left to the consumer to reject
+    unknown = {"type": "packed", "data": write_var_uint(6) + ydata.AWARENESS_UPDATE}
+    assert batches == [[message, unknown, message]]
+
+
+@pytest.mark.asyncio
+async def test_packed_message_of_unknown_session_resets_session(ydata):
+    consumer = YRoomChannelConsumer()
+    consumer.channel_layer = RecordingChannelLayer()
+    data = write_var_uint(6) + ydata.DOC_UPDATE
+
+    # Without the worker channel there is no group to reset
+    await consumer.dispatch({"type": "packed", "data": data})
+    consumer.scope = {"type": "channel", "channel": "yroom.1"}
+    await consumer.dispatch({"type": "packed", "data": data})
+
+    assert consumer.channel_layer.sent == []
+    assert consumer.channel_layer.group_sent == [
+        ("yroom.1__sessions", {"type": "yroom_session_reset", "handle": 6})
+    ]
+    assert consumer.room_manager.list_rooms() == []
+
+
+@pytest.mark.asyncio
+async def test_worker_concurrent_dispatch_keeps_room_order():
+    dispatched = []
+    slow_room_release = asyncio.Event()
+
+    class SlowRoomConsumer(YRoomChannelConsumer):
+        async def dispatch(self, message):
+            if message["room"] == "slow" and message["n"] == 0:
+                await slow_room_release.wait()
+            dispatched.append((message["room"], message["n"]))
+
+    class ConcurrentWorker(YroomWorker):
+        consumer_class = SlowRoomConsumer
+
+    worker = ConcurrentWorker(channel="yroom", channel_layer=None, concurrent=True)
+    worker.input_queue = asyncio.Queue()
+    for room, n in [("slow", 0), ("fast", 0), ("slow", 1), ("fast", 1)]:
+        worker.input_queue.put_nowait({"type": "message", "room": room, "n": n})
+    consumer_task = asyncio.create_task(worker.run_consumer())
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+    # Fast room is not blocked by slow room
+    assert dispatched == [("fast", 0), ("fast", 1)]
+    assert list(worker.room_queues) == ["slow"]
+
+    slow_room_release.set()
+    for _ in range(5):
+        await asyncio.sleep(0)
+    assert dispatched == [("fast", 0), ("fast", 1), ("slow", 0), ("slow", 1)]
+    assert not worker.room_queues
+    consumer_task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_worker_concurrent_dispatch_reports_exceptions():
+    contexts = []
+
+    class FailingConsumer(YRoomChannelConsumer):
+        async def dispatch(self, message):
+            raise ValueError("Room failure")
+
+    class ConcurrentWorker(YroomWorker):
+        consumer_class = FailingConsumer
+
+    loop = asyncio.get_running_loop()
+    loop.set_exception_handler(lambda loop, context: contexts.append(context))
+    worker = ConcurrentWorker(channel="yroom", channel_layer=None, concurrent=True)
+    worker.input_queue = asyncio.Queue()
+    worker.input_queue.put_nowait({"type": "message", "room": "room"})
+    consumer_task = asyncio.create_task(worker.run_consumer())
+    for _ in range(5):
+        await asyncio.sleep(0)
+    consumer_task.cancel()
+    loop.set_exception_handler(None)
+
+    assert len(contexts) == 1
+    assert str(contexts[0]["exception"]) == "Room failure"
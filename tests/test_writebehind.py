@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+
+from channels_yroom.autosave import Autosave
+from channels_yroom.writebehind import WriteBehind
+
+
+class FakeChannelConsumer:
+    def __init__(self, fail=False):
+        self.saved_batches = []
+        self.fail = fail
+        self.write_behind = WriteBehind(consumer=self)
+
+    def get_storage(self, room_name):
+        return "storage"
+
+    async def snapshot_rooms(self, room_names):
+        self.saved_batches.append(room_names)
+        if self.fail:
+            raise ValueError("Database is down")
+
+
+@pytest.mark.asyncio
+async def test_full_batch_is_flushed_at_once(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {"WRITE_BEHIND_MAX_BATCH": 2, "WRITE_BEHIND_MAX_DELAY": 10},
+    }
+    consumer = FakeChannelConsumer()
+    write_behind = consumer.write_behind
+
+    write_behind.enqueue("a")
+    write_behind.enqueue("a")
+    assert write_behind.depth == 1
+    write_behind.enqueue("b")
+    write_behind.enqueue("c")
+    await asyncio.sleep(0.01)
+
+    assert consumer.saved_batches == [["a", "b"]]
+    assert write_behind.depth == 1
+    assert write_behind.get_stats()["flush_count"] == 1
+    assert write_behind.get_stats()["flushed_rooms"] == 2
+
+    await write_behind.close()
+    assert consumer.saved_batches == [["a", "b"], ["c"]]
+    assert write_behind.depth == 0
+    assert not write_behind.flusher_tasks
+
+
+@pytest.mark.asyncio
+async def test_batch_is_flushed_after_max_delay(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {"WRITE_BEHIND_MAX_DELAY": 0.05},
+    }
+    consumer = FakeChannelConsumer()
+    write_behind = consumer.write_behind
+
+    write_behind.enqueue("a")
+    await asyncio.sleep(0.03)
+    write_behind.enqueue("b")
+    write_behind.forget("c")
+    assert consumer.saved_batches == []
+    await asyncio.sleep(0.05)
+
+    assert consumer.saved_batches == [["a", "b"]]
+    assert write_behind.get_stats()["last_flush_latency"] is not None
+    assert not write_behind.flusher_tasks
+
+    # A new flusher starts for rooms queued later
+    write_behind.enqueue("c")
+    await asyncio.sleep(0.07)
+    assert consumer.saved_batches == [["a", "b"], ["c"]]
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_is_logged(settings, caplog):
+    settings.YROOM_SETTINGS = {
+        "default": {"WRITE_BEHIND_MAX_DELAY": 10},
+    }
+    consumer = FakeChannelConsumer(fail=True)
+    write_behind = consumer.write_behind
+
+    write_behind.enqueue("a")
+    await write_behind.close()
+
+    assert consumer.saved_batches == [["a"]]
+    assert write_behind.get_stats()["flush_count"] == 1
+    assert "Write-behind save of 1 rooms failed" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_is_retried_with_backoff(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {"WRITE_BEHIND_MAX_BATCH": 2, "WRITE_BEHIND_MAX_DELAY": 0},
+    }
+    consumer = FakeChannelConsumer(fail=True)
+    write_behind = consumer.write_behind
+    write_behind.retry_delay = 0.05
+
+    write_behind.enqueue("a")
+    await asyncio.sleep(0.01)
+    assert consumer.saved_batches == [["a"]]
+    # Failed rooms wait in front of newly queued rooms, even for full batches
+    write_behind.enqueue("b")
+    write_behind.enqueue("c")
+    assert list(write_behind.queues["storage"]) == ["a", "b", "c"]
+    await asyncio.sleep(0.01)
+    assert consumer.saved_batches == [["a"]]
+
+    await asyncio.sleep(0.06)
+    assert consumer.saved_batches == [["a"], ["a", "b"]]
+    assert write_behind.failures["storage"] == 2
+
+    consumer.fail = False
+    # Second retry waits twice as long
+    await asyncio.sleep(0.12)
+    assert consumer.saved_batches[2:] == [["a", "b"], ["c"]]
+    assert "storage" not in write_behind.failures
+    assert write_behind.get_stats()["failed_flushes"] == 2
+    assert write_behind.depth == 0
+
+
+@pytest.mark.asyncio
+async def test_autosave_enqueues_with_write_behind(settings):
+    settings.YROOM_SETTINGS = {
+        "default": {
+            "AUTOSAVE_DELAY": 0.01,
+            "WRITE_BEHIND": True,
+            "WRITE_BEHIND_MAX_DELAY": 10,
+        },
+    }
+    consumer = FakeChannelConsumer()
+    autosave = Autosave(consumer)
+
+    autosave.nudge("a")
+    autosave.nudge("b")
+    await autosave.scheduler.join()
+
+    assert consumer.write_behind.depth == 2
+    await consumer.write_behind.close()
+    assert consumer.saved_batches == [["a", "b"]]